@@ -1,8 +1,13 @@
-from math import log
+from bisect import bisect_right
 from Persistent.Array.fixed_array import FixedArray
+from Persistent.Data.dtype        import get_dtype
+from Persistent.Storage           import MmapStorage
 from Persistent import DynamicCollection
 
-class Array(DynamicCollection):
+# Array is a new style class, so that slices are handed to __getitem__ as
+# they are. Old style classes work out negative slice indexes with __len__,
+# which an array that grows on demand doesn't have.
+class Array(DynamicCollection, object):
     """ Array class is a dynamic array that grows as more elements are added.
     The array elements are Data objects.
 
@@ -15,10 +20,13 @@ class Array(DynamicCollection):
 
     This is kind of dangerous, but a design decision that I feel is okay. Just
     don't access element 1,000,000,000,000 by accident, or you'll create a
-    pretty huge array.
+    pretty huge array. Read only arrays never allocate, so gets outside of
+    the allocated space return None instead.
 
     Because of this behvaior, a get or set should never fail for a given index,
-    unless you run out of disk space.
+    unless you run out of disk space, or the index is negative. Since the
+    array doesn't have an end, there's nothing for negative indexes to count
+    back from, so they raise an IndexError, in slices too.
 
     The implementation details of this array are different than for most
     dynamic arrays. In a typical dynamic array, a certain amount of space
@@ -99,6 +107,18 @@ class Array(DynamicCollection):
     ...   a[i] = Integer(value=i)
     >>> [False for i in xrange(10000) if a[i].value != i]
     []
+    >>> a[-1]
+    Traceback (most recent call last):
+    ...
+    IndexError: Array indexes can't be negative: -1
+    >>> a[-2:]
+    Traceback (most recent call last):
+    ...
+    IndexError: Array indexes can't be negative: -2
+    >>> a[:-1] = [Integer(value=1)]
+    Traceback (most recent call last):
+    ...
+    IndexError: Array indexes can't be negative: -1
 
     >>> import os
     >>> os.remove("array_doctest.db")
@@ -107,6 +127,28 @@ class Array(DynamicCollection):
 
     fixed_collection = FixedArray
 
+    # The index each fixed array starts at, followed by the index the last
+    # of them stops at. See _get_starts().
+    starts = [0]
+
+    def _get_starts(self, index):
+        """ Returns the list of the index that each fixed array starts at,
+        followed by the index that the last of them stops at, with enough of
+        them that the given index falls in one. Fixed arrays that haven't
+        been allocated yet are included, with the allocations that the
+        growth policy will give them.
+
+        """
+        starts = self.starts
+        if index >= starts[-1]:
+            with self.lock:
+                starts = list(self.starts)
+                while index >= starts[-1]:
+                    starts.append(starts[-1] +
+                        self._get_allocation(len(starts) - 1))
+                self.starts = starts
+        return starts
+
     def _get_array_index(self, index):
         """ Since our array is really an array of fixed size arrays, this
         function tells us which fixed array our index is in.
@@ -129,8 +171,13 @@ class Array(DynamicCollection):
         >>> os.remove("array_doctest.db")
 
         """
-        block = (index / self.initial_allocation) + 1
-        return int(log(block, 2))
+        self._check_index(index)
+        return bisect_right(self._get_starts(index), index) - 1
+
+    def _check_index(self, index):
+        """ Raises an IndexError if the index is negative. """
+        if index < 0:
+            raise IndexError("Array indexes can't be negative: %d" % index)
 
     def _get_relative_index(self, index, array_index):
         """ Whereas _get_array_index tells us which fixed array our index is
@@ -155,9 +202,400 @@ class Array(DynamicCollection):
         >>> os.remove("array_doctest.db")
 
         """
-        if array_index > 0:
-            return index - self.initial_allocation*((2**array_index)-1)
-        return index
+        return index - self._get_array_start(array_index)
+
+    def _get_array_start(self, array_index):
+        """ Returns the index of the first element of the given fixed array.
+
+        >>> from Persistent import Data, IntegerProperty
+        >>> class Integer(Data):
+        ...   value = IntegerProperty()
+        ...
+        >>> a = Array(Integer, "array_doctest.db")
+        >>> [a._get_array_start(i) for i in xrange(4)]
+        [0, 1024, 3072, 7168]
+
+        >>> import os
+        >>> os.remove("array_doctest.db")
+
+        """
+        starts = self.starts
+        while array_index >= len(starts):
+            starts = self._get_starts(starts[-1])
+        return starts[array_index]
+
+    def _allocate_index(self, index):
+        """ Allocates fixed arrays until the given index fits in the array. """
+        while self._get_array_index(index) >= len(self.collections):
+            if self.readonly:
+                raise Exception("The array is read only, and %d is past its "
+                    "end" % index)
+            self._add_collection(len(self.collections))
+
+    def reserve(self, count):
+        """ Allocates fixed arrays until there is room for count elements,
+        so that indexes up to count - 1 can be set without allocating
+        anything.
+
+        >>> from cStringIO import StringIO
+        >>> from Persistent import Data, IntegerProperty
+        >>> class Integer(Data):
+        ...   value = IntegerProperty()
+        ...
+        >>> a = Array(Integer, file_object=StringIO(), growth=1.5)
+        >>> a.reserve(4864)
+        >>> [c.allocation for c in a.collections]
+        [1024, 1536, 2304]
+        >>> [a._get_array_index(i) for i in (1023, 1024, 2559, 2560, 4864)]
+        [0, 1, 1, 2, 3]
+        >>> a[4863] = Integer(value=5)
+        >>> len(a.collections), a[4863].value
+        (3, 5)
+
+        """
+        if count > 0:
+            self._allocate_index(count - 1)
+
+    def _get_runs(self, indexes):
+        """ Splits the sorted, unique indexes into runs of consecutive indexes
+        that fall within the same fixed array, so each run can be read or
+        written with a single call.
+
+        Yields the fixed array, the relative index the run starts at, and the
+        indexes in the run.
+
+        >>> from Persistent import Data, IntegerProperty
+        >>> class Integer(Data):
+        ...   value = IntegerProperty()
+        ...
+        >>> a = Array(Integer, "array_doctest.db")
+        >>> a._allocate_index(3072)
+        >>> [(a.collections.index(f), s, len(i))
+        ...   for f, s, i in a._get_runs([5, 6, 7, 9, 1022, 1023, 1024, 3072])]
+        [(0, 5, 3), (0, 9, 1), (0, 1022, 2), (1, 0, 1), (2, 0, 1)]
+
+        >>> import os
+        >>> os.remove("array_doctest.db")
+
+        """
+        # We walk the indexes alongside the fixed arrays, instead of working
+        # out which fixed array each index is in.
+        array_index = 0
+        array_start = 0
+        array_stop  = self._get_array_start(1)
+        run         = []
+        for index in indexes:
+            if run and (index != run[-1] + 1 or index >= array_stop):
+                yield (self.collections[array_index], run[0] - array_start,
+                    run)
+                run = []
+            while index >= array_stop:
+                array_index += 1
+                array_start  = array_stop
+                array_stop   = self._get_array_start(array_index + 1)
+            run.append(index)
+        if run:
+            yield (self.collections[array_index], run[0] - array_start, run)
+
+    def items(self, generations=None, result="data"):
+        """ Yields the index and data of every element that has been set, in
+        order of index. Elements that were never set are skipped.
+
+        Each fixed array is read in large sequential chunks, and only one
+        chunk is held at a time, so this is the way to walk through all of a
+        large array. If generations is given, only the fixed arrays with
+        those numbers are walked, see DynamicCollection._get_generations.
+
+        The data are data objects, unless result is "tuple" or "namedtuple",
+        see FixedArray.get_range.
+
+        >>> from Persistent import Data, IntegerProperty
+        >>> class Integer(Data):
+        ...   value = IntegerProperty()
+        ...
+        >>> a = Array(Integer, "array_doctest.db")
+        >>> for i in (5, 1023, 1024, 5000):
+        ...   a[i] = Integer(value=-i)
+        >>> [(i, d.value) for i, d in a.items()]
+        [(5, -5), (1023, -1023), (1024, -1024), (5000, -5000)]
+        >>> list(a.keys([1, 2]))
+        [1024, 5000]
+        >>> list(a.values(result="tuple"))
+        [(-5,), (-1023,), (-1024,), (-5000,)]
+        >>> [d.value for d in a]
+        [-5, -1023, -1024, -5000]
+
+        >>> import os
+        >>> os.remove("array_doctest.db")
+
+        """
+        for number, fixed_array in self._get_generations(generations):
+            start = self._get_array_start(number)
+            for index, data in fixed_array.items(result):
+                yield start + index, data
+
+    def keys(self, generations=None):
+        """ Yields the index of every element that has been set, in order,
+        without deserializing any of them. See items().
+
+        """
+        for number, fixed_array in self._get_generations(generations):
+            start = self._get_array_start(number)
+            for index, bytes in fixed_array._read_elements():
+                yield start + index
+
+    def values(self, generations=None, result="data"):
+        """ Yields every element that has been set, in order of index. See
+        items().
+
+        """
+        for index, data in self.items(generations, result):
+            yield data
+
+    def __iter__(self):
+        """ Iterates over the elements that have been set. See items(). """
+        return self.values()
+
+    def _get_spans(self, start, stop):
+        """ Splits the indexes from start up to, but not including, stop by
+        the fixed array they fall in. Yields the fixed array, the relative
+        index the span starts at, and the number of indexes in the span.
+
+        >>> from Persistent import Data, IntegerProperty
+        >>> class Integer(Data):
+        ...   value = IntegerProperty()
+        ...
+        >>> a = Array(Integer, "array_doctest.db")
+        >>> a._allocate_index(3072)
+        >>> [(a.collections.index(f), s, n) for f, s, n in a._get_spans(5, 3080)]
+        [(0, 5, 1019), (1, 0, 2048), (2, 0, 8)]
+
+        >>> import os
+        >>> os.remove("array_doctest.db")
+
+        """
+        number = self._get_array_index(start)
+        while start < stop:
+            end = min(stop, self._get_array_start(number + 1))
+            yield (self.collections[number],
+                start - self._get_array_start(number), end - start)
+            start   = end
+            number += 1
+
+    def get_dtype(self):
+        """ Returns the numpy dtype of the elements of the array, as they are
+        on disk. See Persistent.Data.dtype.get_dtype for its fields.
+
+        numpy is only needed by get_dtype(), to_numpy() and from_numpy(), so
+        it's only imported when one of them is called.
+
+        """
+        import numpy
+        return numpy.dtype(get_dtype(self.data, self.checksum != "off"))
+
+    def to_numpy(self, start=0, stop=None, copy=True):
+        """ Returns the elements from index start up to, but not including,
+        index stop as a numpy structured array, with the dtype from
+        get_dtype(). If no stop is given, the elements run to the end of the
+        currently allocated space, and just like get_many(), space is
+        allocated for indexes past it.
+
+        Rather than making a data object for every element, the bytes of
+        each fixed array's share of the elements are read with a single read
+        and copied into the numpy array as they are. Elements that were
+        never set are all 0xFF bytes, or all zero bytes in sparse arrays, so
+        none of their "_set" fields are 1.
+
+        If copy is False, the array is memory mapped, and the elements all
+        fall in one fixed array, the numpy array is a view of the mapping
+        instead of a copy, and nothing is read at all. Writing to the view
+        writes to the file. The view is only good until the array is closed.
+
+        For example, with an array of Integer elements:
+
+            values = a.to_numpy(0, 1000)
+            total  = values["value"][values["value_set"] == 1].sum()
+
+        """
+        import numpy
+        dtype = self.get_dtype()
+        if stop == None:
+            stop = self._get_array_start(len(self.collections))
+        if stop <= start:
+            return numpy.zeros(0, dtype)
+        self._allocate_index(stop - 1)
+        spans = list(self._get_spans(start, stop))
+
+        if not copy and len(spans) == 1 and \
+                isinstance(self.storage, MmapStorage):
+            fixed_array, index, count = spans[0]
+            return numpy.frombuffer(self.storage.map, dtype, count,
+                fixed_array._get_address(index))
+
+        result   = numpy.empty(stop - start, dtype)
+        position = 0
+        for fixed_array, index, count in spans:
+            bytes = fixed_array.storage.read(fixed_array._get_address(index),
+                count * fixed_array.record_size)
+            result[position : position + count] = numpy.frombuffer(bytes,
+                dtype)
+            position += count
+        return result
+
+    def from_numpy(self, array, start=0):
+        """ Writes the elements of a numpy structured array into the array,
+        starting at index start. This is the opposite of to_numpy(), and the
+        numpy array has to have the dtype from get_dtype().
+
+        Each fixed array's share of the elements is written with a single
+        write. The "_set" field of every property has to be 1 for values
+        that are set, and 0 for None. The checksums are worked out as the
+        elements are written, so whatever is in the "checksum_" field is
+        ignored.
+
+        For example, to write a million Integer elements:
+
+            values = numpy.zeros(1000000, a.get_dtype())
+            values["value_set"] = 1
+            values["value"]     = numpy.arange(1000000)
+            a.from_numpy(values)
+
+        """
+        import numpy
+        dtype = self.get_dtype()
+        array = numpy.ascontiguousarray(array)
+        if array.dtype != dtype:
+            raise Exception("The numpy array's dtype doesn't match the array")
+        if not len(array):
+            return
+        stop = start + len(array)
+        self._allocate_index(stop - 1)
+        position = 0
+        with self.storage.operation():
+            for fixed_array, index, count in self._get_spans(start, stop):
+                bytes = bytearray(array[position : position + count].tostring())
+                if self.checksum != "off":
+                    self.data.add_checksums(bytes)
+                fixed_array.storage.write(fixed_array._get_address(index),
+                    str(bytes))
+                position += count
+
+    def _get_slice_indexes(self, index):
+        """ Turns a slice into the indexes that it covers. The array has no
+        length of its own, so a slice without a start or a stop runs to the
+        end of the currently allocated space, in whichever direction its step
+        goes. Just like single indexes, the bounds that are given can't be
+        negative, but they can be past the end.
+
+        >>> from cStringIO import StringIO
+        >>> from Persistent import Data, IntegerProperty
+        >>> class Integer(Data):
+        ...   value = IntegerProperty()
+        ...
+        >>> a = Array(Integer, file_object=StringIO())
+        >>> a._get_slice_indexes(slice(None, None, -1))
+        xrange(1023, -1, -1)
+        >>> a[0:3] = [Integer(value=i) for i in xrange(3)]
+        >>> [i.value for i in a[2::-1]], [i.value for i in a[:0:-1][-2:]]
+        ([2, 1, 0], [2, 1])
+        >>> len(a[::-1]), a[::-1][-1].value, len(a[1030:1020:-2])
+        (1024, 0, 5)
+        >>> a[::0]
+        Traceback (most recent call last):
+        ...
+        ValueError: slice step cannot be zero
+        >>> a[-1::-1]
+        Traceback (most recent call last):
+        ...
+        IndexError: Array indexes can't be negative: -1
+
+        """
+        for bound in (index.start, index.stop):
+            if bound != None:
+                self._check_index(bound)
+        step = index.step if index.step != None else 1
+        if step == 0:
+            raise ValueError("slice step cannot be zero")
+        end = self._get_array_start(len(self.collections))
+        if step > 0:
+            start = index.start if index.start != None else 0
+            stop  = index.stop if index.stop != None else end
+        else:
+            start = index.start if index.start != None else end - 1
+            stop  = index.stop if index.stop != None else -1
+        return xrange(start, stop, step)
+
+    def get_many(self, indexes, result="data"):
+        """ Gets the data for each of the given indexes, in the same order.
+
+        The indexes are grouped by the fixed array they fall in, and runs of
+        consecutive indexes are read with a single read. Reading thousands
+        of neighbouring elements is then a handful of reads rather than
+        thousands of them.
+
+        Just like __getitem__, space is allocated for indexes outside of the
+        currently allocated space, unless the array is read only.
+
+        The values are data objects, unless result is "tuple" or
+        "namedtuple", in which case they're tuples of the values of the
+        elements' properties. See FixedArray.get_range.
+
+        >>> from Persistent import Data, IntegerProperty
+        >>> class Integer(Data):
+        ...   value = IntegerProperty()
+        ...
+        >>> a = Array(Integer, "array_doctest.db")
+        >>> a.set_many((i, Integer(value=i)) for i in xrange(5000))
+        >>> [i.value for i in a.get_many([4999, 0, 1023, 1024, 1024])]
+        [4999, 0, 1023, 1024, 1024]
+        >>> [i.value for i in a[1020:1030]]
+        [1020, 1021, 1022, 1023, 1024, 1025, 1026, 1027, 1028, 1029]
+        >>> [i and i.value for i in a[4998:5002]]
+        [4998, 4999, None, None]
+        >>> a.get_many([3, 4999, 5000], "namedtuple")
+        [Integer(value=3), Integer(value=4999), None]
+        >>> a[10:0:-5] = [Integer(value=-1), Integer(value=-2)]
+        >>> [i.value for i in a[0:11]]
+        [0, 1, 2, 3, 4, -2, 6, 7, 8, 9, -1]
+
+        >>> import os
+        >>> os.remove("array_doctest.db")
+
+        """
+        indexes = list(indexes)
+        if not indexes:
+            return []
+        self._check_index(min(indexes))
+        results = {}
+        present = set(indexes)
+        if self.readonly:
+            stop    = self._get_array_start(len(self.collections))
+            present = set(index for index in indexes if index < stop)
+            results = dict((index, None) for index in indexes
+                if index >= stop)
+        else:
+            self._allocate_index(max(indexes))
+        for fixed_array, start, run in self._get_runs(sorted(present)):
+            datas = fixed_array.get_range(start, start + len(run), result)
+            results.update(zip(run, datas))
+        return [results[index] for index in indexes]
+
+    def set_many(self, pairs):
+        """ Sets the data for each of the given (index, data) pairs.
+
+        Just like get_many, consecutive indexes within a fixed array are
+        written with a single write. If an index appears more than once, the
+        last data for it wins.
+
+        """
+        datas = dict(pairs)
+        if not datas:
+            return
+        self._check_index(min(datas))
+        with self.storage.operation():
+            self._allocate_index(max(datas))
+            for fixed_array, start, run in self._get_runs(sorted(datas)):
+                fixed_array.set_range(start, [datas[index] for index in run])
 
     def __setitem__(self, index, data):
         """ Sets the index of this array equal to the data specified.
@@ -165,15 +603,21 @@ class Array(DynamicCollection):
         If the index specified is outside of the currently allocated space for
         the array, additional space will be allocated.
 
+        The index may also be a slice, in which case data is a sequence of
+        data objects, which are written with set_many().
+
         """
         #TODO For data objects with only one property, allow setting like:
         # a[5] = "Steve"
+        if isinstance(index, slice):
+            self.set_many(zip(self._get_slice_indexes(index), data))
+            return
         array_index    = self._get_array_index(index)
         relative_index = self._get_relative_index(index, array_index)
         if array_index < len(self.collections):
             self.collections[array_index][relative_index] = data
         else:
-            self._add_collection()
+            self._allocate_index(index)
             # Recurse and try setting again
             self[index] = data
 
@@ -183,18 +627,97 @@ class Array(DynamicCollection):
         If the index specified is outside of the currently allocated space for
         the array, additional space will be allocated. I'm still not sure if
         this design decision makes sense for __getitem__, but I figured it
-        couldn't hurt to stay consistent with __setitem__.
+        couldn't hurt to stay consistent with __setitem__. Read only arrays
+        return None instead, without allocating anything.
+
+        The index may also be a slice, in which case a list of data objects
+        is returned by get_many().
+
+        >>> from Persistent import Data, IntegerProperty
+        >>> class Integer(Data):
+        ...   value = IntegerProperty()
+        ...
+        >>> a = Array(Integer, "array_doctest.db")
+        >>> a[5] = Integer(value=5)
+        >>> a.close()
+        >>> import os
+        >>> size = os.path.getsize("array_doctest.db")
+        >>> a = Array(Integer, "array_doctest.db", readonly=True)
+        >>> a[5].value, a[50000], [i and i.value for i in a[1022:1026]]
+        (5, None, [None, None, None, None])
+        >>> os.path.getsize("array_doctest.db") == size
+        True
+        >>> a.close()
+        >>> os.remove("array_doctest.db")
 
         """
         #TODO For data objects with only one property, allow getting like:
         # a[5] = "Steve"
         # a[5] == "Steve"
         # True
+        if isinstance(index, slice):
+            return self.get_many(self._get_slice_indexes(index))
         array_index    = self._get_array_index(index)
         relative_index = self._get_relative_index(index, array_index)
         if array_index < len(self.collections):
             return self.collections[array_index][relative_index]
+        elif self.readonly:
+            return None
         else:
-            self._add_collection()
+            self._allocate_index(index)
             # Recurse and try setting again
             return self[index]
+
+    def aget(self, index):
+        """ Asynchronously gets the data for the index, and returns a Future
+        for it.
+
+        Reads that are waiting at the same time are carried out together with
+        get_many(), so neighbouring indexes are read in a single read.
+
+        >>> from Persistent import Data, IntegerProperty
+        >>> class Integer(Data):
+        ...   value = IntegerProperty()
+        ...
+        >>> a = Array(Integer, "array_doctest.db")
+        >>> writes = [a.aset(i, Integer(value=i)) for i in xrange(2000)]
+        >>> reads  = [a.aget(i) for i in xrange(2000)]
+        >>> [i for i in xrange(2000) if reads[i].result().value != i]
+        []
+        >>> [i.value for i in a.aget_many([5, 3, 1]).result()]
+        [5, 3, 1]
+        >>> a.close()
+
+        >>> import os
+        >>> os.remove("array_doctest.db")
+
+        """
+        return self._get_executor().submit(self.__getitem__, index,
+            key=index, batch=self.get_many)
+
+    def aget_many(self, indexes):
+        """ Asynchronously gets the data for each of the indexes, and returns
+        a Future for the list of them.
+
+        """
+        return self._get_executor().submit(self.get_many, list(indexes))
+
+    def aset(self, index, data):
+        """ Asynchronously sets the index to the data, and returns a Future
+        that is done once it has been set.
+
+        Writes that are waiting at the same time are carried out together
+        with set_many().
+
+        """
+        return self._get_executor().submit(self._set_pairs, [(index, data)],
+            key=index, write=True, batch=self._set_pair_lists)
+
+    def _set_pairs(self, pairs):
+        """ Sets the (index, data) pairs for aset(). """
+        self.set_many(pairs)
+
+    def _set_pair_lists(self, pair_lists):
+        """ Sets the pairs of many aset() requests at once. """
+        self.set_many(pair for pairs in pair_lists for pair in pairs)
+        return [None] * len(pair_lists)
@@ -1,5 +1,7 @@
-import os
+import threading
+from random import random
 from struct import pack, unpack, calcsize
+from Persistent.Storage import open_storage, open_file
 
 class FixedArray:
     """ FixedArray creates an araray of a fixed size on disk. The array
@@ -42,6 +44,8 @@ class FixedArray:
     {password: password, username: Steve}
     >>> print c[1]
     {password: None, username: John}
+    >>> c.file_object is obj
+    True
     >>> c.close()
 
     >>> import os
@@ -49,7 +53,19 @@ class FixedArray:
 
     """
 
-    def __init__(self, data, file_name=None, file_object=None, allocation=1024, address=None):
+    # The ways the checksums of the elements can be handled, see __init__
+    checksums   = ["read", "sample", "scrub", "off"]
+
+    # With the "sample" policy, about this fraction of the reads are checked
+    sample_rate = 1 / 16.0
+
+    # scrub() and items() read the elements in chunks of about this many
+    # bytes
+    chunk_size  = 1024 * 1024
+
+    def __init__(self, data, file_name=None, file_object=None, allocation=1024,
+            address=None, storage=None, mmap=False, sparse=False, cache=None,
+            lazy=False, checksum="read", size=None, readonly=False):
         """ Initializes a new fixed array.
 
         Data is the Data class for the elements of this array.
@@ -76,44 +92,98 @@ class FixedArray:
         then the allocation argument is ignored (because it implies that the
         array has already been allocated),
 
+        The size of an array that has already been allocated is read from
+        the start of it. Containers that already know the size, in bytes,
+        can pass it in, so that opening the array doesn't read anything.
+
+        The storage is what we read from and write to. Containers that hold
+        many fixed arrays, such as Array, pass in their own storage so that
+        all of them share it. If no storage is given, one is opened on top of
+        the file object. If mmap is True, that storage memory maps the file.
+        If a PageCache is given as the cache, reads and writes go through it.
+
+        By default, elements that haven't been set are all 0xFF bytes, so
+        allocating the array means writing 0xFF over all of its space. If
+        sparse is True, empty elements are all zero bytes instead, which
+        lets us allocate the array without writing anything but its last
+        byte. The file system leaves a hole for the rest. Since nothing on
+        disk says which of the two an array uses, the same sparse value has
+        to be passed in every time the array is opened.
+
+        If lazy is True, the data objects we return are lazy. They only
+        decode their properties as they're used, and don't check their
+        checksums unless they're verified. See Data.__init__.
+
+        Checksum says what's done with the checksums of the elements:
+
+            "read"   - Every element is checked when it's read. This is the
+                       default.
+            "sample" - A random sample of the reads are checked, about one
+                       in every 1 / sample_rate of them.
+            "scrub"  - Elements are only checked by scrub().
+            "off"    - Elements are written without a checksum, which saves
+                       4 bytes per element.
+
+        The checksums are written either way, unless the policy is "off". So
+        "off" has to be passed in every time the array is opened, and the
+        other policies can be switched between. Elements without a checksum
+        that are all None would look like empty elements in a sparse array,
+        so sparse arrays always have checksums.
+
+        If readonly is True, the array is opened for reading only, with the
+        file memory mapped shared and read only. See
+        DynamicCollection.__init__.
+
         """
+        if checksum not in self.checksums:
+            raise Exception("Unknown checksum: %s" % checksum)
+        if checksum == "off" and sparse:
+            raise Exception("Sparse arrays need checksums")
         if file_name != None:
-            if not os.path.exists(file_name):
-                # Create the file if it doesn't exist
-                open(file_name, 'w').close()
-            elif address == None:
-                # If the file exists already and no address is supplied
-                address = 0
-            file_object = open(file_name, 'r+b')
+            file_object, address = open_file(file_name, address, readonly)
+        if readonly and address == None:
+            raise Exception("Read only collections have to exist already")
+        if storage == None:
+            storage = open_storage(file_object, mmap, cache,
+                readonly=readonly)
         # When the Data object is first initialized, it sets up certain
         # things in the class. We force the initialization here.
         data()
-        self.file_object = file_object
+        self.storage     = storage
+        # The file the array is kept in, which the storage reads and writes
+        self.file_object = storage.file_object
         self.data        = data
+        self.checksum    = checksum
+        self.record_size = data._size
+        if checksum == "off":
+            self.record_size -= data._crc_size
         self.allocation  = allocation
-        self.size        = allocation * data._size
+        self.size        = allocation * self.record_size
         self.address     = address
         self.long_sz     = calcsize("q")
+        self.sparse      = sparse
+        self.empty_byte  = chr(0) if sparse else chr(255)
+        self.empty_cell  = self.empty_byte * self.record_size
+        self.lazy        = lazy
+        # Held by writers that have to read before they write, such as
+        # FixedSet, so that two of them never claim the same empty cell
+        self.lock        = threading.RLock()
 
         # We allocate space at the end of the file if there is no address
         if self.address == None:
-            # Seek to the end of the file and record the address
-            self.file_object.seek(0, 2)
-            self.address = self.file_object.tell()
-
-            # Write how big this array is
-            self.file_object.write(pack("q", self.size))
+            # Write how big this array is at the end of the file, and record
+            # the address it was written to
+            self.address = self.storage.append(pack("q", self.size))
 
             # Allocate the space for the elements
             self._allocate_space(self.size)
         else:
-            # Seek to the start of the array
-            self.file_object.seek(self.address)
-
             # Set the size and allocation of the array
-            self.size       = unpack("q", self.file_object.read(self.long_sz))[0]
-            self.allocation = self.size / self.data._size
-
+            if size == None:
+                size = unpack("q",
+                    self.storage.read(self.address, self.long_sz))[0]
+            self.size       = size
+            self.allocation = self.size / self.record_size
 
     def _allocate_space(self, size):
         """ Allocates space for the array elements.
@@ -131,21 +201,19 @@ class FixedArray:
         >>> obj.tell()
         90008
 
-        """
-        # We write half a megabyte at a time
-        block_size = 512 * 1024
-
-        # We create a block of data filled with invalid addresses
-        zeroed_block  = chr(255) * block_size
-
-        # Write the blocks to disk
-        for i in xrange(size / block_size):
-            self.file_object.write(zeroed_block)
+        >>> obj = StringIO()
+        >>> a = FixedArray(Integer, file_object=obj, allocation=10000,
+        ...   sparse=True)
+        >>> obj.seek(0,2)
+        >>> obj.tell()
+        90008
+        >>> print a[9999]
+        None
 
-        # The last block won't likely be a full block, so we create a
-        # special block for the last one.
-        zeroed_block = chr(255) * (size % block_size)
-        self.file_object.write(zeroed_block)
+        """
+        # We fill the space with the empty byte, which marks the elements as
+        # not being set
+        self.storage.allocate(size, self.empty_byte)
 
     def __setitem__(self, index, data):
         """ Sets a value in the array.
@@ -162,30 +230,192 @@ class FixedArray:
 
         Index is the index of the element you want to retrieve.
 
-        If all the bytes are chr(255), then that implies that no data object
-        has been stored there (No valid data object will consist of all 0xFF
-        bytes). In that case, we return None instead of a data object.
+        If all the bytes are the empty byte (chr(255), or chr(0) for sparse
+        arrays), then that implies that no data object has been stored there.
+        No valid data object consists of all 0xFF bytes, and the checksum
+        keeps a valid data object from being all zero bytes. In that case,
+        we return None instead of a data object.
 
         """
 
         # Find the address of the index
         address = self._get_address(index)
-        self.file_object.seek(address)
 
         # Read in the bytes for the data object
-        bytes = self.file_object.read(self.data._size)
+        bytes = self.storage.read(address, self.record_size)
+        return self._load(bytes, index)
+
+    def _load(self, bytes, index, result="data"):
+        """ Deserializes the bytes of the element at the given index, or
+        returns None if the bytes are empty. If the index is None, the data
+        object isn't told its index.
+
+        Result says what to deserialize the bytes into. By default that's a
+        data object, but it can also be a "tuple" or a "namedtuple" of the
+        values, see Data.to_tuple.
+
+        """
+        # If all the bytes are empty, then there is no data object
+        if bytes == self.empty_cell:
+            return None
+        verify = self._should_verify()
+        if result == "tuple":
+            return self.data.to_tuple(bytes, False, verify)
+        if result == "namedtuple":
+            return self.data.to_tuple(bytes, True, verify)
 
-        # If all the bytes are chr(0), then there is no data object
-        if bytes[0] == chr(255) and len(set(bytes)) == 1:
-            data = None
         # Otherwise, we deserialize the bytes
-        else:
-            data = self.data(self, bytes)
+        data = self.data(self, bytes, _lazy=self.lazy, _verify=verify)
 
         # Set the data object's index attribute (which can be used by commit())
-        data.fixed_array_index_ = index
+        if index != None:
+            data.fixed_array_index_ = index
         return data
 
+    def _should_verify(self):
+        """ Returns True if the element that's being read should have its
+        checksum checked, according to the checksum policy.
+
+        """
+        if self.checksum == "read":
+            return True
+        if self.checksum == "sample":
+            return random() < self.sample_rate
+        return False
+
+    def _unload(self, data):
+        """ Returns the bytes that the data object is written to the array
+        as, which only end with a checksum if the array keeps them.
+
+        """
+        return data.unload(self.checksum != "off")
+
+    def scrub(self):
+        """ Checks the checksum of every element in the array, and returns
+        a list of the indexes of the elements that don't match.
+
+        Rather than reading the elements one at a time, they're read in
+        large sequential chunks, see _read_elements(). This is how arrays
+        with the "scrub" policy find corrupt elements, away from the reads
+        that something is waiting on.
+
+        >>> from cStringIO import StringIO
+        >>> from Persistent import Data, IntegerProperty
+        >>> class Integer(Data):
+        ...   value = IntegerProperty()
+        ...
+        >>> a = FixedArray(Integer, file_object=StringIO(), checksum="scrub")
+        >>> a.set_range(0, [Integer(value=i) for i in xrange(1000)])
+        >>> a.scrub()
+        []
+        >>> a.storage.write(a._get_address(700) + 1, "?")
+        >>> a[700].value
+        575
+        >>> a.scrub()
+        [700]
+        >>> a.checksum = "read"
+        >>> a[700]
+        Traceback (most recent call last):
+        Exception: Checksums don't match. Looks like corrupt data
+
+        """
+        if self.checksum == "off":
+            raise Exception("The array has no checksums to check")
+        return [index for index, bytes in self._read_elements()
+            if not self.data.is_intact(bytes)]
+
+    def items(self, result="data"):
+        """ Yields the index and value of every element that has been set, in
+        order of index. The values are data objects, unless result is
+        "tuple" or "namedtuple", see _load().
+
+        >>> from cStringIO import StringIO
+        >>> from Persistent import Data, IntegerProperty
+        >>> class Integer(Data):
+        ...   value = IntegerProperty()
+        ...
+        >>> a = FixedArray(Integer, file_object=StringIO())
+        >>> a[900] = Integer(value=1)
+        >>> a.set_range(3, [Integer(value=i) for i in xrange(3)])
+        >>> list(a.items("tuple"))
+        [(3, (0,)), (4, (1,)), (5, (2,)), (900, (1,))]
+
+        """
+        for index, bytes in self._read_elements():
+            yield index, self._load(bytes, index, result)
+
+    def _read_elements(self):
+        """ Yields the index and bytes of every element that isn't empty.
+
+        The elements are read in sequential chunks of about chunk_size
+        bytes, rather than one at a time, and empty elements are skipped
+        without being deserialized. Only one chunk is held at a time.
+
+        """
+        size  = self.record_size
+        chunk = max(1, self.chunk_size / size)
+        empty = self.empty_cell
+        # Sets find the address of their elements by hashing them, so we
+        # work out the address of each chunk ourselves
+        first = self.address + self.long_sz
+        for start in xrange(0, self.allocation, chunk):
+            stop  = min(start + chunk, self.allocation)
+            bytes = self.storage.read(first + start * size,
+                (stop - start) * size)
+            # Chunks that haven't been written to are common, and we can
+            # skip all of their elements at once
+            if bytes.count(self.empty_byte) == len(bytes):
+                continue
+            for i in xrange(stop - start):
+                element = bytes[i * size : (i + 1) * size]
+                if element != empty:
+                    yield start + i, element
+
+    def get_range(self, start, stop, result="data"):
+        """ Gets the values from index start up to, but not including, index
+        stop. All of the elements are read from disk in a single read.
+
+        The values are data objects, unless result is "tuple" or
+        "namedtuple", see _load().
+
+        >>> from cStringIO import StringIO
+        >>> from Persistent import Data, IntegerProperty
+        >>> class Integer(Data):
+        ...   value = IntegerProperty()
+        ...
+        >>> a = FixedArray(Integer, file_object=StringIO())
+        >>> a.set_range(3, [Integer(value=i) for i in xrange(3)])
+        >>> [i and i.value for i in a.get_range(2, 7)]
+        [None, 0, 1, 2, None]
+        >>> a.get_range(4, 6, "tuple")
+        [(1,), (2,)]
+        >>> a.get_range(1020, 1025)
+        Traceback (most recent call last):
+        Exception: Index is out of bounds
+
+        """
+        if start >= stop:
+            return []
+        size    = self.record_size
+        address = self._get_address(start)
+        self._get_address(stop - 1)
+        bytes   = self.storage.read(address, (stop - start) * size)
+        return [self._load(bytes[i * size : (i + 1) * size], start + i,
+            result) for i in xrange(stop - start)]
+
+    def set_range(self, start, datas):
+        """ Sets consecutive values of the array, starting at index start, to
+        the given data objects. All of the elements are written to disk in a
+        single write.
+
+        """
+        if not datas:
+            return
+        address = self._get_address(start)
+        self._get_address(start + len(datas) - 1)
+        self.storage.write(address, "".join(self._unload(data)
+            for data in datas))
+
     def commit(self, data, index=None):
         """ Writes a data object to the array.
 
@@ -219,8 +449,7 @@ class FixedArray:
             else:
                 raise Exception("Data has no associated index")
         address = self._get_address(index)
-        self.file_object.seek(address)
-        self.file_object.write(data.unload())
+        self.storage.write(address, self._unload(data))
 
     def _get_address(self, index):
         """ Given an index, will return the address of the element in the
@@ -251,9 +480,23 @@ class FixedArray:
         # the array
         if index >= self.allocation:
             raise Exception("Index is out of bounds")
-        return self.address + self.long_sz + (index * self.data._size)
+        return self.address + self.long_sz + (index * self.record_size)
+
+    def refresh(self):
+        """ Fixed arrays don't hold on to anything they read, so there's
+        nothing to forget. See DynamicCollection.refresh.
+
+        """
+        pass
+
+    def flush(self):
+        """ Makes sure that everything written to the array has been handed
+        to the operating system.
+
+        """
+        self.storage.flush()
 
     def close(self):
-        """ Closes the array's file object. """
+        """ Closes the array's storage. """
 
-        self.file_object.close()
+        self.storage.close()
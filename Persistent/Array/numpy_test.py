@@ -0,0 +1,88 @@
+""" Tests for Array.get_dtype, Array.to_numpy and Array.from_numpy. They need
+numpy, which Persistent itself doesn't, so test_runner only runs them when
+numpy can be imported.
+
+Elements go both ways between data objects and numpy arrays, in every kind
+of array whose bytes look different on disk.
+
+>>> import os
+>>> import numpy
+>>> from Persistent import Data, IntegerProperty, StringProperty
+>>> from Persistent.Array import Array
+>>> class User(Data):
+...   id   = IntegerProperty()
+...   name = StringProperty(length=5)
+...
+>>> fields = ["id_set", "id", "name_set", "name_length", "name"]
+>>> def round_trip(**options):
+...   a = Array(User, "numpy_doctest.db", **options)
+...   values = numpy.zeros(3000, a.get_dtype())
+...   values["id_set"]          = 1
+...   values["id"]              = numpy.arange(3000)
+...   values["name_set"][::2]    = 1
+...   values["name_length"][::2] = 2
+...   values["name"][::2]        = "ab"
+...   a.from_numpy(values, 10)
+...   a[3010] = User(id=-1, name="Steve")
+...   a.close()
+...
+...   # The elements come back the same, whether they're read as data
+...   # objects, which checks their checksums, or as a numpy array
+...   a     = Array(User, "numpy_doctest.db", **options)
+...   users = a[10:3011]
+...   print [(u.id, u.name) for u in users[:2] + users[-2:]]
+...   print a[9] == None, a.to_numpy(0, 10)["id_set"][0]
+...   back  = a.to_numpy(10, 3011)
+...   print (back[:3000][fields] == values[fields]).all(), back[-1]["name"]
+...   print a.get_dtype().itemsize == User._size, \\
+...     len(a.to_numpy(5, 5)), len(a.to_numpy()) >= 3011
+...   a.close()
+...   os.remove("numpy_doctest.db")
+...
+>>> round_trip()
+[(0, 'ab'), (1, None), (2999, None), (-1, 'Steve')]
+True 255
+True Steve
+True 0 True
+
+>>> round_trip(mmap=True)
+[(0, 'ab'), (1, None), (2999, None), (-1, 'Steve')]
+True 255
+True Steve
+True 0 True
+
+>>> # Without checksums, the elements don't end with a checksum field
+>>> round_trip(checksum="off")
+[(0, 'ab'), (1, None), (2999, None), (-1, 'Steve')]
+True 255
+True Steve
+False 0 True
+
+>>> # Elements that were never set are zero bytes in sparse arrays, rather
+>>> # than 0xFF bytes
+>>> round_trip(sparse=True)
+[(0, 'ab'), (1, None), (2999, None), (-1, 'Steve')]
+True 0
+True Steve
+True 0 True
+
+>>> # Views of memory mapped arrays write straight to the file
+>>> a    = Array(User, "numpy_doctest.db", mmap=True)
+>>> a[3] = User(id=3, name="x")
+>>> view = a.to_numpy(0, 10, copy=False)
+>>> view["id"][3] = 30
+>>> a.to_numpy(3, 4)["id"].tolist()
+[30]
+>>> a.get_dtype().names == tuple(fields + ["checksum_"])
+True
+>>> a.close()
+
+>>> a = Array(User, "numpy_doctest.db")
+>>> a.from_numpy(numpy.zeros(3, numpy.dtype([("id", "i4")])))
+Traceback (most recent call last):
+...
+Exception: The numpy array's dtype doesn't match the array
+>>> a.close()
+>>> os.remove("numpy_doctest.db")
+
+"""
@@ -0,0 +1 @@
+from Persistent.Btree.btree import Btree
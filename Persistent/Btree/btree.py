@@ -0,0 +1,771 @@
+import threading
+from struct import pack, unpack, calcsize
+from Persistent.Data     import Data
+from Persistent.Storage  import open_storage, open_file
+
+class Btree:
+    """ Btree keeps data objects in the order of their keys, so that they can
+    be read back a range of keys at a time. Hashmaps are faster for looking
+    up a single key, but they can't answer "the next 50 keys after this
+    one" without reading everything.
+
+    It's a B+tree made of fixed size pages, which are allocated in the same
+    file as everything else. The data objects are kept in the leaves, which
+    are linked together in the order of their keys, and the pages above
+    them hold the first key of each of their children. Keys are compared by
+    their bytes, so they're unloaded with Data.unload_ordered_key, whose
+    bytes sort in the same order as the keys do.
+
+    >>> from cStringIO import StringIO
+    >>> from Persistent import Data, IntegerProperty, StringProperty
+    >>> class Post(Data):
+    ...   id    = IntegerProperty(key=True)
+    ...   title = StringProperty(length=20)
+    ...
+    >>> obj = StringIO()
+    >>> t = Btree(Post, file_object=obj, page_size=256)
+    >>> for i in xrange(1000, 0, -1):
+    ...   t.set(Post(id=i * 3, title="Post %d" % i))
+    >>> len(t), t.height
+    (1000, 4)
+    >>> t.get(Post(id=30)).title, t.get(Post(id=31))
+    ('Post 10', None)
+
+    >>> # Pages of posts start after the last id of the page before them
+    >>> [post.id for post in t.range(lo=Post(id=-5), hi=Post(id=15))]
+    [3, 6, 9, 12]
+    >>> [post.id for post in t.range(lo=2990)]
+    [2991, 2994, 2997, 3000]
+    >>> list(t.range(20, 30, result="tuple"))
+    [(21, 'Post 7'), (24, 'Post 8'), (27, 'Post 9')]
+
+    >>> t.delete(Post(id=6)), t.delete(Post(id=6))
+    (True, False)
+    >>> t.flush()
+    >>> t = Btree(Post, file_object=obj, address=0)
+    >>> len(t), [post.id for post in t.range(hi=13)]
+    (999, [3, 9, 12])
+
+    Reads never block each other, or writers. Writers wait for each other.
+    A page that splits is written last, after the page that takes half of
+    its keys and the pages that point to it. Keys only ever move to the
+    right, so a reader that got to a leaf just before it split, and finds
+    that the key is past its last key, follows the link to the next leaf.
+
+    The header is only written when the root or the first leaf moves. The
+    number of data objects is counted in memory, and written along with the
+    header by flush() and close(), just like the counts of sets.
+
+    """
+
+    # The magic string that the header starts with
+    magic         = "Btree\x00\x00\x01"
+
+    # The header is the magic string, a fingerprint of the Data class, the
+    # size of the pages, the address of the root, the height of the tree,
+    # the number of data objects, and the address of the first leaf
+    header_format = "8sqqqqqq"
+
+    # Each page starts with its kind, the number of keys in it, and the
+    # address of the next leaf, or -1. The keys of leaves are followed by
+    # the bytes of their data object, and the keys of the pages above them
+    # by the address of the child that they're the first key of.
+    page_format   = "=BHq"
+    pointer_format = "q"
+    leaf_kind     = 1
+    node_kind     = 0
+
+    # Bulk loading writes this many pages at a time
+    load_pages    = 256
+
+    def __init__(self, data, file_name=None, file_object=None, address=None,
+            mmap=False, cache=None, durability=None, lazy=False,
+            page_size=4096, storage=None, readonly=False):
+        """ Initializes a new B+tree.
+
+        Data is the class for the elements that will be stored in the tree.
+        It has to have keys, and every key has to be a property that can be
+        ordered, see Property.pack_ordered.
+
+        File_name, file_object, address, mmap, cache, durability, lazy,
+        storage and readonly work the same way as they do for every other
+        collection, see DynamicCollection.__init__.
+
+        Page_size is the size of each page of the tree. Larger pages make for
+        a shorter tree, but every lookup reads a whole page at each level.
+        It's recorded in the header, so it only matters when the tree is
+        first created.
+
+        """
+        # Data objects have certain varibles, such as the size of the object,
+        # initialized the first time the constructor is called. Here we force
+        # these variables to be intiialized.
+        data()
+        if not data._keys:
+            raise Exception("Btrees need a Data class with keys")
+        self.data = data
+        if file_name != None:
+            file_object, address = open_file(file_name, address, readonly)
+        if readonly and address == None:
+            raise Exception("Read only collections have to exist already")
+        if storage == None:
+            storage = open_storage(file_object, mmap, cache, durability,
+                readonly)
+        self.storage   = storage
+        self.address   = address
+        self.lazy      = lazy
+        self.page_size = page_size
+        # Held while the tree is being written to
+        self.lock      = threading.RLock()
+        # Whether the count has changed since the header was written
+        self.dirty     = False
+
+        if self.address == None:
+            self._set_sizes()
+            # The tree starts out as a single empty leaf, which is written
+            # right after the header
+            self.count = 0
+            self.first = -1
+            self.top   = (-1, 1)
+            with self.storage.operation():
+                self.address = self.storage.append(self._get_header() +
+                    self._pack_page(_Page(self.leaf_kind)))
+                self.first = self.address + calcsize(self.header_format)
+                self.top   = (self.first, 1)
+                self._write_header()
+        else:
+            self._load_header()
+
+    @property
+    def root(self):
+        """ The address of the root page. """
+        return self.top[0]
+
+    @property
+    def height(self):
+        """ The number of levels of pages, counting the leaves. """
+        return self.top[1]
+
+    def _set_sizes(self):
+        """ Works out how many keys fit in each kind of page. """
+        self.key_size      = self.data._key_size
+        self.record_size   = self.data._size
+        self.header_size   = calcsize(self.page_format)
+        self.pointer_size  = calcsize(self.pointer_format)
+        space              = self.page_size - self.header_size
+        self.capacities    = {
+            self.leaf_kind : space / (self.key_size + self.record_size),
+            self.node_kind : space / (self.key_size + self.pointer_size)}
+        if min(self.capacities.values()) < 3:
+            raise Exception("Pages of %d bytes are too small for %s" %
+                (self.page_size, self.data.__name__))
+
+    def _get_header(self):
+        """ Returns the bytes of the header. """
+        root, height = self.top
+        return pack(self.header_format, self.magic, self.data._fingerprint,
+            self.page_size, root, height, self.count, self.first)
+
+    def _write_header(self):
+        """ Writes the header, along with the count. """
+        self.storage.write(self.address, self._get_header())
+        self.dirty = False
+
+    def _load_header(self):
+        """ Reads in the header of a tree that already exists. """
+        (magic, fingerprint, self.page_size, root, height, self.count,
+            self.first) = unpack(self.header_format, self.storage.read(
+            self.address, calcsize(self.header_format)))
+        if magic != self.magic:
+            raise Exception("There is no Btree at %d" % self.address)
+        if fingerprint != self.data._fingerprint:
+            raise Exception(
+                "The collection was written with a different Data class")
+        self.top = (root, height)
+        self._set_sizes()
+
+    def refresh(self):
+        """ Reads the header again, to pick up what a writer in another
+        process has done since the tree was opened. Reads find what the
+        writer has added even without this, since the pages are read as
+        they are in the file, but they get slower as the root the tree was
+        opened with splits.
+
+        >>> from Persistent import Data, IntegerProperty
+        >>> class Pair(Data):
+        ...   key   = IntegerProperty(key=True)
+        ...   value = IntegerProperty()
+        ...
+        >>> writer = Btree(Pair, "btree_doctest.db", mmap=True)
+        >>> writer.set(Pair(key=1, value=1))
+        >>> writer.flush()
+        >>> reader = Btree(Pair, "btree_doctest.db", readonly=True)
+        >>> writer.load(Pair(key=i, value=i) for i in xrange(1000))
+        >>> reader.get(Pair(key=999)).value, len(reader), reader.height
+        (999, 1, 1)
+        >>> reader.refresh()
+        >>> len(reader), reader.height
+        (1000, 2)
+        >>> reader.close()
+        >>> writer.close()
+
+        >>> import os
+        >>> os.remove("btree_doctest.db")
+
+        """
+        with self.lock:
+            self._load_header()
+
+    def _get_key(self, key):
+        """ Returns the ordered bytes of the keys of a data object. If the
+        Data class has a single key, its value can be given instead.
+
+        """
+        if isinstance(key, Data):
+            return key.unload_ordered_key()
+        if len(self.data._keys) != 1:
+            raise Exception("%s has more than one key" % self.data.__name__)
+        return self.data(**{self.data._keys[0][0] : key}).unload_ordered_key()
+
+    def _get_entry_size(self, kind):
+        """ Returns the size of a key and what follows it in a page of the
+        given kind.
+
+        """
+        if kind == self.leaf_kind:
+            return self.key_size + self.record_size
+        return self.key_size + self.pointer_size
+
+    def _read_page(self, address):
+        """ Reads the page at the address, and returns its kind, the number
+        of keys in it, the address of the next leaf, and its bytes.
+
+        """
+        bytes = self.storage.read(address, self.page_size)
+        kind, count, next = unpack(self.page_format, bytes[:self.header_size])
+        return kind, count, next, bytes
+
+    def _search(self, bytes, kind, count, key, lo=0):
+        """ Returns the position of the first key in the page's bytes that
+        isn't less than the given key, without unpacking the whole page.
+        Only the keys from position lo on are looked at.
+
+        """
+        entry = self._get_entry_size(kind)
+        start = self.header_size
+        hi    = count
+        while lo < hi:
+            middle = (lo + hi) / 2
+            offset = start + middle * entry
+            if bytes[offset : offset + self.key_size] < key:
+                lo = middle + 1
+            else:
+                hi = middle
+        return lo
+
+    def _get_key_at(self, bytes, kind, position):
+        """ Returns the key at the position in the page's bytes. """
+        offset = self.header_size + position * self._get_entry_size(kind)
+        return bytes[offset : offset + self.key_size]
+
+    def _get_value_at(self, bytes, kind, position):
+        """ Returns the bytes of the data object, or the address of the child,
+        that follow the key at the position in the page's bytes.
+
+        """
+        offset = self.header_size + position * self._get_entry_size(kind) + \
+            self.key_size
+        if kind == self.leaf_kind:
+            return bytes[offset : offset + self.record_size]
+        return unpack(self.pointer_format,
+            bytes[offset : offset + self.pointer_size])[0]
+
+    def _descend(self, key):
+        """ Follows the key from the root down to the leaf it belongs in.
+        Returns the path of (address, bytes, position) for each page above
+        the leaf, where position is the child that was followed, and then
+        the address, number of keys, next leaf and bytes of the leaf.
+
+        """
+        address, height = self.top
+        path = []
+        for level in xrange(height - 1):
+            kind, count, next, bytes = self._read_page(address)
+            # The child to follow is the last one whose first key isn't
+            # greater than the key. The first child takes every key that's
+            # less than the first key of the second, so its own first key is
+            # never looked at. It's out of date once a key less than it has
+            # been added.
+            position = self._search(bytes, kind, count, key, 1)
+            if position == count or \
+                    self._get_key_at(bytes, kind, position) != key:
+                position -= 1
+            path.append((address, bytes, position))
+            address = self._get_value_at(bytes, kind, position)
+        kind, count, next, bytes = self._read_page(address)
+        return path, address, count, next, bytes
+
+    def _parse_page(self, address, bytes):
+        """ Unpacks the bytes of a page into a _Page, so that it can be
+        changed.
+
+        """
+        kind, count, next = unpack(self.page_format, bytes[:self.header_size])
+        page = _Page(kind, next, address)
+        for position in xrange(count):
+            page.keys.append(self._get_key_at(bytes, kind, position))
+            page.values.append(self._get_value_at(bytes, kind, position))
+        return page
+
+    def _pack_page(self, page):
+        """ Returns the bytes of a _Page, padded out to the page size. """
+        if page.kind == self.leaf_kind:
+            entries = [key + value
+                for key, value in zip(page.keys, page.values)]
+        else:
+            entries = [key + pack(self.pointer_format, value)
+                for key, value in zip(page.keys, page.values)]
+        bytes = pack(self.page_format, page.kind, len(page.keys),
+            page.next) + "".join(entries)
+        return bytes + chr(0) * (self.page_size - len(bytes))
+
+    def _append_page(self, page):
+        """ Writes a new page at the end of the file and returns its
+        address.
+
+        """
+        page.address = self.storage.append(self._pack_page(page))
+        return page.address
+
+    def _write_page(self, page):
+        """ Writes a page back to where it came from. """
+        self.storage.write(page.address, self._pack_page(page))
+
+    def set(self, data):
+        """ Adds a data object to the tree, replacing the one with the same
+        keys if there is one.
+
+        A leaf with too many keys is split in half, and its parent gets the
+        first key of the new page, which can split the parent in turn. Data
+        objects are often added in the order of their keys, so a split of
+        the last leaf, when the key went at its very end, leaves the new
+        page with just that key instead. Pages then end up full rather than
+        half full.
+
+        >>> from cStringIO import StringIO
+        >>> from Persistent import Data, IntegerProperty
+        >>> class Pair(Data):
+        ...   key   = IntegerProperty(key=True)
+        ...   value = IntegerProperty()
+        ...
+        >>> import random
+        >>> random.seed(5)
+        >>> t = Btree(Pair, file_object=StringIO(), page_size=128)
+        >>> expected = {}
+        >>> for i in xrange(3000):
+        ...   key = random.randint(-2000, 2000)
+        ...   expected[key] = i
+        ...   t.set(Pair(key=key, value=i))
+        >>> len(t) == len(expected), t.height
+        (True, 5)
+        >>> [(p.key, p.value) for p in t] == sorted(expected.items())
+        True
+
+        >>> # Six pairs fit in a leaf, so adding them in order makes 500 full
+        >>> # leaves, and 64 pages above them
+        >>> t = Btree(Pair, file_object=StringIO(), page_size=128)
+        >>> for i in xrange(3000):
+        ...   t.set(Pair(key=i, value=i))
+        >>> t.height, t.storage.end() / 128
+        (4, 564)
+
+        """
+        key    = data.unload_ordered_key()
+        record = data.unload()
+        with self.storage.operation(), self.lock:
+            path, address, count, next, bytes = self._descend(key)
+            kind     = self.leaf_kind
+            position = self._search(bytes, kind, count, key)
+            offset   = self.header_size + position * self._get_entry_size(kind)
+            if position < count and \
+                    self._get_key_at(bytes, kind, position) == key:
+                self.storage.write(address + offset + self.key_size, record)
+                return
+
+            # Most of the time the key fits in the leaf, and it's spliced
+            # into the bytes of the leaf without unpacking them
+            self.count += 1
+            self.dirty  = True
+            if count < self.capacities[kind]:
+                end = self.header_size + count * self._get_entry_size(kind)
+                self.storage.write(address, pack(self.page_format, kind,
+                    count + 1, next) + bytes[self.header_size : offset] +
+                    key + record + bytes[offset : end])
+                return
+
+            page = self._parse_page(address, bytes)
+            page.keys.insert(position, key)
+            page.values.insert(position, record)
+            appending = position == count and page.next == -1
+
+            # New pages are written as they're made, while the pages that
+            # already existed are written afterwards, from the top down
+            changed = [page]
+            root, height = self.top
+            while len(page.keys) > self.capacities[page.kind]:
+                right = page.split(appending)
+                self._append_page(right)
+                if page.kind == self.leaf_kind:
+                    page.next = right.address
+                if not path:
+                    root = self._append_page(_Page(self.node_kind,
+                        keys=[page.keys[0], right.keys[0]],
+                        values=[page.address, right.address]))
+                    height += 1
+                    break
+                address, bytes, position = path.pop()
+                parent = self._parse_page(address, bytes)
+                parent.keys.insert(position + 1, right.keys[0])
+                parent.values.insert(position + 1, right.address)
+                changed.append(parent)
+                page = parent
+
+            if (root, height) != self.top:
+                self.top = (root, height)
+                self._write_header()
+            for page in reversed(changed):
+                self._write_page(page)
+
+    def commit(self, data):
+        """ Writes a data object that came from the tree back to it. See
+        Data.commit.
+
+        """
+        self.set(data)
+
+    def get(self, data, default=None):
+        """ Retrieve a data object from the tree. If the data isn't found,
+        default is returned.
+
+        """
+        key = self._get_key(data)
+        path, address, count, next, bytes = self._descend(key)
+        position = self._search(bytes, self.leaf_kind, count, key)
+        while position == count and next != -1:
+            kind, count, next, bytes = self._read_page(next)
+            position = self._search(bytes, kind, count, key)
+        if position < count and \
+                self._get_key_at(bytes, self.leaf_kind, position) == key:
+            return self._load(
+                self._get_value_at(bytes, self.leaf_kind, position))
+        return default
+
+    def delete(self, data):
+        """ Removes the data object with the same keys as the given one from
+        the tree, and returns True if there was one.
+
+        Pages aren't merged or freed when keys are removed from them, they
+        just have fewer keys until new ones are added, so deleting never
+        gives space back. Merging would move keys to the left, which readers
+        that don't take the lock can't follow. Leaves that are left empty
+        stay linked, and range() goes straight past them. To get the space
+        back, load() what's left into a new tree.
+
+        >>> from cStringIO import StringIO
+        >>> from Persistent import Data, IntegerProperty
+        >>> class Pair(Data):
+        ...   key   = IntegerProperty(key=True)
+        ...   value = IntegerProperty()
+        ...
+        >>> t = Btree(Pair, file_object=StringIO(), page_size=128)
+        >>> t.load(Pair(key=i, value=i) for i in xrange(1000))
+        >>> end = t.storage.end()
+        >>> len([i for i in xrange(10, 1000) if t.delete(Pair(key=i))])
+        990
+        >>> len(t), [p.key for p in t.range(8)], t.storage.end() == end
+        (10, [8, 9], True)
+
+        """
+        key = self._get_key(data)
+        with self.storage.operation(), self.lock:
+            path, address, count, next, bytes = self._descend(key)
+            kind     = self.leaf_kind
+            position = self._search(bytes, kind, count, key)
+            if position == count or \
+                    self._get_key_at(bytes, kind, position) != key:
+                return False
+            entry  = self._get_entry_size(kind)
+            offset = self.header_size + position * entry
+            end    = self.header_size + count * entry
+            self.count -= 1
+            self.dirty  = True
+            self.storage.write(address, pack(self.page_format, kind,
+                count - 1, next) + bytes[self.header_size : offset] +
+                bytes[offset + entry : end] + chr(0) * entry)
+            return True
+
+    def range(self, lo=None, hi=None, result="data"):
+        """ Iterates over the data objects with keys from lo up to, but not
+        including, hi, in the order of their keys. Lo and hi are data
+        objects with their keys set, or the value of the key if there's
+        only one. Without lo, it starts at the first key, and without hi
+        it goes on to the last.
+
+        Result works the same way it does for Hashset.values.
+
+        The data objects are read a leaf at a time, so paging through the
+        keys is a lookup for where to start, followed by a read of just the
+        leaves with the keys on the page.
+
+        >>> from cStringIO import StringIO
+        >>> from itertools import islice
+        >>> from Persistent import Data, StringProperty
+        >>> class Name(Data):
+        ...   last  = StringProperty(length=10, key=True)
+        ...   first = StringProperty(length=10, key=True)
+        ...
+        >>> t = Btree(Name, file_object=StringIO())
+        >>> for last, first in [("Smith", "Al"), ("Jones", "Zed"),
+        ...     ("Smith", "Adam"), ("Smith", "B"), ("Jones", "Ann")]:
+        ...   t.set(Name(last=last, first=first))
+        >>> names = t.range(lo=Name(first="Al"), result="tuple")
+        >>> list(islice(names, 3))
+        [('Al', 'Smith'), ('Ann', 'Jones'), ('B', 'Smith')]
+
+        """
+        if result not in ("data", "tuple", "namedtuple"):
+            raise Exception("Unknown result: %s" % result)
+        hi_key = None
+        if hi != None:
+            hi_key = self._get_key(hi)
+        if lo == None:
+            address, position = self.first, 0
+        else:
+            lo_key = self._get_key(lo)
+            path, address, count, next, bytes = self._descend(lo_key)
+            position = self._search(bytes, self.leaf_kind, count, lo_key)
+
+        while address != -1:
+            kind, count, next, bytes = self._read_page(address)
+            for position in xrange(position, count):
+                if hi_key != None and \
+                        self._get_key_at(bytes, kind, position) >= hi_key:
+                    return
+                yield self._load(self._get_value_at(bytes, kind, position),
+                    result)
+            address, position = next, 0
+
+    def load(self, datas):
+        """ Adds many data objects, given in the order of their keys, to a
+        tree that's empty. This is much faster than calling set() for each
+        of them. The leaves are written out full, in large sequential
+        writes, and then each level of pages above them is built from the
+        first keys of the level below. If a key is given more than once,
+        the last data object with it is kept.
+
+        If the tree isn't empty, the data objects are added with set()
+        instead.
+
+        >>> from cStringIO import StringIO
+        >>> from Persistent import Data, IntegerProperty
+        >>> class Pair(Data):
+        ...   key   = IntegerProperty(key=True)
+        ...   value = IntegerProperty()
+        ...
+        >>> obj = StringIO()
+        >>> t = Btree(Pair, file_object=obj, page_size=128)
+        >>> t.load(Pair(key=i, value=-i) for i in xrange(-50, 5000))
+        >>> t = Btree(Pair, file_object=obj, address=0)
+        >>> len(t), t.height, t.get(Pair(key=-7)).value
+        (5050, 5, 7)
+        >>> [p.key for p in t.range(4997)], [p.key for p in t.range(hi=-48)]
+        ([4997, 4998, 4999], [-50, -49])
+        >>> t.set(Pair(key=10000, value=0))
+        >>> t.load([Pair(key=1, value=1), Pair(key=5001, value=1)])
+        >>> len(t), t.get(Pair(key=1)).value
+        (5052, 1)
+
+        >>> t = Btree(Pair, file_object=StringIO())
+        >>> t.load([Pair(key=2), Pair(key=1)])
+        Traceback (most recent call last):
+        ...
+        Exception: Data objects have to be loaded in the order of their keys
+
+        """
+        with self.storage.operation(), self.lock:
+            if self.count > 0:
+                for data in datas:
+                    self.set(data)
+                self._write_count()
+                return
+
+            writer  = _PageWriter(self)
+            leaf    = _Page(self.leaf_kind)
+            capacity = self.capacities[self.leaf_kind]
+            count   = 0
+            for data in datas:
+                key = data.unload_ordered_key()
+                if leaf.keys and key <= leaf.keys[-1]:
+                    if key != leaf.keys[-1]:
+                        raise Exception("Data objects have to be loaded in "
+                            "the order of their keys")
+                    leaf.values[-1] = data.unload()
+                    continue
+                if len(leaf.keys) == capacity:
+                    writer.add(leaf)
+                    leaf = _Page(self.leaf_kind)
+                leaf.keys.append(key)
+                leaf.values.append(data.unload())
+                count += 1
+            if count == 0:
+                return
+            writer.add(leaf)
+            level = writer.finish()
+            first = level[0][1]
+
+            # Each level above holds the first keys of the one below it,
+            # until there's a level with a single page
+            height   = 1
+            capacity = self.capacities[self.node_kind]
+            while len(level) > 1:
+                writer = _PageWriter(self)
+                for start in xrange(0, len(level), capacity):
+                    entries = level[start : start + capacity]
+                    writer.add(_Page(self.node_kind,
+                        keys=[key for key, address in entries],
+                        values=[address for key, address in entries]))
+                level   = writer.finish()
+                height += 1
+
+            self.count = count
+            self.first = first
+            self.top   = (level[0][1], height)
+            self._write_header()
+
+    def _load(self, bytes, result="data"):
+        """ Deserializes the bytes of a data object from a leaf. See
+        FixedArray._load.
+
+        """
+        if result == "tuple":
+            return self.data.to_tuple(bytes)
+        if result == "namedtuple":
+            return self.data.to_tuple(bytes, True)
+        return self.data(self, bytes, _lazy=self.lazy)
+
+    def __iter__(self):
+        """ Iterates over every data object, in the order of their keys. """
+        return self.range()
+
+    def __contains__(self, data):
+        """ Returns True if there's a data object with the same keys. """
+        return self.get(data) != None
+
+    def __len__(self):
+        """ Returns the number of data objects in the tree. """
+        return self.count
+
+    def _write_count(self):
+        """ Writes the header if the count has changed since it was last
+        written.
+
+        """
+        with self.lock:
+            if self.dirty:
+                self._write_header()
+
+    def flush(self):
+        """ Writes the count, and makes sure that everything written to
+        this tree has been handed to the operating system.
+
+        """
+        self._write_count()
+        self.storage.flush()
+
+    def close(self):
+        """ Writes the count, and closes the associated storage for this
+        tree.
+
+        """
+        self._write_count()
+        self.storage.close()
+
+
+class _Page:
+    """ A page of the tree that has been unpacked, so that keys can be added
+    to it and removed from it. Values are the bytes of the data objects in
+    leaves, and the addresses of the children everywhere else.
+
+    """
+
+    def __init__(self, kind, next=-1, address=None, keys=None, values=None):
+        self.kind    = kind
+        self.next    = next
+        self.address = address
+        self.keys    = keys if keys != None else []
+        self.values  = values if values != None else []
+
+    def split(self, appending=False):
+        """ Moves the second half of the keys to a new page, and returns it.
+        If appending, only the last key is moved.
+
+        """
+        middle = len(self.keys) - 1 if appending else len(self.keys) / 2
+        right  = _Page(self.kind, self.next, keys=self.keys[middle:],
+            values=self.values[middle:])
+        del self.keys[middle:]
+        del self.values[middle:]
+        return right
+
+
+class _PageWriter:
+    """ Writes new pages of one level of a tree, many of them at a time, and
+    links the leaves together. Used for bulk loading, see Btree.load.
+
+    """
+
+    def __init__(self, tree):
+        self.tree     = tree
+        self.pages    = []
+        self.level    = []
+        # The address of the last page written, whose next leaf isn't known
+        # until the pages after it are written
+        self.previous = None
+
+    def add(self, page):
+        """ Adds a page to the level, writing out the pages so far once
+        there are enough of them.
+
+        """
+        self.pages.append(page)
+        if len(self.pages) == self.tree.load_pages:
+            self._write()
+
+    def _write(self):
+        """ Writes out the pages added since the last write. """
+        tree    = self.tree
+        storage = tree.storage
+        start   = storage.allocate(tree.page_size * len(self.pages), chr(0))
+        for number, page in enumerate(self.pages):
+            page.address = start + number * tree.page_size
+            if page.kind == tree.leaf_kind and number + 1 < len(self.pages):
+                page.next = page.address + tree.page_size
+        storage.write(start, "".join(tree._pack_page(page)
+            for page in self.pages))
+
+        # The last leaf written before these points to the first of them
+        if self.previous != None and self.pages[0].kind == tree.leaf_kind:
+            storage.write(self.previous + calcsize(tree.page_format) -
+                tree.pointer_size, pack(tree.pointer_format, start))
+        self.previous = self.pages[-1].address
+        self.level.extend((page.keys[0], page.address) for page in self.pages)
+        self.pages = []
+
+    def finish(self):
+        """ Writes out the rest of the pages, and returns a list of the first
+        key and address of every page in the level.
+
+        """
+        if self.pages:
+            self._write()
+        return self.level
@@ -0,0 +1,147 @@
+from inspect import getmro
+from struct import Struct, calcsize
+from Persistent.Property import Property
+
+class Codec:
+    """ Codec packs and unpacks a list of properties with a single struct.
+
+    Each property packs to a byte that says whether its value is set,
+    followed by its format. Rather than packing every property on its own
+    and joining the bytes, we join the formats of all of the properties into
+    a single struct when the Data class is first used. Packing and unpacking
+    a whole object is then a single call.
+
+    The bytes are exactly the same as the ones the properties' own pack()
+    methods make. Properties that override pack() or unpack() without also
+    overriding encode() and decode() can't be packed this way, and neither
+    can properties whose format would be laid out differently inside a
+    larger struct. get_codec() returns None for lists of properties with any
+    of those in them, and the Data class falls back to the properties' own
+    methods.
+
+    To keep the work per object to a minimum, the codec writes the source
+    of a pack() and an unpack() function for its properties, and compiles
+    them, the same way collections.namedtuple builds its classes. Simple
+    properties, whose format packs a single value, are read straight out of
+    the object and into the struct, without calling any of their methods.
+
+    >>> from Persistent import IntegerProperty, StringProperty
+    >>> props = [("id", IntegerProperty()), ("name", StringProperty(8))]
+    >>> codec = get_codec(props)
+    >>> class Thing:
+    ...   pass
+    ...
+    >>> thing = Thing()
+    >>> thing.id, thing.name = 5, "Steve"
+    >>> bytes = codec.pack(thing)
+    >>> bytes == "".join(p.pack(getattr(thing, n)) for n, p in props)
+    True
+    >>> thing.id = None
+    >>> codec.pack(thing)[:5] == props[0][1].pack(None)
+    True
+    >>> other = Thing()
+    >>> codec.unpack(other, bytes)
+    >>> other.id, other.name
+    (5, 'Steve')
+    >>> codec.unpack_tuple(bytes)
+    (5, 'Steve')
+
+    >>> class Custom(Property):
+    ...   def pack(self, value, file_object=None):
+    ...     return Property.pack(self, value)
+    ...
+    >>> get_codec([("id", Custom('i'))]) == None
+    True
+
+    """
+
+    def __init__(self, props):
+        """ Initializes a new codec for the (name, property) pairs.
+
+        The codec gets three methods. pack(data) returns the bytes of the
+        properties of the data object, and unpack(data, bytes) sets the
+        properties of the data object from the bytes, which may carry on
+        past the properties. unpack_tuple(bytes) returns the values in the
+        bytes as a tuple instead.
+
+        """
+        self.struct = Struct("=" + "".join("B" + prop.format
+            for name, prop in props))
+        self.size   = self.struct.size
+
+        namespace = {"struct_pack" : self.struct.pack,
+            "struct_unpack" : self.struct.unpack_from}
+        values    = []
+        loads     = []
+        start     = 0
+        for i, (name, prop) in enumerate(props):
+            # The values the property's format packs when it's None
+            empty = Struct("=B" + prop.format).unpack(prop.default)
+            count = len(empty) - 1
+            namespace["empty_%d" % i]  = empty
+            namespace["encode_%d" % i] = prop.encode
+            namespace["decode_%d" % i] = prop.decode
+            simple = count == 1 and _get_owner(getmro(prop.__class__),
+                "encode") is Property
+            if simple:
+                value = "(1, v_%d)" % i
+                load  = "v[%d]" % (start + 1)
+            else:
+                value = "(1,) + encode_%d(v_%d)" % (i, i)
+                load  = "decode_%d(v[%d:%d])" % (i, start + 1,
+                    start + 1 + count)
+            values.append("(empty_%d if v_%d == None else %s)" %
+                (i, i, value))
+            loads.append("(%s if v[%d] else None)" % (load, start))
+            start += 1 + count
+
+        source = "def pack(data):\n"
+        for i, (name, prop) in enumerate(props):
+            source += "    v_%d = data.%s\n" % (i, name)
+        source += "    return struct_pack(*(%s))\n" % \
+            " + ".join(values or ["()"])
+        source += "def unpack(data, bytes):\n"
+        source += "    v = struct_unpack(bytes)\n"
+        for (name, prop), load in zip(props, loads):
+            source += "    data.%s = %s\n" % (name, load)
+        source += "def unpack_tuple(bytes):\n"
+        source += "    v = struct_unpack(bytes)\n"
+        source += "    return (%s)\n" % "".join(load + ", " for load in loads)
+        exec source in namespace
+        self.pack         = namespace["pack"]
+        self.unpack       = namespace["unpack"]
+        self.unpack_tuple = namespace["unpack_tuple"]
+
+
+def get_codec(props):
+    """ Returns a Codec for the (name, property) pairs, or None if they can't
+    all be packed by one.
+
+    """
+    for name, prop in props:
+        if not _is_compilable(prop):
+            return None
+    return Codec(props)
+
+def _is_compilable(prop):
+    """ Returns True if the property can be packed by a Codec. """
+    # Inside a larger struct, the property's format is laid out with
+    # standard sizes and no padding. It has to come out the same as it
+    # does on its own.
+    if prop.format[:1] in "@=<>!" or \
+            calcsize("=" + prop.format) != calcsize(prop.format):
+        return False
+    # Whichever class defines the property's pack() and unpack() methods
+    # also has to define the encode() and decode() methods that go with
+    # them.
+    classes = getmro(prop.__class__)
+    for packer, encoder in (("pack", "encode"), ("unpack", "decode")):
+        if _get_owner(classes, packer) is not _get_owner(classes, encoder):
+            return False
+    return True
+
+def _get_owner(classes, name):
+    """ Returns the first of the classes to define the attribute. """
+    for cls in classes:
+        if name in cls.__dict__:
+            return cls
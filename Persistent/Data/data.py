@@ -1,8 +1,133 @@
-from struct import pack, unpack, calcsize
+from struct import pack, pack_into, unpack, calcsize
+from collections import namedtuple
 from Persistent.Property import Property, IntegerProperty
+from Persistent.Data.codec import get_codec
 from zlib import crc32
 
-class Data:
+class DataType(type):
+    """ DataType is the metaclass of Data. It works out the layout of a Data
+    class on disk as soon as the class is defined.
+
+    The properties stay on the class, so User.username is the Property, and
+    Data objects keep their values in their __dict__, like any other object.
+
+    A Data class that sets _slots to True gets a slot for each of its
+    properties instead (see __slots__ in the Python docs). Its objects then
+    don't need a __dict__, which makes them a lot smaller, about as small as
+    a tuple of their values. That's worth it when lots of them are held at
+    once. The catch is that a slot can't have the same name as a class
+    attribute, so the properties are taken out of the class, and looking
+    one up on the class gives its slot. Use Data.get_property() to get the
+    Property instead. Objects of such classes can't be given attributes
+    other than their properties either.
+
+    >>> class Point(Data):
+    ...   x = IntegerProperty()
+    ...
+    >>> class SlottedPoint(Data):
+    ...   _slots = True
+    ...   x = IntegerProperty()
+    ...
+    >>> isinstance(Point.x, Property), isinstance(SlottedPoint.x, Property)
+    (True, False)
+    >>> SlottedPoint.get_property("x") is SlottedPoint._names["x"]
+    True
+    >>> p = Point(x=1)
+    >>> p.label = "origin"
+    >>> s = SlottedPoint(x=1)
+    >>> s.label = "origin"
+    Traceback (most recent call last):
+    ...
+    AttributeError: 'SlottedPoint' object has no attribute 'label'
+    >>> hasattr(p, "__dict__"), hasattr(s, "__dict__")
+    (True, False)
+
+    """
+
+    # The slots that every Data object has, besides its properties
+    base_slots = ("_file", "_container", "_raw", "_is_map",
+        "fixed_array_index_")
+
+    # The slots, besides the properties, that are kept when pickling
+    pickled_slots = ("_is_map", "fixed_array_index_")
+
+    def __new__(meta, name, bases, namespace):
+        # The properties of the class, along with those of the Data classes
+        # it inherits from
+        props = {}
+        for base in reversed(bases):
+            props.update(getattr(base, "_props", []))
+        own   = [(key, value) for key, value in namespace.items()
+            if isinstance(value, Property)]
+        props.update(own)
+
+        # Data itself has slots for what every Data object keeps, so that
+        # classes with _slots don't get a __dict__ from it. A slot can't have
+        # the same name as a class attribute, so the properties of those
+        # classes are only kept in _props.
+        if not [base for base in bases if isinstance(base, DataType)]:
+            namespace["__slots__"] = meta.base_slots
+        elif namespace.get("_slots") and "__slots__" not in namespace:
+            for key, value in own:
+                del namespace[key]
+            namespace["__slots__"] = tuple(key for key, value in own)
+        cls = type.__new__(meta, name, bases, namespace)
+
+        is_key      = lambda x: x[1].is_key
+        is_data     = lambda x: x[1].is_data
+
+        # Sort the properties by name. It is important to sort them by name
+        # so that they are always in the same order. By default dict.items()
+        # might be in a different order in different versions of python. The
+        # order determines the order of the bytes on disk as well.
+        props = sorted(props.items())
+
+        # We then get a list of all of the keys for this Data object
+        cls._keys = filter(is_key, props)
+        # And we get a list of all non-keys for this Data object.
+        cls._data = filter(is_data, props)
+
+        # We put the keys before the data so that the bytes on disk always
+        # start with the key bytes, if there are any. This is useful for
+        # some containers when doing lookups.
+        cls._props = cls._keys + cls._data
+        cls._names = dict(cls._props)
+        cls._size  = sum(prop.size for name, prop in cls._props) + \
+                     cls._crc_size
+        # The bytes of an object start with the bytes of its keys
+        cls._key_size = sum(prop.size for name, prop in cls._keys)
+        # The properties that maps keep an index on
+        cls._indexes  = [(name, prop) for name, prop in cls._props
+            if prop.is_indexed]
+
+        # We compile the properties, and the keys on their own, into
+        # codecs that pack and unpack all of them with a single struct.
+        # These are None if any of the properties can't be packed that
+        # way, see Codec.
+        cls._codec     = get_codec(cls._props)
+        cls._key_codec = get_codec(cls._keys)
+
+        # Lazy objects need to know where each property's bytes start
+        cls._offsets = {}
+        start = 0
+        for name, prop in cls._props:
+            cls._offsets[prop] = (name, start)
+            start += prop.size
+
+        # The class of the named tuples that containers can return instead
+        # of Data objects
+        cls._tuple = namedtuple(cls.__name__, [n for n, prop in cls._props])
+
+        # A fingerprint of the layout on disk. Containers keep it, so that
+        # they can tell when they're opened with a class that doesn't match
+        # the one they were written with.
+        layout = "".join("%s:%s:%s;" % (name, prop.format, prop.is_key)
+            for name, prop in cls._props)
+        cls._fingerprint = crc32(layout) & 0xffffffff
+        return cls
+
+
+class Data(object):
     """ Data class is responsible for managing a series of related properties.
     Effectively it is an object that can be written to and read from disk.
 
@@ -60,11 +185,14 @@ class Data:
 
     """
 
+    __metaclass__ = DataType
+
     # The checksum is simply an int, this describes the format and size
     _crc_fmt  = "i"
     _crc_size = calcsize(_crc_fmt)
 
-    def __init__(self, _container=None, _bytes=None, _file=None,  **kwargs):
+    def __init__(self, _container=None, _bytes=None, _file=None, _lazy=False,
+            _verify=True, **kwargs):
         """ Initializes a new Data object
 
         _container is the container that is storing these Data objects.
@@ -78,36 +206,42 @@ class Data:
         _file is the open file handle that the bytes for this data object
         are being written to.
 
+        If _lazy is True, the object just holds on to _bytes. Each property
+        is decoded the first time it's used, and the checksum isn't checked
+        unless verify() is called. This saves a lot of work when only a few
+        of the properties are ever looked at.
+
+        If _verify is False, the checksum at the end of _bytes isn't checked
+        when they're loaded. It has to be False for bytes that were unloaded
+        without a checksum.
+
+        >>> from Persistent import StringProperty
+        >>> class User(Data):
+        ...   username = StringProperty(length=25)
+        ...   age      = IntegerProperty()
+        ...
+        >>> bytes = User(username="Steve", age=30).unload()
+        >>> user  = User(_bytes=bytes, _lazy=True)
+        >>> user.is_decoded("age")
+        False
+        >>> user.age
+        30
+        >>> user.is_decoded("age"), user.is_decoded("username")
+        (True, False)
+        >>> user.verify()
+        >>> print user
+        {age: 30, username: Steve}
+
+        >>> user = User(_bytes=bytes[:-1] + "?", _lazy=True)
+        >>> user.age
+        30
+        >>> user.verify()
+        Traceback (most recent call last):
+        Exception: Checksums don't match. Looks like corrupt data
+
         """
-        # We use cls just so we don't have to keep writing self.__class__
-        cls = self.__class__
-
-        # If the class properties haven't been initialized yet, initialize
-        # them.
-        if "_props" not in cls.__dict__:
-            is_property = lambda x: isinstance(x[1], Property)
-            is_key      = lambda x: x[1].is_key
-            is_data     = lambda x: x[1].is_data
-
-            # Get all of the class fields that are properties and sort them
-            # by name. It is important to sort them by name so that they
-            # are always in the same order. By default dict.items() might
-            # be in a different order in different versions of python. The
-            # order determines the order of the bytes on disk as well.
-            cls._props = filter(is_property, cls.__dict__.items())
-            cls._props.sort()
-
-            # We then get a list of all of the keys for this Data object
-            cls._keys = filter(is_key, cls._props)
-            # And we get a list of all non-keys for this Data object.
-            cls._data = filter(is_data, cls._props)
-
-            # We put the keys before the data so that the bytes on disk always
-            # start with the key bytes, if there are any. This is useful for
-            # some containers when doing lookups.
-            cls._props = cls._keys + cls._data
-            cls._size  = sum(prop.size for name, prop in cls._props) + \
-                         cls._crc_size
+        # The layout of the class was worked out by DataType when the class
+        # was defined
         self._file   = _file
         self._container = _container
 
@@ -137,19 +271,42 @@ class Data:
             for name, property_ in self._props:
                 value = kwargs.get(name, None)
                 setattr(self, name, value)
+        elif _lazy:
+            # Lazy objects keep their bytes, and decode properties from them
+            # as they're used
+            self._raw = _bytes
         else:
             # If bytes are specified, we initialize the object using those
             # bytes
-            self.load(_bytes)
+            self.load(_bytes, _verify)
 
-    def load(self, bytes):
+    def load(self, bytes, verify=True):
         """ Sets the values for the attributes of the object based on the
         bytes passed in. In other words, deserializes the object.
 
+        Unless verify is False, the checksum at the end of the bytes is
+        checked too.
+
+        >>> class Integer(Data):
+        ...   value = IntegerProperty()
+        ...
+        >>> bytes = Integer(value=3).unload(checksum=False)
+        >>> len(bytes), Integer._size
+        (5, 9)
+        >>> Integer(_bytes=bytes, _verify=False).value
+        3
+
         """
 
-        # We iterate through each property and tell that property to
-        # unpack its respective bytes.
+        # The codec unpacks all of the properties at once
+        if self._codec != None:
+            self._codec.unpack(self, bytes)
+            if verify:
+                self._check(bytes, self._codec.size)
+            return
+
+        # Otherwise we iterate through each property and tell that property
+        # to unpack its respective bytes.
         start = 0
         for name, property_ in self._props:
             # We set data to the appropaite range of bytes for that
@@ -163,25 +320,239 @@ class Data:
             # When we're done with this property, we update the new start
             # position for the bytes for the next property
             start += property_.size
-        # The last few bytes are the bytes for the checksum. We just make
-        # sure that the checksum is what it is supposed to be. If it's not
-        # then we throw an exception.
-        checksum = bytes[start : start + self._crc_size]
-        if pack(self._crc_fmt, crc32(bytes[0 : -self._crc_size])) != checksum:
+        if verify:
+            self._check(bytes, start)
+
+    def __getattr__(self, name):
+        """ Properties that haven't been set yet are decoded from the bytes
+        of lazy objects.
+
+        """
+        property_ = self._names.get(name)
+        if property_ == None:
+            raise AttributeError(name)
+        return self.decode(property_)
+
+    def is_decoded(self, name):
+        """ Returns True if the property with the given name holds a value,
+        rather than waiting to be decoded from the bytes of a lazy object.
+
+        """
+        if name in getattr(self, "__dict__", ()):
+            return True
+        # Looking at the slot directly doesn't fall back on __getattr__
+        slot = getattr(self.__class__, name)
+        if isinstance(slot, Property):
+            return False
+        try:
+            slot.__get__(self, self.__class__)
+            return True
+        except AttributeError:
+            return False
+
+    @classmethod
+    def get_property(cls, name):
+        """ Returns the Property with the given name. That's the same as
+        looking it up on the class, except for classes with _slots, where
+        the class has a slot by that name instead, see DataType.
+
+        >>> class Integer(Data):
+        ...   value = IntegerProperty(key=True)
+        ...
+        >>> Integer.get_property("value") is Integer.value
+        True
+        >>> Integer.value.is_key
+        True
+
+        """
+        property_ = cls._names.get(name)
+        if property_ == None:
+            raise AttributeError(name)
+        return property_
+
+    def __getstate__(self):
+        """ Returns the values of the properties, for pickling. Lazy objects
+        are decoded first. The container and file aren't pickled, so an
+        unpickled object has to be added to a container again before it can
+        be committed.
+
+        Without this, objects with slots can't be pickled with protocols 0
+        and 1, and that includes every Data object, since Data has slots of
+        its own.
+
+        >>> import pickle, sys
+        >>> from Persistent import StringProperty
+        >>> class User(Data):
+        ...   username = StringProperty(length=25)
+        ...   age      = IntegerProperty()
+        ...
+        >>> class SlottedUser(Data):
+        ...   _slots   = True
+        ...   username = StringProperty(length=25)
+        ...   age      = IntegerProperty()
+        ...
+        >>> # Pickle looks classes up by their module and name
+        >>> module = sys.modules[User.__module__]
+        >>> module.User, module.SlottedUser = User, SlottedUser
+        >>> bytes = User(username="Steve", age=30).unload()
+        >>> for cls in (User, SlottedUser):
+        ...   for protocol in (0, 1, 2):
+        ...     user = pickle.loads(pickle.dumps(cls(_bytes=bytes), protocol))
+        ...     print user, user.unload() == bytes
+        ...
+        {age: 30, username: Steve} True
+        {age: 30, username: Steve} True
+        {age: 30, username: Steve} True
+        {age: 30, username: Steve} True
+        {age: 30, username: Steve} True
+        {age: 30, username: Steve} True
+        >>> user = pickle.loads(pickle.dumps(User(_bytes=bytes, _lazy=True)))
+        >>> user.is_decoded("age"), user.age
+        (True, 30)
+        >>> del module.User, module.SlottedUser
+
+        """
+        state = dict((name, getattr(self, name)) for name, prop in self._props)
+        for name in DataType.pickled_slots:
+            if hasattr(self, name):
+                state[name] = getattr(self, name)
+        return state
+
+    def __setstate__(self, state):
+        """ Sets the values of the properties when unpickling. """
+        self._file      = None
+        self._container = None
+        for name, value in state.items():
+            setattr(self, name, value)
+
+    def decode(self, property_):
+        """ Decodes the value of the property from the bytes of a lazy
+        object, and holds on to it from then on. This is called the first
+        time the property's value is used.
+
+        """
+        name, start = self._offsets[property_]
+        raw   = getattr(self, "_raw", None)
+        value = None
+        if raw != None:
+            value = property_.unpack(raw[start : start + property_.size],
+                self._file)
+        setattr(self, name, value)
+        return value
+
+    def verify(self):
+        """ Checks the checksum of a lazy object's bytes, and throws an
+        exception if it doesn't match. Objects that aren't lazy are checked
+        when they're loaded. There's nothing to check for bytes without a
+        checksum.
+
+        """
+        raw = getattr(self, "_raw", None)
+        if raw != None and len(raw) == self._size:
+            self._check(raw, self._size - self._crc_size)
+
+    @classmethod
+    def to_tuple(cls, bytes, named=False, verify=True):
+        """ Deserializes the bytes into a plain tuple of the values of the
+        properties, keys first, rather than into a Data object. If named is
+        True, the tuple is a namedtuple, so the values can be looked up by
+        the names of the properties too.
+
+        Tuples take much less memory than Data objects and are quicker to
+        make, which makes them handy for reading lots of elements at once.
+
+        Just like load(), the checksum is checked unless verify is False.
+
+        >>> class Pair(Data):
+        ...   key   = IntegerProperty(key=True)
+        ...   value = IntegerProperty()
+        ...
+        >>> bytes = Pair(key=1, value=2).unload()
+        >>> Pair.to_tuple(bytes)
+        (1, 2)
+        >>> Pair.to_tuple(bytes, named=True)
+        Pair(key=1, value=2)
+
+        """
+        if cls._codec != None:
+            if verify:
+                cls._check(bytes, cls._codec.size)
+            values = cls._codec.unpack_tuple(bytes)
+        else:
+            data   = cls(_bytes=bytes, _verify=verify)
+            values = tuple(getattr(data, name) for name, prop in cls._props)
+        if named:
+            return cls._tuple._make(values)
+        return values
+
+    @classmethod
+    def _check(cls, bytes, start):
+        """ The last few bytes, starting at start, are the bytes for the
+        checksum. We just make sure that the checksum is what it is supposed
+        to be. If it's not then we throw an exception.
+
+        """
+        if not cls.is_intact(bytes[0 : start + cls._crc_size]):
             raise Exception("Checksums don't match. Looks like corrupt data")
 
-    def unload(self):
+    @classmethod
+    def is_intact(cls, bytes):
+        """ Returns True if the checksum that the bytes end with matches the
+        rest of them.
+
+        >>> class Integer(Data):
+        ...   value = IntegerProperty()
+        ...
+        >>> bytes = Integer(value=3).unload()
+        >>> Integer.is_intact(bytes), Integer.is_intact("?" + bytes[1:])
+        (True, False)
+
+        """
+        checksum = bytes[-cls._crc_size:]
+        return pack(cls._crc_fmt, crc32(bytes[0 : -cls._crc_size])) == checksum
+
+    @classmethod
+    def add_checksums(cls, bytes):
+        """ Fills in the checksums of the objects in bytes, a bytearray of
+        the bytes of many objects one after the other, from the rest of
+        their bytes. This is how bytes that were put together without
+        unload(), such as those of a numpy array, get their checksums.
+
+        >>> class Integer(Data):
+        ...   value = IntegerProperty()
+        ...
+        >>> bytes = bytearray(Integer(value=1).unload()[:-4] + "????" +
+        ...   Integer(value=2).unload()[:-4] + "????")
+        >>> Integer.add_checksums(bytes)
+        >>> str(bytes) == Integer(value=1).unload() + Integer(value=2).unload()
+        True
+
+        """
+        size = cls._size - cls._crc_size
+        for start in xrange(0, len(bytes), cls._size):
+            pack_into(cls._crc_fmt, bytes, start + size,
+                crc32(buffer(bytes, start, size)))
+
+    def unload(self, checksum=True):
         """ Takes the values for the attributes of the object and converts
         these values to a series a bytes that can be written to disk. In
         other words, it serializes the object.
 
+        The bytes end with a checksum of the rest of them, unless checksum
+        is False.
+
         """
-        # Iterate through each property and join the packed bytes
-        bytes = "".join(property_.pack(getattr(self, name))
-                        for name, property_ in self._props)
+        # Pack all of the properties at once if we can, otherwise iterate
+        # through each property and join the packed bytes
+        if self._codec != None:
+            bytes = self._codec.pack(self)
+        else:
+            bytes = "".join(property_.pack(getattr(self, name))
+                            for name, property_ in self._props)
+        if not checksum:
+            return bytes
         # Append the checksum to the end of the bytes
-        checksum = pack(self._crc_fmt, crc32(bytes))
-        return bytes + checksum
+        return bytes + pack(self._crc_fmt, crc32(bytes))
 
     def unload_key(self):
         """ Takes the values for the attributes of the object that
@@ -190,9 +561,31 @@ class Data:
         is present somewhere in them.
 
         """
+        if self._key_codec != None:
+            return self._key_codec.pack(self)
         return "".join(property_.pack(getattr(self, name))
                        for name, property_ in self._keys)
 
+    def unload_ordered_key(self):
+        """ Like unload_key(), but the bytes sort in the same order as the
+        keys, see Property.pack_ordered. The keys are compared in the order
+        of their names, which is the order their bytes are kept in.
+
+        >>> from Persistent import StringProperty
+        >>> class Name(Data):
+        ...   last  = StringProperty(length=10, key=True)
+        ...   first = StringProperty(length=10, key=True)
+        ...
+        >>> names = [Name(last="Smith", first="Al"), Name(last="Jones",
+        ...   first="Zed"), Name(last="Smith", first="Adam")]
+        >>> names.sort(key=Name.unload_ordered_key)
+        >>> [(name.first, name.last) for name in names]
+        [('Adam', 'Smith'), ('Al', 'Smith'), ('Zed', 'Jones')]
+
+        """
+        return "".join(property_.pack_ordered(getattr(self, name))
+                       for name, property_ in self._keys)
+
     def commit(self):
         """ This saves the data object in whatever its container is. This
         way, once you get a Data object from a container, you can pass it
@@ -204,8 +597,8 @@ class Data:
         # TODO the old object will still be present in the container,
         # This is only a problem for containers that use key->vals and
         # the key has been modified.
-        # This is a known bug. To fix this, delete the old object first.
-        # Delete support isn't implemented yet.
+        # This is a known bug. Until it's fixed, delete the old object
+        # first, with Hashmap.delete().
         self._container.commit(self)
 
     def __str__(self):
@@ -0,0 +1,81 @@
+import re
+from struct import calcsize
+
+# The kind of numpy type that each struct format character is. The sizes
+# come from struct, so they always match the bytes on disk.
+_kinds = {"b" : "i", "h" : "i", "i" : "i", "l" : "i", "q" : "i",
+          "B" : "u", "H" : "u", "I" : "u", "L" : "u", "Q" : "u", "P" : "u",
+          "f" : "f", "d" : "f", "?" : "b", "c" : "S", "s" : "S", "p" : "V"}
+
+def get_dtype(data, checksum=True):
+    """ Returns a description of the bytes of the data class's objects, that
+    numpy.dtype() turns into the equivalent structured dtype. This doesn't
+    need numpy itself.
+
+    Every property starts with a field named after it with "_set" on the
+    end, which is 1 if the value is set and 0 if it's None. That's followed
+    by the fields for the values that its format packs, named by
+    Property.get_fields. If checksum is True, the bytes end with a field
+    called "checksum_".
+
+    >>> from Persistent import Data, IntegerProperty, StringProperty
+    >>> class User(Data):
+    ...   id   = IntegerProperty(key=True)
+    ...   name = StringProperty(length=5)
+    ...
+    >>> dtype = get_dtype(User)
+    >>> for field in zip(dtype["names"], dtype["formats"], dtype["offsets"]):
+    ...   print field
+    ('id_set', '|u1', 0)
+    ('id', '=i4', 1)
+    ('name_set', '|u1', 5)
+    ('name_length', '=u4', 6)
+    ('name', '|S5', 10)
+    ('checksum_', '=i4', 15)
+    >>> dtype["itemsize"] == User._size
+    True
+    >>> get_dtype(User, checksum=False)["itemsize"]
+    15
+
+    """
+    if data._codec == None:
+        raise Exception("%s can't be described by a dtype" % data.__name__)
+    description = {"names" : [], "formats" : [], "offsets" : []}
+    start = 0
+    for name, prop in data._props:
+        _add_field(description, name + "_set", "|u1", start)
+        prefix = ""
+        fields = iter(prop.get_fields(name))
+        for count, char in re.findall(r"(\d*)(\D)", prop.format):
+            # Values are aligned within the property's own format, the same
+            # way struct lines them up
+            offset  = start + 1 + calcsize(prefix + "0" + char)
+            prefix += count + char
+            count   = int(count or 1)
+            if char == "x":
+                continue
+            if char not in _kinds:
+                raise Exception("%s can't be described by a dtype" % char)
+            kind = _kinds[char]
+            if char in "sp":
+                format = "|%s%d" % (kind, count)
+            else:
+                size   = calcsize(char)
+                order  = "|" if size == 1 else "="
+                format = "%s%s%d" % (order, kind, size)
+                if count > 1:
+                    format = "(%d,)%s" % (count, format)
+            _add_field(description, fields.next(), format, offset)
+        start += prop.size
+    if checksum:
+        _add_field(description, "checksum_", "=" + "i%d" % data._crc_size,
+            start)
+        start += data._crc_size
+    description["itemsize"] = start
+    return description
+
+def _add_field(description, name, format, offset):
+    """ Adds a field to the description of a dtype. """
+    description["names"].append(name)
+    description["formats"].append(format)
+    description["offsets"].append(offset)
@@ -1,5 +1,7 @@
-import os
+import threading
 from struct import pack, unpack, calcsize
+from Persistent.Storage  import open_storage, open_file
+from Persistent.Executor import Executor
 
 class DynamicCollection:
     """ DynamicCollection simply centralizes some of the common logic between
@@ -9,9 +11,146 @@ class DynamicCollection:
     TODO: Add proper tests to this class. In all fairness though most of the
     functionality is already tested by the other classes that implement it.
 
+    The collection starts with a superblock. It's a magic string, so that
+    we can tell it apart from collections written before there was one,
+    followed by flags describing the format of the collection, a
+    fingerprint of the Data class, and everything else the collection was
+    created with. The superblock is followed by a directory with the address
+    and size of each of the fixed collections. Opening a collection is then
+    a single read, rather than a read for every fixed collection.
+
+    >>> from cStringIO import StringIO
+    >>> from Persistent import Data, IntegerProperty, Array
+    >>> class Integer(Data):
+    ...   value = IntegerProperty()
+    ...
+    >>> obj = StringIO()
+    >>> a = Array(Integer, file_object=obj, sparse=True)
+    >>> a[5000] = Integer(value=5)
+    >>> b = Array(Integer, file_object=obj, address=0)
+    >>> b.sparse
+    True
+    >>> print b[5000], b[5001]
+    {value: 5} None
+
+    >>> # The directory grows past its first block as it needs to
+    >>> class Small(Array):
+    ...   directory_entries = 2
+    ...
+    >>> obj = StringIO()
+    >>> a = Small(Integer, file_object=obj)
+    >>> a[20000] = Integer(value=20000)
+    >>> len(a.collections), len(a.directory_blocks)
+    (5, 3)
+    >>> b = Small(Integer, file_object=obj, address=0)
+    >>> [c.address for c in b.collections] == [c.address for c in a.collections]
+    True
+    >>> b[20000].value
+    20000
+
+    >>> # A collection can't be opened with a different Data class
+    >>> class Other(Data):
+    ...   other = IntegerProperty()
+    ...
+    >>> Array(Other, file_object=obj, address=0)
+    Traceback (most recent call last):
+    ...
+    Exception: The collection was written with a different Data class
+
+    >>> # Collections with the first version of the header can still be
+    >>> # opened, and so can collections written without a header
+    >>> obj = StringIO()
+    >>> obj.write(pack("8sq", "Persist\x01", 1) + pack("q" * 32, *([-1] * 32)))
+    >>> a = Array(Integer, file_object=obj, address=0)
+    >>> a._add_collection()
+    >>> a[0] = Integer(value=7)
+    >>> b = Array(Integer, file_object=obj, address=0)
+    >>> b.sparse, b[0].value
+    (True, 7)
+
+    >>> obj = StringIO()
+    >>> obj.write(pack("q" * 32, *([-1] * 32)))
+    >>> a = Array(Integer, file_object=obj, address=0)
+    >>> a._add_collection()
+    >>> a[0] = Integer(value=7)
+    >>> b = Array(Integer, file_object=obj, address=0)
+    >>> b.sparse, b[0].value
+    (False, 7)
+
+    Collections can be shared by many threads. Reads never block each other,
+    and writers only wait for writers working on the same fixed collection,
+    or for a new fixed collection to be added.
+
+    >>> import threading
+    >>> from Persistent import Hashmap
+    >>> class Pair(Data):
+    ...   key   = IntegerProperty(key=True)
+    ...   value = IntegerProperty()
+    ...
+    >>> m = Hashmap(Pair, file_object=StringIO())
+    >>> def work(start):
+    ...   for i in xrange(start, 5000, 4):
+    ...     m[i] = i
+    ...   for i in xrange(5000):
+    ...     m[i]
+    ...
+    >>> threads = [threading.Thread(target=work, args=(i,)) for i in xrange(4)]
+    >>> for thread in threads:
+    ...   thread.start()
+    >>> for thread in threads:
+    ...   thread.join()
+    >>> [i for i in xrange(5000) if m[i] != i]
+    []
+
     """
 
-    def __init__(self, data, file_name=None, file_object=None, address=None):
+    # The magic string that headers start with. A collection without a header
+    # starts with a pointer instead, which will never look like this.
+    magic         = "Persist\x03"
+    header_format = "8sq"
+
+    # The superblock goes on after the magic string and the flags with the
+    # fingerprint of the Data class, the probe size of the fixed sets, the
+    # allocation of the first fixed collection, and how many times larger
+    # each fixed collection is than the one before it. Then come the
+    # address of the block of named collections, and how many there are.
+    # It ends with reserved bytes, which are written as zeros. Anything
+    # added to the superblock later goes in them, and has to take zero to
+    # mean whatever collections written before it was added did, so that
+    # the layout of the superblock never changes under this magic string.
+    superblock_format = "8sqqqqdqq64x"
+    named_offset      = calcsize("8sqqqqd")
+
+    # Other collections that are kept in the same file, such as the indexes
+    # of a map, are found by their name in the block of named collections.
+    # It's rewritten at the end of the file whenever they change.
+    named_format      = "64sq"
+
+    # The directory is made of blocks, the first of which follows the
+    # superblock. Each block is the address of the next block, or -1, and
+    # then the address and size of this many fixed collections. Entries that
+    # aren't used yet have an address of -1.
+    directory_entries = 32
+    entry_format      = "qq"
+
+    # The first version of the header was followed by this many pointers to
+    # the fixed collections, and nothing else
+    legacy_magic      = "Persist\x01"
+    pointers_format   = "q" * 32
+
+    # Only sets probe, and they set their own probe size
+    probe_size        = 0
+
+    # The bits of the flags in the header
+    sparse_flag    = 1
+    # The number of the checksum policy is kept in these bits of the flags
+    checksum_shift = 16
+    checksum_mask  = 0xFF
+
+    def __init__(self, data, file_name=None, file_object=None, address=None,
+            mmap=False, sparse=False, cache=None, durability=None,
+            lazy=False, checksum="read", initial_allocation=1024, growth=2,
+            expected_size=None, storage=None, readonly=False):
         """ Initializes a new dynamic collection.
 
         Data is the class for the elements that will be stored in this collection.
@@ -28,89 +167,532 @@ class DynamicCollection:
         no address is supplied, space for a new collection is allocated at the
         end of the file.
 
-        TODO add "bytes" argument for loading through Data objects, set initial allocation too
+        If mmap is True, the file is memory mapped rather than read through
+        the file object. Lookups then become slices of the mapping instead
+        of a seek and a read.
+
+        If sparse is True, empty elements are zero bytes instead of 0xFF
+        bytes. This lets new collections be allocated without writing them
+        out, so growing the collection is constant time rather than a write
+        of the entire new collection. This is recorded in the header, so it
+        only matters when the collection is first created.
+
+        If a PageCache is given as the cache, reads and writes go through it.
+        Writes then only reach the file when the cache evicts them, or when
+        flush() or close() is called. The same cache can be shared by many
+        collections.
+
+        If a durability is given, writes go through a write-ahead log, so
+        that a crash never leaves the collection half written. Durability is
+        one of "op", "batch" or "none", see LoggedStorage for what each of
+        them means.
+
+        If lazy is True, the data objects we return only decode their
+        properties as they're used, see Data.__init__. Unlike sparse, this
+        can be different every time the collection is opened.
+
+        Checksum is the policy for the checksums of the elements, one of
+        "read", "sample", "scrub" or "off". See FixedArray.__init__ for what
+        each of them means. It's recorded in the header, so it only matters
+        when the collection is first created. Collections that do keep
+        checksums can be checked all at once with scrub().
+
+        >>> from cStringIO import StringIO
+        >>> from Persistent import Data, IntegerProperty, Hashmap
+        >>> class Pair(Data):
+        ...   key   = IntegerProperty(key=True)
+        ...   value = IntegerProperty()
+        ...
+        >>> obj = StringIO()
+        >>> m = Hashmap(Pair, file_object=obj, checksum="off")
+        >>> m.update(Pair(key=i, value=i) for i in xrange(2000))
+        >>> m.collections[0].record_size, Pair._size
+        (10, 14)
+        >>> m = Hashmap(Pair, file_object=obj, address=0)
+        >>> m.checksum, [i for i in xrange(2000) if m[i] != i]
+        ('off', [])
+
+        >>> m = Hashmap(Pair, file_object=StringIO(), checksum="scrub")
+        >>> m.update(Pair(key=i, value=i) for i in xrange(2000))
+        >>> m.scrub()
+        []
+        >>> m.storage.write(m.collections[1].address + 13, "?")
+        >>> m.scrub()
+        [(1, 0)]
+
+        The first fixed collection has room for initial_allocation
+        elements, and each one after it is growth times as large as the one
+        before it. A growth closer to 1 wastes less space, but makes for
+        more fixed collections. If the number of elements the collection
+        will hold is known up front, it can be given as expected_size
+        instead, and the first fixed collection is made large enough to
+        hold all of them. These are recorded in the header, so they only
+        matter when the collection is first created. See reserve() for
+        making room in a collection that already exists.
+
+        >>> m = Hashmap(Pair, file_object=StringIO(), expected_size=50000)
+        >>> m.update(Pair(key=i, value=i) for i in xrange(50000))
+        >>> len(m.collections), m.collections[0].allocation
+        (1, 62500)
+
+        >>> obj = StringIO()
+        >>> m = Hashmap(Pair, file_object=obj, initial_allocation=100,
+        ...   growth=1.5)
+        >>> m.update(Pair(key=i, value=i) for i in xrange(2000))
+        >>> m = Hashmap(Pair, file_object=obj, address=0)
+        >>> m.initial_allocation, m.growth
+        (100, 1.5)
+        >>> [c.allocation for c in m.collections]
+        [100, 150, 225, 337, 505, 757]
+
+        Collections that are kept in the same file as another collection
+        can share its storage, instead of a file_name or file_object.
+
+        If readonly is True, the collection is opened for reading only. The
+        file is memory mapped shared and read only, see ReadOnlyStorage, so
+        any number of processes can read it while sharing one copy of it in
+        the operating system's page cache. Nothing is ever allocated or
+        written. The collection has to exist already, and cache and
+        durability can't be given. A single writer can go on adding to the
+        collection in another process, and refresh() picks up what it has
+        added.
+
+        TODO add "bytes" argument for loading through Data objects
 
         """
+        if growth < 1:
+            raise Exception("Collections can't shrink, growth is %s" %
+                growth)
         # Data objects have certain varibles, such as the size of the object,
         # initialized the first time the constructoris called. Here we force
         # these variables to be intiialized.
         data()
         self.data = data
         if file_name != None:
-            if not os.path.exists(file_name):
-                # Create the file if it doesn't exist
-                open(file_name, 'w').close()
-            elif address == None:
-                # If the file exists already and no address is supplied 
-                address = 0
-            file_object = open(file_name, 'r+b')
-        self.file_object        = file_object
-        self.initial_allocation = 1024
-        # TODO make this a linked list instead of array[32]
-        self.pointers_format    = "q" * 32
-        self.pointers           = [-1] * 32
+            file_object, address = open_file(file_name, address, readonly)
+        if readonly and address == None:
+            raise Exception("Read only collections have to exist already")
+        if storage == None:
+            storage = open_storage(file_object, mmap, cache, durability,
+                readonly)
+        self.storage            = storage
+        # What the storage's count of other containers' writes was when we
+        # last looked, see _refresh_if_changed()
+        self.changes            = getattr(storage, "changes", 0)
+        self.readonly           = readonly
+        self.initial_allocation = initial_allocation
+        self.growth             = growth
+        if expected_size != None:
+            self.initial_allocation = self._get_reserved_allocation(
+                expected_size)
+        self.directory_format   = "q" + self.entry_format * \
+            self.directory_entries
+        self.directory_blocks   = []
+        # Only collections with the first version of the header, or none at
+        # all, have pointers
+        self.pointers           = None
+        self.pointers_address   = None
+        self.named              = {}
         self.address            = address
+        self.sparse             = sparse
+        self.lazy               = lazy
+        self.checksum           = checksum
         self.collections        = []
+        self.executor           = None
+        # Held while a fixed collection is being added
+        self.lock               = threading.RLock()
 
         # We allocate space at the end of the file if there is no address
         if self.address == None:
-            # Seek to the end of the file and record the address
-            self.file_object.seek(0, 2)
-            self.address = self.file_object.tell()
-
-            # Write the pointers
-            self.file_object.write(pack(self.pointers_format, *self.pointers))
+            # Write the superblock and the first block of the directory at
+            # the end of the file and record the address
+            superblock = pack(self.superblock_format, self.magic,
+                self._get_flags(), self.data._fingerprint, self.probe_size,
+                self.initial_allocation, self.growth, -1, 0)
+            self.address = self.storage.append(
+                superblock + self._get_empty_block())
+            self.directory_blocks.append(self.address + len(superblock))
 
             # Allocate the first array
             self._add_collection()
         else:
-            # Seek to the pointers
-            self.file_object.seek(self.address)
+            self._load_superblock()
+        self._open_indexes()
 
-            # Read in the pointers
-            self.pointers = list(unpack(self.pointers_format,
-                self.file_object.read(calcsize(self.pointers_format))))
+    def _load_superblock(self):
+        """ Reads in the superblock and the directory, and opens the fixed
+        collections in it.
+
+        The superblock and the first block of the directory are read all at
+        once. That's also enough to cover the header and pointers of
+        collections from before there was a superblock. The fixed
+        collections are given their sizes, and don't read anything until
+        they're used.
 
-            # Load collections
-            # TODO This just seeks and reads the size of each collection. We could
-            # store this locally to cut down on that seek time
+        >>> from StringIO import StringIO
+        >>> from Persistent import Data, IntegerProperty, Hashmap
+        >>> class Counted(StringIO):
+        ...   reads = 0
+        ...   def read(self, size=-1):
+        ...     self.reads += 1
+        ...     return StringIO.read(self, size)
+        ...
+        >>> class Pair(Data):
+        ...   key   = IntegerProperty(key=True)
+        ...   value = IntegerProperty()
+        ...
+        >>> obj = Counted()
+        >>> m = Hashmap(Pair, file_object=obj, bloom=True, probe_size=20)
+        >>> m.update(Pair(key=i, value=i) for i in xrange(20000))
+        >>> obj.reads = 0
+        >>> m = Hashmap(Pair, file_object=obj, address=0)
+        >>> len(m.collections), obj.reads
+        (5, 1)
+        >>> m.probe_size, m.collections[-1].probe_size, m[5]
+        (20, 20, 5)
+
+        """
+        superblock_size = calcsize(self.superblock_format)
+        bytes = self.storage.read(self.address,
+            superblock_size + calcsize(self.directory_format))
+        header_size  = calcsize(self.header_format)
+        magic, flags = unpack(self.header_format, bytes[:header_size])
+        if magic != self.magic:
+            if magic == self.legacy_magic:
+                self.pointers_address = self.address + header_size
+                bytes = bytes[header_size:]
+            else:
+                flags                 = 0
+                self.pointers_address = self.address
+            self._load_flags(flags)
+            self.pointers = list(unpack(self.pointers_format,
+                bytes[:calcsize(self.pointers_format)]))
             self.collections = [self._create_collection(address=i)
                 for i in self.pointers if i > -1]
+            self.named       = None
+            return
+
+        (magic, flags, fingerprint, self.probe_size, self.initial_allocation,
+            self.growth, named_address, named_count) = unpack(
+            self.superblock_format, bytes[:superblock_size])
+        if fingerprint != self.data._fingerprint:
+            raise Exception(
+                "The collection was written with a different Data class")
+        self._load_flags(flags)
+        if named_count > 0:
+            values = unpack(self.named_format * named_count,
+                self.storage.read(named_address,
+                calcsize(self.named_format) * named_count))
+            self.named = dict(zip([name.rstrip(chr(0))
+                for name in values[0::2]], values[1::2]))
+
+        # Every block of the directory after the first takes another read,
+        # but there's only one for every directory_entries fixed collections
+        block = self.address + superblock_size
+        bytes = bytes[superblock_size:]
+        while block != -1:
+            if bytes == None:
+                bytes = self.storage.read(block,
+                    calcsize(self.directory_format))
+            self.directory_blocks.append(block)
+            values = unpack(self.directory_format, bytes)
+            block  = values[0]
+            bytes  = None
+            for address, size in zip(values[1::2], values[2::2]):
+                if address > -1:
+                    self.collections.append(
+                        self._create_collection(address, size))
+
+    def refresh(self):
+        """ Picks up the fixed collections that a writer in another process
+        has added since the collection was opened, or last refreshed. Only
+        the block of the directory that the next fixed collection would be
+        in is read, along with any blocks after it, so it's cheap enough to
+        call before every batch of reads. The fixed collections that were
+        already open forget anything they've read about themselves, such as
+        the filters and counts of sets, so that they see what was added to
+        them too.
+
+        This is meant for read only collections, but works for any
+        collection that another process writes to.
+
+        >>> from Persistent import Data, IntegerProperty, Hashmap
+        >>> class Pair(Data):
+        ...   key   = IntegerProperty(key=True)
+        ...   value = IntegerProperty()
+        ...
+        >>> class Small(Hashmap):
+        ...   directory_entries = 2
+        ...
+        >>> writer = Small(Pair, "refresh_doctest.db", mmap=True, bloom=True)
+        >>> writer.update(Pair(key=i, value=i) for i in xrange(500))
+        >>> writer.flush()
+        >>> reader = Small(Pair, "refresh_doctest.db", readonly=True)
+        >>> reader[5], reader[1500], reader.storage.__class__.__name__
+        (5, None, 'ReadOnlyStorage')
+        >>> writer.update(Pair(key=i, value=i) for i in xrange(500, 10000))
+        >>> writer.flush()
+        >>> len(reader.collections), reader[1500]
+        (1, None)
+        >>> reader.refresh()
+        >>> len(reader.collections), len(reader.directory_blocks)
+        (4, 2)
+        >>> reader[1500], reader[9999]
+        (1500, 9999)
+        >>> reader[10000] = 10000
+        Traceback (most recent call last):
+        ...
+        Exception: The storage is read only
+        >>> reader.close()
+        >>> writer.close()
+
+        >>> import os
+        >>> os.remove("refresh_doctest.db")
+
+        """
+        with self.lock:
+            known = len(self.collections)
+            if self.pointers != None:
+                self.pointers = list(unpack(self.pointers_format,
+                    self.storage.read(self.pointers_address,
+                    calcsize(self.pointers_format))))
+                for address in self.pointers[known:]:
+                    if address > -1:
+                        self.collections.append(
+                            self._create_collection(address=address))
+            else:
+                block = known / self.directory_entries
+                while block < len(self.directory_blocks):
+                    values = unpack(self.directory_format, self.storage.read(
+                        self.directory_blocks[block],
+                        calcsize(self.directory_format)))
+                    first   = block * self.directory_entries
+                    entries = zip(values[1::2], values[2::2])
+                    for address, size in entries[len(self.collections) -
+                            first:]:
+                        if address > -1:
+                            self.collections.append(
+                                self._create_collection(address, size))
+                    if values[0] != -1 and \
+                            block + 1 == len(self.directory_blocks):
+                        self.directory_blocks.append(values[0])
+                    block += 1
+            for collection in self.collections[:known]:
+                collection.refresh()
+
+    def _refresh_if_changed(self):
+        """ Refreshes the collection if another container on the same file
+        has written to it through a shared PageCache since we last looked.
 
-    def _add_collection(self):
-        """ Adds an additional collection to the list of collections. """
+        """
+        changes = getattr(self.storage, "changes", 0)
+        if changes != self.changes:
+            self.changes = changes
+            self.refresh()
+
+    def _set_named(self, named):
+        """ Records the addresses of the named collections, given as a dict
+        of their names and addresses, by writing a new block of them at the
+        end of the file and pointing the superblock to it.
+
+        """
+        if self.pointers != None:
+            raise Exception("Collections without a superblock can't keep "
+                "other collections")
+        for name in named:
+            if len(name) > calcsize(self.named_format) - calcsize("q"):
+                raise Exception("The name %s is too long" % name)
+        block = "".join(pack(self.named_format, name, named[name])
+            for name in sorted(named))
+        with self.storage.operation():
+            address = -1
+            if block:
+                address = self.storage.append(block)
+            self.storage.write(self.address + self.named_offset,
+                pack("qq", address, len(named)))
+        self.named = dict(named)
+
+    def _open_indexes(self):
+        """ Opens the indexes of the collection, once the collection itself
+        is open. Only maps have indexes, see Hashmap._open_indexes.
+
+        """
+        pass
+
+    def _add_collection(self, count=None, allocation=None):
+        """ Adds an additional collection to the list of collections.
+
+        If a count is given, the collection is only added if there are still
+        count collections. Many threads can find the newest collection full
+        at the same time, and this way only one of them adds a collection.
+
+        The collection gets the allocation that the growth policy gives it,
+        see _get_allocation(), or the given allocation if that's larger.
+
+        """
+        # Allocating the collection and pointing to it happen all at once.
+        # The operation always comes before the lock, as it does everywhere
+        # else, so that threads never wait on each other in a circle.
+        with self.storage.operation(), self.lock:
+            self._refresh_if_changed()
+            if count != None and len(self.collections) != count:
+                return
+
+            # We allocate the array
+            policy = self._get_allocation(len(self.collections))
+            if allocation == None or allocation < policy:
+                allocation = policy
+            new_collection = self._create_collection(allocation=allocation)
+
+            # Point to it, either in the directory or in the pointers
+            if self.pointers == None:
+                self._add_to_directory(len(self.collections), new_collection)
+            else:
+                position = self.pointers.index(-1)
+                self.pointers[position] = new_collection.address
+                self.storage.write(self.pointers_address,
+                    pack(self.pointers_format, *self.pointers))
 
-        # Find the position of the next null pointer
-        position = self.pointers.index(-1)
+            # Add our new array to our list of arrays
+            self.collections.append(new_collection)
 
-        # We allocate the array
-        new_collection = self._create_collection()
+    def _add_to_directory(self, number, collection):
+        """ Writes the address and size of the fixed collection with the
+        given number to its entry in the directory. If the directory is
+        full, a new block is added to the end of the file first, and the
+        last block is pointed to it.
 
-        # Update our pointers and sizes
-        self.pointers[position] = new_collection.address
+        """
+        block, entry = divmod(number, self.directory_entries)
+        if block == len(self.directory_blocks):
+            address = self.storage.append(self._get_empty_block())
+            self.storage.write(self.directory_blocks[-1], pack("q", address))
+            self.directory_blocks.append(address)
+        self.storage.write(self.directory_blocks[block] + calcsize("q") +
+            entry * calcsize(self.entry_format),
+            pack(self.entry_format, collection.address, collection.size))
 
-        # Seek to the pointers
-        self.file_object.seek(self.address)
+    def _get_allocation(self, number):
+        """ Returns the allocation that the growth policy gives the fixed
+        collection with the given number. The first one has the initial
+        allocation, and each one after it is growth times as large as the
+        one before it.
 
-        # Write the pointers
-        self.file_object.write(pack(self.pointers_format, *self.pointers))
+        """
+        if number == 0:
+            return self.initial_allocation
+        if number <= len(self.collections):
+            previous = self.collections[number - 1].allocation
+        else:
+            previous = self._get_allocation(number - 1)
+        return max(1, int(previous * self.growth))
 
-        # Add our new array to our list of arrays
-        self.collections.append(new_collection)
+    def _get_reserved_allocation(self, count):
+        """ Returns the allocation a fixed collection needs to hold count
+        elements. Children that can't fill their fixed collections change
+        this.
 
-    def _create_collection(self, address=None):
+        """
+        return max(1, count)
+
+    def _get_empty_block(self):
+        """ Returns the bytes of a block of the directory with no entries. """
+        return pack(self.directory_format,
+            -1, *([-1, 0] * self.directory_entries))
+
+    def _create_collection(self, address=None, size=None, allocation=None):
         """ Creates a new fixed size collection depending upon what the child
         set self.fixed_collection to. For arrays this would be FixedArray, for
-        sets it'd be FixedSet.
+        sets it'd be FixedSet. It has room for allocation elements.
 
-        It also doubles the size of the allocation, so that the new collection
-        is twice as large as the previous one.
+        If the address is given, the fixed collection is opened instead. If
+        its size is given too, it doesn't have to be read.
 
         """
-        allocation = (2**len(self.collections)) * self.initial_allocation
+        if allocation == None:
+            allocation = self._get_allocation(len(self.collections))
         fixed = self.fixed_collection
-        return fixed(data=self.data, file_name=None, file_object=self.file_object, allocation=allocation, address=address)
+        return fixed(data=self.data, file_name=None, allocation=allocation,
+            address=address, storage=self.storage, size=size,
+            **self._get_collection_options())
+
+    def _get_flags(self):
+        """ Returns the flags to write in the header of a new collection.
+        Children that have options of their own add their flags to these.
+
+        """
+        flags = self.sparse_flag if self.sparse else 0
+        checksums = self.fixed_collection.checksums
+        if self.checksum not in checksums:
+            raise Exception("Unknown checksum: %s" % self.checksum)
+        return flags | (checksums.index(self.checksum) << self.checksum_shift)
+
+    def _load_flags(self, flags):
+        """ Sets up the collection's options from the flags in its header.
+        Collections without a header have no flags set, which is the "read"
+        checksum policy.
+
+        """
+        self.sparse   = bool(flags & self.sparse_flag)
+        checksums     = self.fixed_collection.checksums
+        number        = (flags >> self.checksum_shift) & self.checksum_mask
+        if number >= len(checksums):
+            raise Exception("Unknown checksum: %s" % number)
+        self.checksum = checksums[number]
+
+    def _get_collection_options(self):
+        """ Returns the options, besides the allocation, address and storage,
+        that the fixed collections are created with.
+
+        """
+        return {'sparse' : self.sparse, 'lazy' : self.lazy,
+            'checksum' : self.checksum}
+
+    def _get_generations(self, generations=None):
+        """ Returns a list of (number, fixed collection) pairs for the given
+        generation numbers, or for every generation if none are given. The
+        first fixed collection is generation 0, the one after it is
+        generation 1, and so on.
+
+        """
+        self._refresh_if_changed()
+        collections = list(self.collections)
+        if generations == None:
+            generations = xrange(len(collections))
+        return [(number, collections[number]) for number in generations]
+
+    def scrub(self):
+        """ Checks the checksum of every element of every fixed collection,
+        reading each of them in large sequential chunks. Returns a list of
+        (collection number, index) pairs for the elements that don't match.
+        See FixedArray.scrub.
+
+        """
+        return [(number, index)
+            for number, collection in enumerate(self.collections)
+            for index in collection.scrub()]
+
+    def _get_executor(self):
+        """ Returns the executor that carries out this collection's
+        asynchronous requests, starting it the first time it's needed.
+
+        """
+        if self.executor == None:
+            self.executor = Executor()
+        return self.executor
+
+    def flush(self):
+        """ Makes sure that everything written to this collection has been
+        handed to the operating system.
+
+        """
+        self.storage.flush()
 
     def close(self):
-        """ Closes the associated file object for this collection. """
-        self.file_object.close()
+        """ Closes the associated storage for this collection, once any
+        asynchronous requests that are still waiting have been carried out.
+
+        """
+        if self.executor != None:
+            self.executor.shutdown()
+        self.storage.close()
@@ -0,0 +1 @@
+from Persistent.Executor.executor import Executor, Future
@@ -0,0 +1,208 @@
+import threading
+from collections import deque
+
+class Future:
+    """ Future holds the result of a request made to an Executor, once the
+    request has been carried out.
+
+    Call result() to wait for the result, or add_done_callback() to be called
+    with the future once it's done. Callbacks are run on the executor's
+    thread, so code running an event loop should hand them back to the loop
+    (e.g. with the loop's call_soon_threadsafe).
+
+    """
+
+    def __init__(self):
+        """ Initializes a new future that isn't done yet. """
+        self._done      = threading.Event()
+        self._lock      = threading.Lock()
+        self._result    = None
+        self._error     = None
+        self._callbacks = []
+
+    def done(self):
+        """ Returns True once the future has a result. """
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        """ Waits for the result and returns it. If the request raised an
+        exception, that exception is raised here instead.
+
+        """
+        if not self._done.wait(timeout):
+            raise Exception("Timed out waiting for the result")
+        if self._error != None:
+            raise self._error
+        return self._result
+
+    def add_done_callback(self, callback):
+        """ Calls the callback with this future once it's done. If it's
+        already done, the callback is called right away.
+
+        """
+        with self._lock:
+            if not self.done():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def _finish(self, result=None, error=None):
+        """ Sets the result or the exception, and runs the callbacks. """
+        with self._lock:
+            self._result = result
+            self._error  = error
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+
+class Executor:
+    """ Executor carries out a container's requests on a background thread,
+    so that the caller isn't blocked on disk I/O. Every request returns a
+    Future right away.
+
+    Requests are carried out in the order they were made, so a read made
+    after a write always sees that write.
+
+    The queue of requests is bounded. Once max_pending requests are waiting,
+    new requests block until there is room again.
+
+    Two requests that would do the same work are only done once. When a
+    read is made for a key that already has a read waiting, and no write to
+    that key was made in between, the caller gets the waiting read's future.
+
+    Neighbouring requests that have a batch function are also carried out
+    together, by handing all of their arguments to the batch function in a
+    single call. For instance, the reads for many indexes of an Array are
+    turned into one call to get_many(), which reads neighbouring indexes in
+    a single read.
+
+    >>> def double_all(xs):
+    ...   return [x * 2 for x in xs]
+    >>> e = Executor()
+    >>> futures = [e.submit(lambda x: x * 2, i, batch=double_all)
+    ...   for i in xrange(5)]
+    >>> [f.result() for f in futures]
+    [0, 2, 4, 6, 8]
+
+    >>> # Waiting reads for the same key are shared, until a write is made
+    >>> go = threading.Event()
+    >>> blocker = e.submit(lambda x: go.wait(), None)
+    >>> a = e.submit(sorted, [2, 1], key="a")
+    >>> a is e.submit(sorted, [2, 1], key="a")
+    True
+    >>> w = e.submit(sorted, [], key="a", write=True)
+    >>> a is e.submit(sorted, [2, 1], key="a")
+    False
+    >>> go.set()
+    >>> a.result()
+    [1, 2]
+
+    >>> # Exceptions end up in the future
+    >>> e.submit(lambda x: 1 / x, 0).result()
+    Traceback (most recent call last):
+    ZeroDivisionError: integer division or modulo by zero
+    >>> e.shutdown()
+
+    """
+
+    def __init__(self, max_pending=1024, max_batch=256):
+        """ Initializes a new executor and starts its thread.
+
+        Max_pending is the number of requests that may be waiting, and
+        max_batch is the largest number of requests handed to a batch
+        function at once.
+
+        """
+        self.max_pending = max_pending
+        self.max_batch   = max_batch
+        self.queue       = deque()
+        self.reads       = {}
+        self.closed      = False
+        self.condition   = threading.Condition()
+        self.thread      = threading.Thread(target=self._work)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, function, argument, key=None, write=False, batch=None):
+        """ Requests that function(argument) be called, and returns a Future
+        for its result.
+
+        Key identifies what the request reads or writes, such as an index or
+        the bytes of a key. Write is True for requests that change it.
+
+        If batch is given, neighbouring requests with the same batch function
+        may be carried out as batch([argument, ...]), which must return a
+        list with a result for each argument.
+
+        """
+        with self.condition:
+            if self.closed:
+                raise Exception("The executor has been shut down")
+            if key != None:
+                if write:
+                    # Reads made from here on have to see this write
+                    self.reads.pop(key, None)
+                elif key in self.reads:
+                    return self.reads[key]
+            while len(self.queue) >= self.max_pending:
+                self.condition.wait()
+            future = Future()
+            if key != None and not write:
+                self.reads[key] = future
+            self.queue.append((future, function, argument, key, batch))
+            self.condition.notify_all()
+            return future
+
+    def _next(self):
+        """ Takes the next request off of the queue, along with any requests
+        right behind it that share its batch function. Returns None once the
+        executor has been shut down and the queue is empty.
+
+        """
+        with self.condition:
+            while not self.queue and not self.closed:
+                self.condition.wait()
+            if not self.queue:
+                return None
+            requests = [self.queue.popleft()]
+            batch    = requests[0][4]
+            while batch != None and self.queue and \
+                    self.queue[0][4] == batch and \
+                    len(requests) < self.max_batch:
+                requests.append(self.queue.popleft())
+            # Once a read has started, later reads can't share it anymore
+            for future, function, argument, key, b in requests:
+                if key != None and self.reads.get(key) is future:
+                    del self.reads[key]
+            self.condition.notify_all()
+            return requests
+
+    def _work(self):
+        """ Carries out requests until the executor is shut down. """
+        while True:
+            requests = self._next()
+            if requests == None:
+                return
+            try:
+                if len(requests) > 1:
+                    results = requests[0][4]([r[2] for r in requests])
+                else:
+                    results = [requests[0][1](requests[0][2])]
+            except Exception, error:
+                for request in requests:
+                    request[0]._finish(error=error)
+            else:
+                for request, result in zip(requests, results):
+                    request[0]._finish(result)
+
+    def shutdown(self):
+        """ Carries out the requests that are still waiting, then stops the
+        executor's thread.
+
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.thread.join()
@@ -1 +1,2 @@
-from Persistent.Hashmap.hashmap import Hashmap
+from Persistent.Hashmap.hashmap         import Hashmap
+from Persistent.Hashmap.sharded_hashmap import ShardedHashmap
@@ -1,4 +1,6 @@
-from Persistent import Hashset
+from Persistent                 import Hashset, Array
+from Persistent.Hashmap.index   import Index, get_entry_class, \
+    get_posting_class
 
 class Hashmap(Hashset):
     """ Hashmap is really a hashset, we just give it a different.
@@ -20,17 +22,239 @@ class Hashmap(Hashset):
     ...   u = m.get(User(username=str(i)))
     ...   if u.password != str(i) + "!":
     ...     print 'Failed to match %s.' % (i)
+    >>> m.close()
+
+    >>> # The same map can be reopened with the file memory mapped
+    >>> m = Hashmap(User, "hashmap_doctest.db", mmap=True)
+    >>> for i in xrange(100):
+    ...   if m[str(i)] != str(i) + "!":
+    ...     print 'Failed to match %s.' % (i)
+    >>> for i in xrange(100, 2000):
+    ...   m[str(i)] = str(i) + "?"
+    >>> for i in xrange(100, 2000):
+    ...   if m[str(i)] != str(i) + "?":
+    ...     print 'Failed to match %s.' % (i)
+    >>> m.close()
+
+    >>> # Lazy maps hand back data objects that decode values as they're used
+    >>> m = Hashmap(User, "hashmap_doctest.db", lazy=True)
+    >>> u = m.get(User(username="5"))
+    >>> u.is_decoded("password"), u.password, u.is_decoded("password")
+    (False, '5!', True)
+    >>> m.close()
     >>> import os
     >>> os.remove("hashmap_doctest.db")
 
     """
 
+    # The entries and the postings of the indexes are kept in the same file
+    # as the map, under their property's name with these in front of it
+    index_prefix    = "index."
+    postings_prefix = "postings."
+
+    # The older elements of a key hold values that have been replaced, so
+    # values() skips them by default, see Hashset.values
+    unique_values = True
+
+    def _open_indexes(self):
+        """ Opens the index of every property of the data class that has
+        index=True. See Index.
+
+        The entries of an index are a map of their own, and its postings an
+        array, kept in the same file and sharing the map's storage, so that
+        with a durability a data object and its index entries are always
+        written all at once. An index that isn't in
+        the file yet is made, and every data object that's already in the
+        map is added to it. An index whose property isn't indexed anymore is
+        forgotten, since it would go out of date. Read only maps can't do
+        either, so they only open the indexes that are in the file.
+
+        """
+        self.indexes = {}
+        names        = [name for name, prop in self.data._indexes]
+        if self.named == None:
+            if names:
+                raise Exception("Maps without a superblock can't have "
+                    "indexes")
+            return
+
+        prefixes = (self.index_prefix, self.postings_prefix)
+        named    = dict((key, address) for key, address in self.named.items()
+            if not [prefix for prefix in prefixes if key.startswith(prefix)
+                and key[len(prefix):] not in names])
+        new      = []
+        for name in names:
+            key      = self.index_prefix + name
+            if self.readonly and key not in named:
+                continue
+            entries  = Hashmap(get_entry_class(self.data, name),
+                storage=self.storage, address=named.get(key),
+                hash=self.hash, checksum=self.checksum,
+                readonly=self.readonly)
+            postings = Array(get_posting_class(self.data),
+                storage=self.storage,
+                address=named.get(self.postings_prefix + name),
+                checksum=self.checksum, readonly=self.readonly)
+            self.indexes[name] = Index(self.data, name, entries, postings)
+            if key not in named:
+                named[key] = entries.address
+                named[self.postings_prefix + name] = postings.address
+                new.append(self.indexes[name])
+        if self.readonly:
+            return
+        if named != self.named:
+            self._set_named(named)
+        if new:
+            with self.storage.operation(), self.lock:
+                for data in self.values():
+                    for index in new:
+                        index.add(getattr(data, index.name), data)
+
+    def _update_indexes(self, old, new):
+        """ Updates the indexes for a data object that was old, and is now
+        new. Old is None for a data object that wasn't in the map, and new
+        is None for one that was removed.
+
+        """
+        for name, index in self.indexes.items():
+            before = getattr(old, name) if old != None else None
+            after  = getattr(new, name) if new != None else None
+            if old != None and (new == None or after != before):
+                index.remove(before, old)
+            if new != None and (old == None or after != before):
+                index.add(after, new)
+
+    def find_by(self, name, value):
+        """ Returns a list of the data objects in the map whose property
+        with the given name has the value. The property has to have been
+        declared with index=True.
+
+        The indexes are updated by set(), update(), delete() and by
+        committing data objects that came from the map. Since they have to
+        look up the data object that's being replaced, maps with indexes
+        read before they write.
+
+        Finding the keys of the data objects with the value is a lookup in
+        the index and a single read of the run that holds them, however
+        many there are, see Index. Each data object is then looked up in the
+        map by its keys, so finding n data objects takes n lookups, one for
+        each of them. Changing a data object's value, or removing it, reads
+        the whole run of its old value.
+
+        >>> from Persistent import Data, IntegerProperty, StringProperty
+        >>> class User(Data):
+        ...   username = StringProperty(length=10, key=True)
+        ...   age      = IntegerProperty(index=True)
+        ...
+        >>> m = Hashmap(User, "hashmap_doctest.db")
+        >>> m.update(User(username=str(i), age=i % 50) for i in xrange(3000))
+        >>> sorted(int(u.username) for u in m.find_by("age", 7))[:4]
+        [7, 57, 107, 157]
+        >>> len(m.find_by("age", 7)), m.find_by("age", 50)
+        (60, [])
+
+        >>> user = m.get(User(username="7"))
+        >>> user.age = 50
+        >>> user.commit()
+        >>> m.set(User(username="57", age=50))
+        >>> m.delete(User(username="107"))
+        True
+        >>> sorted(u.username for u in m.find_by("age", 50))
+        ['57', '7']
+        >>> len(m.find_by("age", 7))
+        57
+        >>> m.close()
+
+        >>> # Indexes are kept with the map. They're forgotten when the map
+        >>> # is opened without them, and made again when they're back.
+        >>> class Plain(Data):
+        ...   username = StringProperty(length=10, key=True)
+        ...   age      = IntegerProperty()
+        ...
+        >>> m = Hashmap(Plain, "hashmap_doctest.db")
+        >>> m.named
+        {}
+        >>> m.set(Plain(username="8", age=50))
+        >>> m.close()
+        >>> m = Hashmap(User, "hashmap_doctest.db")
+        >>> sorted(u.username for u in m.find_by("age", 50))
+        ['57', '7', '8']
+        >>> m.find_by("username", "7")
+        Traceback (most recent call last):
+        ...
+        Exception: There is no index on username
+        >>> m.close()
+
+        >>> import os
+        >>> os.remove("hashmap_doctest.db")
+
+        """
+        if name not in self.indexes:
+            raise Exception("There is no index on %s" % name)
+        datas = [self.get(data) for data in self.indexes[name].find(value)]
+        return [data for data in datas if data != None]
+
     def set(self, data):
         """ Adds a data object to the hashmap. """
         # This attribute is so that the hashset knows what bytes from the
         # data are important
         data._is_map = True
-        self.add(data)
+        if not self.indexes:
+            self.add(data)
+            return
+        with self.storage.operation(), self.lock:
+            old = Hashset.get(self, data)
+            self.add(data)
+            self._update_indexes(old, data)
+
+    def commit(self, data):
+        """ Writes a data object that came from the map back to it. See
+        Data.commit.
+
+        """
+        self.set(data)
+
+    def update(self, datas):
+        """ Adds many data objects to the hashmap at once. This is much faster
+        than calling set() for each of them. See Hashset.add_many.
+
+        Just like a dict, a mapping of keys to values can be given instead,
+        if the data object has exactly one key and one property.
+
+        >>> from Persistent import Data, IntegerProperty
+        >>> class Pair(Data):
+        ...   key   = IntegerProperty(key=True)
+        ...   value = IntegerProperty()
+        ...
+        >>> m = Hashmap(Pair, "hashmap_doctest.db")
+        >>> m.update(Pair(key=i, value=i) for i in xrange(5000))
+        >>> m.update(dict((i, -i) for i in xrange(0, 5000, 2)))
+        >>> [i for i in xrange(5000) if m[i] != (-i if i % 2 == 0 else i)]
+        []
+        >>> m.close()
+
+        >>> import os
+        >>> os.remove("hashmap_doctest.db")
+
+        """
+        if hasattr(datas, 'items'):
+            datas = [self._make(key, value) for key, value in datas.items()]
+        datas = list(datas)
+        for data in datas:
+            data._is_map = True
+        if not self.indexes:
+            self.add_many(datas)
+            return
+
+        # Only the last data object for a key ends up in the map, and the
+        # indexes are updated from whatever it replaces
+        with self.storage.operation(), self.lock:
+            latest = dict((data.unload_key(), data) for data in datas)
+            old    = dict((key, Hashset.get(self, data))
+                for key, data in latest.items())
+            self.add_many(datas)
+            for key, data in latest.items():
+                self._update_indexes(old[key], data)
 
     def get(self, data, default=None):
         """ Retrieve a data object from the hashmap.
@@ -40,7 +264,186 @@ class Hashmap(Hashset):
         # This attribute is so that the hashset knows what bytes from the
         # data are important
         data._is_map = True
-        return Hashset.get(self, data, default)
+        result = Hashset.get(self, data)
+        if result == None:
+            return default
+        # Committing the data object writes it back to the map, rather than
+        # to the fixed set it came from
+        result._container = self
+        return result
+
+    def delete(self, data):
+        """ Removes the data object with the same keys as the given one from
+        the hashmap, and returns True if there was one. See Hashset.remove.
+
+        >>> from Persistent import Data, IntegerProperty
+        >>> class Pair(Data):
+        ...   key   = IntegerProperty(key=True)
+        ...   value = IntegerProperty()
+        ...
+        >>> m = Hashmap(Pair, "hashmap_doctest.db")
+        >>> m.update(Pair(key=i, value=i) for i in xrange(2000))
+        >>> m.update(Pair(key=i, value=-i) for i in xrange(5))
+        >>> m.delete(Pair(key=3)), m.delete(Pair(key=3))
+        (True, False)
+        >>> del m[1000]
+        >>> m[2], m[3], m[1000], m[1001]
+        (-2, None, None, 1001)
+        >>> m[3] = 3
+        >>> m[3]
+        3
+        >>> m.close()
+
+        >>> import os
+        >>> os.remove("hashmap_doctest.db")
+
+        """
+        data._is_map = True
+        if not self.indexes:
+            return self.remove(data)
+        with self.storage.operation(), self.lock:
+            old     = Hashset.get(self, data)
+            removed = self.remove(data)
+            self._update_indexes(old, None)
+            return removed
+
+    def __delitem__(self, key):
+        """ Removes a key value mapping from the hashmap. Like
+        __setitem__, this only works if the data object has exactly one key
+        and one property.
+
+        """
+        self.delete(self._make(key, None))
+
+    def aset(self, data):
+        """ Asynchronously adds a data object to the hashmap, and returns a
+        Future that is done once it has been added. See Hashset.aadd.
+
+        >>> from Persistent import Data, IntegerProperty
+        >>> class Pair(Data):
+        ...   key   = IntegerProperty(key=True)
+        ...   value = IntegerProperty()
+        ...
+        >>> m = Hashmap(Pair, "hashmap_doctest.db")
+        >>> sets = [m.aset(Pair(key=i % 100, value=i)) for i in xrange(1000)]
+        >>> gets = [m.aget(Pair(key=i)) for i in xrange(100)]
+        >>> [i for i in xrange(100) if gets[i].result().value != 900 + i]
+        []
+        >>> m.close()
+
+        >>> import os
+        >>> os.remove("hashmap_doctest.db")
+
+        """
+        data._is_map = True
+        return self.aadd(data)
+
+    def _add_all(self, datas):
+        """ Adds the data objects of many aset() requests at once, updating
+        the indexes too.
+
+        """
+        self.update(datas)
+        return [None] * len(datas)
+
+    def compact(self, threshold=0.05, generations=None):
+        """ Compacts the map, and its indexes, see Hashset.compact. """
+        for index in self.indexes.values():
+            index.entries.compact(threshold)
+        return Hashset.compact(self, threshold, generations)
+
+    def refresh(self):
+        """ Picks up what a writer in another process has added to the map,
+        and to its indexes, see DynamicCollection.refresh. Indexes that were
+        made after the map was opened aren't picked up.
+
+        """
+        for index in self.indexes.values():
+            index.refresh()
+        Hashset.refresh(self)
+
+    def _write_stats(self):
+        """ Writes the counts of the fixed sets of the map, and of its
+        indexes.
+
+        """
+        for index in self.indexes.values():
+            index.entries._write_stats()
+        Hashset._write_stats(self)
+
+    def aget(self, data, default=None):
+        """ Asynchronously retrieves a data object from the hashmap, and
+        returns a Future for it. See Hashset.aget.
+
+        """
+        data._is_map = True
+        return Hashset.aget(self, data, default)
+
+    def items(self, generations=None, result="data", unique=True):
+        """ Yields the key and data object of every element of the map. The
+        key is the value of the key property, or a tuple of the values of
+        the key properties if there are several of them.
+
+        The elements are read in large sequential chunks, and every key is
+        only yielded once, with its newest data object. See Hashset.values
+        for the details, and the generations, result and unique arguments.
+
+        >>> from Persistent import Data, IntegerProperty
+        >>> class Pair(Data):
+        ...   key   = IntegerProperty(key=True)
+        ...   value = IntegerProperty()
+        ...
+        >>> m = Hashmap(Pair, "hashmap_doctest.db", bloom=True)
+        >>> m.update(Pair(key=i, value=i) for i in xrange(3000))
+        >>> m.update(Pair(key=i, value=-i) for i in xrange(10))
+        >>> items = sorted(m.items())
+        >>> [p.value for k, p in items[:12]]
+        [0, -1, -2, -3, -4, -5, -6, -7, -8, -9, 10, 11]
+        >>> [k for k, p in items] == range(3000) == sorted(m)
+        True
+        >>> sorted(m.values(result="tuple"))[:2]
+        [(0, 0), (1, -1)]
+        >>> m.close()
+
+        >>> import os
+        >>> os.remove("hashmap_doctest.db")
+
+        """
+        for fixed_set, bytes in self._read_elements(generations, unique):
+            data = fixed_set._load(bytes, None, result)
+            if result == "data":
+                data._container = self
+            yield self._get_key(bytes), data
+
+    def keys(self, generations=None, unique=True):
+        """ Yields the key of every element of the map. Only the key
+        properties are deserialized. See items().
+
+        """
+        for fixed_set, bytes in self._read_elements(generations, unique):
+            yield self._get_key(bytes)
+
+    def _get_key(self, bytes):
+        """ Deserializes the key from the bytes of an element. """
+        if self.data._key_codec != None:
+            key = self.data._key_codec.unpack_tuple(bytes)
+        else:
+            data = self.data(_bytes=bytes, _lazy=True)
+            key  = tuple(getattr(data, name) for name, prop in self.data._keys)
+        if len(key) == 1:
+            return key[0]
+        return key
+
+    def _get_lookup_bytes(self, bytes):
+        """ Elements of a map are looked up by their keys, which the bytes of
+        the element start with.
+
+        """
+        return bytes[:self.data._key_size]
+
+    def __iter__(self):
+        """ Iterates over the keys of the map, like a dict. See keys(). """
+        return self.keys()
 
     def __setitem__(self, key, value):
         """ Adds a key value mapping to the hashmap.
@@ -53,13 +456,20 @@ class Hashmap(Hashset):
              instead of:
                 users.set(User(username="Steve", password="password")))
 
+        """
+        self.set(self._make(key, value))
+
+    def _make(self, key, value):
+        """ Creates a data object from a key and a value. This only works if
+        the data object has exactly one key and one property.
+
         """
         if len(self.data._keys) != 1 or len(self.data._props) != 2:
             raise Exception()
         key_name = self.data._props[0][0]
         val_name = self.data._props[1][0]
         kwargs = {key_name : key, val_name : value}
-        self.set(self.data(**kwargs))
+        return self.data(**kwargs)
 
     def __getitem__(self, key):
         """ Retrieves a key value mapping from the hashmap.
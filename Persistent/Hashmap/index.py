@@ -0,0 +1,208 @@
+from copy import copy
+from Persistent.Data.data import Data, DataType
+from Persistent.Property  import IntegerProperty
+
+class Index:
+    """ Index finds the data objects of a map by the value of one of their
+    properties, rather than by their keys.
+
+    The keys of the data objects with a value are kept next to each other,
+    in a run of elements in an array, which we call the postings. Every
+    value has an entry in a map of its own, which we call the entries, with
+    where its run starts, how many keys are in it, and how many it has room
+    for. Finding the data objects with a value is then a lookup for its
+    entry, and a single read of its run.
+
+    Runs have room for run_size keys at first. A run that fills up is moved
+    to the end of the postings, with twice as much room, so that adding a
+    key takes a constant number of writes on average. The space a run moves
+    away from, or that a value with no data objects left gives up, is never
+    used again.
+
+    When a data object's value changes, or it's removed from the map, its
+    key is found by reading the run of the old value, and the last key of
+    the run takes its place. That's a read of every key with the old value,
+    so indexes work best on properties that don't have too many data
+    objects for any one value.
+
+    You usually won't use this class directly. Hashmap keeps an index for
+    every property with index=True, see Hashmap.find_by.
+
+    >>> from cStringIO import StringIO
+    >>> from Persistent import Data, IntegerProperty, Hashmap, Array
+    >>> class User(Data):
+    ...   id  = IntegerProperty(key=True)
+    ...   age = IntegerProperty(index=True)
+    ...
+    >>> obj      = StringIO()
+    >>> entries  = Hashmap(get_entry_class(User, "age"), file_object=obj)
+    >>> postings = Array(get_posting_class(User), file_object=obj)
+    >>> index    = Index(User, "age", entries, postings)
+    >>> for i in xrange(5):
+    ...   index.add(30, User(id=i, age=30))
+    >>> index.add(31, User(id=5, age=31))
+    >>> index.remove(30, User(id=1))
+    >>> [user.id for user in index.find(30)], index.find(32)
+    ([0, 4, 2, 3], [])
+    >>> entry = entries.get(index.entry(value=30, slot=-1))
+    >>> entry.start, entry.count, entry.capacity
+    (4, 4, 8)
+
+    """
+
+    # The number of keys that a value's run has room for at first
+    run_size = 4
+
+    def __init__(self, data, name, entries, postings):
+        """ Initializes a new index.
+
+        Data is the Data class of the map, and name is the name of the
+        property that's indexed. Entries is the map that the entries are
+        kept in, and postings is the array that the runs of keys are kept
+        in. Their Data classes come from get_entry_class() and
+        get_posting_class().
+
+        """
+        self.data     = data
+        self.name     = name
+        self.entries  = entries
+        self.postings = postings
+        self.entry    = entries.data
+        self.posting  = postings.data
+
+    def _get_entry(self, value):
+        """ Returns the entry of the value, or None if no data objects have
+        it. Every entry has a slot of -1.
+
+        """
+        return self.entries.get(self.entry(value=value, slot=-1))
+
+    def _allocate(self, count):
+        """ Returns where a run with room for count keys starts, at the end
+        of the postings. The end is kept in the entry with no value and a
+        slot of -2, which no value's entry ever has.
+
+        """
+        end   = self.entries.get(self.entry(value=None, slot=-2))
+        start = end.start if end != None else 0
+        self.entries.set(self.entry(value=None, slot=-2,
+            start=start + count))
+        return start
+
+    def _get_run(self, entry, result="data"):
+        """ Returns the postings of the entry's run, with a single read. They
+        are data objects, unless result is "namedtuple", see
+        Array.get_many.
+
+        """
+        return self.postings.get_many(xrange(entry.start,
+            entry.start + entry.count), result)
+
+    def _get_keys(self, data):
+        """ Returns the keys of the data object, as they're kept in a
+        posting.
+
+        """
+        return dict(("key_" + name, getattr(data, name))
+            for name, prop in self.data._keys)
+
+    def add(self, value, data):
+        """ Adds the keys of the data object, which has the value, to the
+        end of the value's run.
+
+        """
+        entry = self._get_entry(value)
+        if entry == None:
+            entry = self.entry(value=value, slot=-1, count=0,
+                capacity=self.run_size, start=self._allocate(self.run_size))
+        elif entry.count == entry.capacity:
+            run            = self._get_run(entry)
+            entry.capacity = entry.capacity * 2
+            entry.start    = self._allocate(entry.capacity)
+            self.postings.set_many(zip(xrange(entry.start,
+                entry.start + entry.count), run))
+        self.postings[entry.start + entry.count] = self.posting(
+            **self._get_keys(data))
+        entry.count += 1
+        self.entries.set(entry)
+
+    def remove(self, value, data):
+        """ Removes the keys of the data object, which had the value, from
+        the value's run.
+
+        """
+        entry = self._get_entry(value)
+        if entry == None:
+            return
+        keys = self._get_keys(data)
+        run  = self._get_run(entry, "namedtuple")
+        for position, posting in enumerate(run):
+            if posting == None or [key for key in keys
+                    if getattr(posting, key) != keys[key]]:
+                continue
+            # The last key takes the place of the one that's removed
+            if position != entry.count - 1:
+                self.postings[entry.start + position] = self.posting(
+                    **run[-1]._asdict())
+            entry.count -= 1
+            if entry.count == 0:
+                self.entries.delete(entry)
+            else:
+                self.entries.set(entry)
+            return
+
+    def _get_data(self, posting):
+        """ Returns a data object with just the keys in the posting, which
+        can be a data object or a namedtuple.
+
+        """
+        return self.data(**dict((name, getattr(posting, "key_" + name))
+            for name, prop in self.data._keys))
+
+    def find(self, value):
+        """ Returns a list of data objects with the keys of every data object
+        that has the value. The rest of their properties aren't set.
+
+        """
+        entry = self._get_entry(value)
+        if entry == None:
+            return []
+        return [self._get_data(posting)
+            for posting in self._get_run(entry, "namedtuple")
+            if posting != None]
+
+    def refresh(self):
+        """ Picks up what a writer in another process has added to the
+        entries and the postings, see DynamicCollection.refresh.
+
+        """
+        self.entries.refresh()
+        self.postings.refresh()
+
+
+def get_entry_class(data, name):
+    """ Returns the Data class of the entries of the index on the property
+    of the data class with the given name. See Index.
+
+    """
+    namespace = {"value" : _copy_property(data._names[name], True),
+        "slot" : IntegerProperty(key=True), "start" : IntegerProperty(),
+        "count" : IntegerProperty(), "capacity" : IntegerProperty()}
+    return DataType("%sIndex" % name.capitalize(), (Data,), namespace)
+
+def get_posting_class(data):
+    """ Returns the Data class of the postings of the indexes on the data
+    class, which hold the keys of a data object. See Index.
+
+    """
+    namespace = dict(("key_" + key_name, _copy_property(prop, False))
+        for key_name, prop in data._keys)
+    return DataType("%sPosting" % data.__name__, (Data,), namespace)
+
+def _copy_property(prop, key):
+    """ Returns a copy of the property, that is or isn't a key. """
+    prop            = copy(prop)
+    prop.is_key     = key
+    prop.is_data    = not key
+    prop.is_indexed = False
+    return prop
@@ -0,0 +1,378 @@
+from zlib import crc32
+from multiprocessing import Pool
+from Persistent.Hashmap.hashmap import Hashmap
+
+class ShardedHashmap:
+    """ ShardedHashmap spreads its elements over several hashmaps, each in a
+    file of its own, which we call shards.
+
+    The shard an element goes in is picked by a hash of its key bytes, so a
+    given key always lands in the same shard. Since elements never move once
+    they've been placed, the shards never have to talk to each other. That
+    lets us put the shards on different disks, and load or look up many
+    elements at once by handing each shard to a process of its own.
+
+    The shards of a map named "users.db" are "users.db.0", "users.db.1" and
+    so on. The same number of shards has to be used every time the map is
+    opened.
+
+    The worker processes are started the first time a batch is large enough
+    to be worth handing to them, and are kept until the map is closed.
+    Batches of fewer than parallel_size data objects are worked through in
+    this process, since sending them to the workers would cost more than it
+    saves.
+
+    >>> from Persistent import Data, IntegerProperty
+    >>> class Pair(Data):
+    ...   key   = IntegerProperty(key=True)
+    ...   value = IntegerProperty()
+    ...
+    >>> m = ShardedHashmap(Pair, "sharded_doctest.db", shards=4, processes=2)
+    >>> m.update(Pair(key=i, value=i) for i in xrange(500))
+    >>> m.pool == None
+    True
+    >>> m.update(Pair(key=i, value=i) for i in xrange(500, 5000))
+    >>> [i for i in xrange(5000) if m[i] != i]
+    []
+    >>> shards = list(m.shards)
+    >>> m.update(Pair(key=i, value=-i) for i in xrange(3000))
+    >>> m.shards == shards, m[2999], m[3000]
+    (True, -2999, 3000)
+    >>> pool    = m.pool
+    >>> results = m.get_many(Pair(key=i) for i in xrange(5001))
+    >>> m.pool is pool, [p.value for p in results[2999:3001]], results[5000]
+    (True, [-2999, 3000], None)
+    >>> [p.value for p in m.get_many([Pair(key=5), Pair(key=4999)])]
+    [-5, 4999]
+    >>> m.get_many([Pair(key=5000)])
+    [None]
+    >>> p = m.get_many([Pair(key=5)])[0]
+    >>> p.value = 5
+    >>> p.commit()
+    >>> m[5]
+    5
+    >>> m[5000] = 7
+    >>> m.get(Pair(key=5000)).value
+    7
+    >>> del m[5000]
+    >>> m[5000], m[4999]
+    (None, 4999)
+    >>> m.close()
+
+    >>> # Every shard got its share of the elements
+    >>> m = ShardedHashmap(Pair, "sharded_doctest.db", shards=4, processes=0)
+    >>> [len(s.collections) > 1 for s in m.shards]
+    [True, True, True, True]
+    >>> [p.value for p in m.get_many(Pair(key=i) for i in xrange(3))]
+    [0, -1, -2]
+    >>> m.close()
+
+    >>> m = ShardedHashmap(Pair, "sharded_doctest.db", shards=4, lazy=True)
+    >>> p = m.get_many([Pair(key=6)])[0]
+    >>> p.is_decoded("value"), p.value
+    (False, -6)
+    >>> m.close()
+
+    >>> import os
+    >>> for i in xrange(4):
+    ...   os.remove("sharded_doctest.db.%s" % i)
+
+    """
+
+    # Batches of fewer data objects than this are worked through in this
+    # process
+    parallel_size = 1000
+
+    def __init__(self, data, file_name, shards=4, processes=None, **options):
+        """ Initializes a new sharded hashmap.
+
+        Data is the Data class for the elements of the map, and file_name is
+        the name that the shards' file names start with.
+
+        Shards is the number of shards to spread the elements over.
+
+        Processes is the number of processes that update() and get_many()
+        fan out to. By default there is a process for every shard. If it's 0,
+        the shards are always worked through one after the other in this
+        process.
+
+        Any other options, such as mmap, sparse, cache or durability, are
+        passed along to each shard's Hashmap. Each shard only expects its
+        share of expected_size.
+
+        """
+        options = dict(options)
+        if options.get('expected_size') != None:
+            options['expected_size'] = _get_share(options['expected_size'],
+                shards)
+        self.data      = data
+        self.file_name = file_name
+        self.processes = processes
+        self.options   = options
+        self.pool      = None
+        self.shards    = [Hashmap(data, self._get_file_name(i), **options)
+            for i in xrange(shards)]
+
+    def _get_file_name(self, number):
+        """ Returns the file name of the shard with the given number. """
+        return "%s.%s" % (self.file_name, number)
+
+    def _get_shard_number(self, data):
+        """ Returns the number of the shard that the data belongs in. We
+        don't use the hash that the sets use to place elements, so that
+        the elements of a shard are still spread evenly over its sets.
+
+        """
+        return (crc32(data.unload_key()) & 0xffffffff) % len(self.shards)
+
+    def _group(self, datas):
+        """ Splits the data objects up by their shard. Returns a list with
+        the data objects of each shard, and a list with the positions they
+        had in datas.
+
+        """
+        groups    = [[] for shard in self.shards]
+        positions = [[] for shard in self.shards]
+        for position, data in enumerate(datas):
+            number = self._get_shard_number(data)
+            groups[number].append(data)
+            positions[number].append(position)
+        return groups, positions
+
+    def _get_worker_options(self, write):
+        """ Returns the options that a worker process opens a shard with.
+
+        A page cache only lives in the process it was made in, so workers
+        never use one. Workers that only read don't need the log either, and
+        open their shard read only, so that they all share one copy of it in
+        the operating system's page cache.
+
+        """
+        options = dict(self.options)
+        options.pop('cache', None)
+        if not write:
+            options.pop('durability', None)
+            options['readonly'] = True
+        return options
+
+    def _is_parallel(self, datas):
+        """ Returns whether the batch of data objects is large enough to
+        hand to the worker processes.
+
+        """
+        return self.processes != 0 and len(datas) >= self.parallel_size
+
+    def _run_jobs(self, function, groups, write):
+        """ Hands each shard's group of data objects to the function in a
+        worker process, and returns a list of what each of them returned.
+        The pool of workers is started the first time it's needed.
+
+        The data objects are sent as bytes. The workers are forked from this
+        process, which already has the data class, so it's handed to them
+        when they start, and never has to be pickled.
+
+        """
+        if self.pool == None:
+            self.pool = Pool(self.processes or len(self.shards),
+                _start_worker, (self.data,))
+        options = self._get_worker_options(write)
+        return self.pool.map(_run_job, [(function, self._get_file_name(i),
+            options, [data.unload() for data in group])
+            for i, group in enumerate(groups)])
+
+    def set(self, data):
+        """ Adds a data object to the map. """
+        self.shards[self._get_shard_number(data)].set(data)
+
+    def get(self, data, default=None):
+        """ Retrieves a data object from the map. If the data isn't found,
+        default is returned.
+
+        """
+        return self.shards[self._get_shard_number(data)].get(data, default)
+
+    def delete(self, data):
+        """ Removes a data object from the map, and returns True if it was
+        there. See Hashmap.delete.
+
+        """
+        return self.shards[self._get_shard_number(data)].delete(data)
+
+    def reserve(self, count):
+        """ Makes room for count more elements, by making room for each
+        shard's share of them. See Hashset.reserve.
+
+        """
+        for shard in self.shards:
+            shard.reserve(_get_share(count, len(self.shards)))
+
+    def find_by(self, name, value):
+        """ Returns a list of the data objects whose property with the given
+        name has the value, from the index of every shard. See
+        Hashmap.find_by.
+
+        """
+        return [data for shard in self.shards
+            for data in shard.find_by(name, value)]
+
+    def update(self, datas):
+        """ Adds many data objects to the map at once.
+
+        The data objects are split up by their shard, and every shard adds
+        its share with Hashmap.update, in a worker process of its own.
+
+        """
+        datas             = list(datas)
+        groups, positions = self._group(datas)
+        if not self._is_parallel(datas):
+            for shard, group in zip(self.shards, groups):
+                shard.update(group)
+            return
+
+        # The workers write to the shards' files themselves, so everything
+        # we've written has to be in them first. Afterwards, our shards
+        # forget what they knew about their files, and read what the workers
+        # wrote.
+        self.flush()
+        try:
+            self._run_jobs(_update_shard, groups, True)
+        finally:
+            for shard in self.shards:
+                shard.storage.reload()
+                shard.refresh()
+
+    def get_many(self, datas, default=None):
+        """ Retrieves many data objects from the map at once, and returns a
+        list of them in the same order. Data objects that aren't found are
+        default in the list.
+
+        Just like update(), every shard looks up its share in a worker
+        process of its own.
+
+        """
+        datas             = list(datas)
+        groups, positions = self._group(datas)
+        if not self._is_parallel(datas):
+            results = [[shard.get(data) for data in group]
+                for shard, group in zip(self.shards, groups)]
+        else:
+            # Anything we've written has to be in the files before the
+            # workers read them
+            self.flush()
+            results = self._run_jobs(_get_shard_bytes, groups, False)
+            # The objects belong to their shard, just like the ones that
+            # Hashmap.get returns, so that committing them works
+            results = [[shard.data(shard, bytes, _lazy=shard.lazy)
+                if bytes != None else None for bytes in shard_results]
+                for shard, shard_results in zip(self.shards, results)]
+
+        found = [default] * len(datas)
+        for shard_positions, shard_results in zip(positions, results):
+            for position, result in zip(shard_positions, shard_results):
+                if result != None:
+                    found[position] = result
+        return found
+
+    def __setitem__(self, key, value):
+        """ Adds a key value mapping to the map. See Hashmap.__setitem__. """
+        self.set(self.shards[0]._make(key, value))
+
+    def __getitem__(self, key):
+        """ Retrieves a key value mapping from the map. See
+        Hashmap.__getitem__.
+
+        """
+        data = self.shards[0]._make(key, None)
+        return self.shards[self._get_shard_number(data)][key]
+
+    def __delitem__(self, key):
+        """ Removes a key value mapping from the map. See
+        Hashmap.__delitem__.
+
+        """
+        self.delete(self.shards[0]._make(key, None))
+
+    def __contains__(self, data):
+        """ Checks if the data object is in the map. """
+        return self.get(data) != None
+
+    def refresh(self):
+        """ Picks up what a writer in another process has added to every
+        shard. See DynamicCollection.refresh.
+
+        """
+        for shard in self.shards:
+            shard.refresh()
+
+    def flush(self):
+        """ Makes sure that everything written to the map has been handed to
+        the operating system.
+
+        """
+        for shard in self.shards:
+            shard.flush()
+
+    def close(self):
+        """ Stops the worker processes, and closes every shard. """
+        if self.pool != None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+        for shard in self.shards:
+            shard.close()
+
+
+def _get_share(count, shards):
+    """ Returns the number of the count elements that each of the shards
+    gets, rounded up.
+
+    """
+    return (count + shards - 1) / shards
+
+
+# What a worker process keeps between jobs. The data class is handed to it
+# when it starts, and the shards it reads from are kept open, read only, so
+# that they don't have to be opened for every job.
+_worker = {}
+
+def _start_worker(data):
+    """ Sets up a worker process for the data class. """
+    _worker['data']   = data
+    _worker['shards'] = {}
+
+def _run_job(job):
+    """ Runs a (function, file name, options, bytes) job in a worker process.
+    The function is handed the data objects the bytes are from.
+
+    """
+    function, file_name, options, records = job
+    data = _worker['data']
+    return function(file_name, options,
+        [data(_bytes=bytes) for bytes in records])
+
+def _update_shard(file_name, options, datas):
+    """ Adds the data objects to the shard in the given file. The shard is
+    opened for every update, so that its log and its counts are handed back
+    to the map once it's done.
+
+    """
+    shard = Hashmap(_worker['data'], file_name, **options)
+    shard.update(datas)
+    shard.close()
+
+def _get_shard_bytes(file_name, options, datas):
+    """ Looks up the data objects in the shard in the given file, and returns
+    the bytes of each of them, or None if they weren't found. The shard is
+    refreshed first, to pick up what has been written since the last job.
+
+    """
+    shard = _worker['shards'].get(file_name)
+    if shard == None:
+        shard = _worker['shards'][file_name] = Hashmap(_worker['data'],
+            file_name, **options)
+    else:
+        shard.storage.reload()
+        shard.refresh()
+    results = [shard.get(element) for element in datas]
+    return [result.unload() if result != None else None
+        for result in results]
@@ -1,5 +1,5 @@
-from struct import calcsize
-from hashlib import md5
+from struct import pack, unpack, calcsize
+from Persistent.Hashset.hashes import hashes
 from Persistent.Array.fixed_array import FixedArray
 
 class FixedSet(FixedArray):
@@ -44,8 +44,32 @@ class FixedSet(FixedArray):
 
     """
 
+    # When adding many elements at once, probe windows that are closer than
+    # this many bytes to each other are read together
+    coalesce_size = 64 * 1024
+
+    # Bloom filters have this many bits for every element, and each element
+    # sets this many of them. That's about one false positive in a hundred.
+    filter_bits   = 10
+    filter_hashes = 7
+
+    # Removed elements are replaced by a tombstone, a cell of these bytes.
+    # The bytes of an element start with the byte that says whether its
+    # first property is set, which is 0 or 1, so no element looks like one.
+    tombstone_byte = chr(254)
+
+    # The number of live elements and tombstones in the set, and its
+    # displacement, kept after the elements and the filter
+    stats_format  = "qqq"
+
+    # Lookups read this many elements of a probe window first, and only read
+    # the rest of it if they have to
+    probe_step    = 8
+
     def __init__(self, data, file_name, file_object=None, allocation=1024,
-            probe_size=75, address=None):
+            probe_size=75, address=None, storage=None, mmap=False,
+            sparse=False, cache=None, bloom=False, hash="md5_64", lazy=False,
+            checksum="read", stats=False, size=None, readonly=False):
         """ Initializes a new fixed set.
 
         Data is the Data class for the elements of the set.
@@ -77,14 +101,98 @@ class FixedSet(FixedArray):
         then the allocation argument is ignored (because it implies that the
         array has already been allocated),
 
+        The storage, mmap, sparse, cache, lazy, checksum and size arguments
+        are passed along to FixedArray. Since elements without checksums are
+        hashed without them too, a set with the "off" policy places its
+        elements differently.
+
+        If bloom is True, the set keeps a Bloom filter of its elements right
+        after them in the file. The filter is held in memory, and lets get()
+        answer for most elements that aren't in the set without reading
+        anything. Just like sparse, the same value has to be passed in every
+        time the set is opened.
+
+        >>> from cStringIO import StringIO
+        >>> from Persistent import Data, IntegerProperty
+        >>> class Integer(Data):
+        ...   value = IntegerProperty()
+        ...
+        >>> obj = StringIO()
+        >>> s = FixedSet(Integer, None, file_object=obj, bloom=True)
+        >>> [s.set(Integer(value=i)) for i in xrange(3)]
+        [True, True, True]
+        >>> s = FixedSet(Integer, None, file_object=obj, address=0, bloom=True)
+        >>> [s.get(Integer(value=i)) != None for i in xrange(4)]
+        [True, True, True, False]
+        >>> len(s.filter)
+        1280
+
+        Hash is the name of the hash function that places the elements, one
+        of the names in Persistent.Hashset.hashes. It also has to be the same
+        every time the set is opened.
+
+        If stats is True, the number of live elements and tombstones in the
+        set are kept on disk, after the filter. They're counted in memory,
+        and written by write_stats(), and they're only read the first time
+        they're used. Without them, the counts start at 0 every time the set
+        is opened. Just like bloom, the same value has to be passed in every
+        time the set is opened.
+
+        The displacement is kept along with the counts. It's the furthest
+        any element has been put from the start of its probe window, in
+        elements, so lookups never have to read past it. Sets that don't
+        keep it have to assume that elements are anywhere in the window.
+
+        Readonly works the same way as it does for FixedArray.
+
         """
+        if hash not in hashes:
+            raise Exception("Unknown hash: %s" % hash)
+        self.stats         = stats
+        self.bloom         = bloom
+        self.hash          = hash
+        self.hash_function = hashes[hash]
         FixedArray.__init__(self, data, file_name, file_object, allocation,
-            address)
-        allocation      = self.size/self.data._size
+            address, storage, mmap, sparse, cache, lazy, checksum, size,
+            readonly)
+        allocation      = self.size/self.record_size
         self.probe_size = min(allocation, probe_size)
-        self.empty_cell = chr(255) * self.data._size
         self.range      = allocation - self.probe_size + 1
-        # TODO Write all construction information to disk
+        self.tombstone_cell = self.tombstone_byte * self.record_size
+        stats_address   = self.address + self.long_sz + self.size
+        if self.bloom:
+            self.filter_address = stats_address
+            stats_address += self._get_filter_size()
+        else:
+            self.filter = None
+        self.dirty      = False
+        self.placed     = 0
+        self.compacting = 0
+        # The probe size and the rest of what the set was created with are
+        # kept by the Hashset that it belongs to
+        if self.stats:
+            self.stats_address = stats_address
+        else:
+            self.live         = 0
+            self.tombstones   = 0
+            self.displacement = self.probe_size - 1
+
+    def __getattr__(self, name):
+        """ Reads the filter, and the counts and the displacement, the first
+        time they're used, so that opening a set doesn't read anything.
+
+        """
+        if name not in ("filter", "live", "tombstones", "displacement"):
+            raise AttributeError(name)
+        with self.lock:
+            if name == "filter" and name not in self.__dict__:
+                self.filter = bytearray(self.storage.read(self.filter_address,
+                    self._get_filter_size()))
+            elif name not in self.__dict__:
+                self.live, self.tombstones, self.displacement = unpack(
+                    self.stats_format, self.storage.read(self.stats_address,
+                    calcsize(self.stats_format)))
+        return self.__dict__[name]
 
     def _get_bytes_address_raw(self, data):
         """ This is a helper function that consolidates some of the common
@@ -120,7 +228,7 @@ class FixedSet(FixedArray):
         >>> bytes
         '\\x01\\x05\\x00\\x00\\x00Steve\\x01\\x08\\x00\\x00\\x00password\\xba\\xa8\\xf4/'
         >>> address
-        3491L
+        20663
         >>> raw == bytes + '\\xff' * 1998
         True
 
@@ -132,7 +240,7 @@ class FixedSet(FixedArray):
         >>> key_bytes
         '\\x01\\x05\\x00\\x00\\x00Steve'
         >>> address
-        24794L
+        16721L
         >>> raw == bytes + '\\xff' * 1998
         True
 
@@ -140,37 +248,55 @@ class FixedSet(FixedArray):
         >>> os.remove("fixedset_doctest.db")
 
         """
-        if getattr(data, '_is_map', False):
-            bytes = data.unload_key()
-        else:
-            bytes = data.unload()
+        bytes        = self._get_bytes(data)
         address, raw = self._get_address_and_probe_bytes(bytes)
         return bytes, address, raw
 
-    def _get_address_and_probe_bytes(self, bytes):
+    def _get_bytes(self, data):
+        """ Returns the bytes of the data object that the set looks for. For
+        a map, that's just the bytes of the keys.
+
+        """
+        if getattr(data, '_is_map', False):
+            return data.unload_key()
+        return self._unload(data)
+
+    def _get_address_and_probe_bytes(self, bytes, hash=None, count=None):
         """ Given a series of bytes, this will return the address associated
         with these bytes, as well as the bytes that should be probed at this
         given adddress.
 
+        By default the whole probe window is read. If count is given, only
+        the first count elements of it are.
+
         """
-        address = self._get_address(bytes)
-        self.file_object.seek(address)
-        return (address,
-            self.file_object.read(self.data._size * self.probe_size))
+        if count == None:
+            count = self.probe_size
+        address = self._get_address(bytes, hash)
+        return (address, self.storage.read(address, self.record_size * count))
 
-    def _get_address(self, bytes):
+    def _get_hash(self, bytes):
+        """ Returns the hash of the bytes, as a long. """
+        return self.hash_function(bytes)
+
+    def _get_address(self, bytes, hash=None):
         """ Given a series of bytes, we hash them and mod them according to
         the range of the given fixed set. From this, we return the address
         that these bytes should be present at.
 
+        If the hash of the bytes is already known, it can be passed in.
+
         """
+        if hash == None:
+            hash = self._get_hash(bytes)
+
         # First we calculate what "slot" these bytes fall in. In an array,
         # this would be the index of the element.
-        slot = int(md5(bytes).hexdigest(), 16) % self.range
+        slot = self._get_slot(hash)
 
         # Once we have the "slot", we convert that to the number of bytes
         # from the start of the set.
-        offset = slot * self.data._size
+        offset = slot * self.record_size
 
         # Finally, once we have the offset, we prepend long_sz to account
         # for the first few bytes which represent the size of the underlying
@@ -178,53 +304,601 @@ class FixedSet(FixedArray):
         # address in the file at which these bytes are present.
         return self.address + self.long_sz + offset
 
+    def _get_slot(self, hash):
+        """ Returns the index of the first element of the probe window for
+        the hash.
+
+        """
+        return hash % self.range
+
     def set(self, data):
         """ Adds an element to the set. """
-        # We get the data bytes, the address of this element and the raw bytes
-        # to probe
-        bytes, address, raw = self._get_bytes_address_raw(data)
-
-        # We search for "bytes" to see if this object already exists in the
-        # set. If it isn't found, then we just find the first empty cell and
-        # store the object there.
-        for b in [bytes, self.empty_cell]:
-            index = self._find_by_bytes(b, raw)
-            if index != None:
-                self.file_object.seek(address + index)
-                self.file_object.write(data.unload())
-                return True
-        return False
+        with self.lock:
+            # We get the data bytes, the address of this element and the raw
+            # bytes to probe
+            bytes        = self._get_bytes(data)
+            hash         = self._get_hash(bytes)
+            address, raw = self._get_address_and_probe_bytes(bytes, hash)
+
+            # We look for "bytes" to see if this object already exists in
+            # the set. If it isn't found, then we store the object in the
+            # first empty cell. If the filter says the object isn't here,
+            # there's no need to look for it.
+            if self.filter != None and not self._filter_contains(hash):
+                bytes = None
+            match, free = self._scan(bytes, raw)
+            index = match if match != None else free
+            if index == None:
+                return False
+
+            # The filter is updated first. If we crash in between, it claims
+            # an element that isn't there, which is fine, rather than missing
+            # one that is.
+            if self.filter != None:
+                self._add_to_filter([hash])
+            self._place(index)
+            if match == None:
+                self._count_added(raw, index)
+            self.storage.write(address + index, self._unload(data))
+            return True
+
+    def _place(self, index):
+        """ Records that an element is about to be put index bytes into its
+        probe window. If that's further than any element has been put
+        before, the new displacement is written right away, before the
+        element is, so that lookups never stop short of it.
+
+        """
+        cells = index / self.record_size
+        self.placed = max(self.placed, cells)
+        if cells > self.displacement:
+            self.displacement = cells
+            self.dirty        = True
+            self.write_stats()
+
+    def _count_added(self, raw, index):
+        """ Counts an element that is about to be added to the cell at index
+        in raw, which is either empty or a tombstone.
+
+        """
+        self.live += 1
+        if raw[index : index + self.record_size] == self.tombstone_cell:
+            self.tombstones -= 1
+        self.dirty = True
+
+    def remove(self, data):
+        """ Removes an element from the set, by replacing it with a
+        tombstone. Returns True if it was in the set. The filter can't
+        forget elements, so it still claims that the element might be here.
+
+        Later elements for the same probe window can be put where the
+        tombstone is. Until then, lookups have to look past it, which
+        compact() takes care of.
+
+        >>> from cStringIO import StringIO
+        >>> from Persistent import Data, IntegerProperty
+        >>> class Integer(Data):
+        ...   value = IntegerProperty()
+        ...
+        >>> s = FixedSet(Integer, None, file_object=StringIO(), stats=True)
+        >>> [s.set(Integer(value=i)) for i in xrange(3)]
+        [True, True, True]
+        >>> s.remove(Integer(value=1)), s.remove(Integer(value=1))
+        (True, False)
+        >>> s.get(Integer(value=1)), s.get(Integer(value=2)).value
+        (None, 2)
+        >>> s.live, s.tombstones
+        (2, 1)
+
+        """
+        with self.lock:
+            bytes = self._get_bytes(data)
+            hash  = self._get_hash(bytes)
+            if self.filter != None and not self._filter_contains(hash):
+                return False
+            address, raw, index = self._probe(bytes, hash)
+            if index == None:
+                return False
+            self.storage.write(address + index, self.tombstone_cell)
+            self.live       -= 1
+            self.tombstones += 1
+            self.dirty       = True
+            return True
+
+    def refresh(self):
+        """ Forgets the filter, the counts and the displacement, if they're
+        kept on disk, so that they're read again the next time they're used.
+        Elements that a writer in another process has added since they were
+        read could be outside of the displacement, or missing from the
+        filter. See DynamicCollection.refresh.
+
+        """
+        with self.lock:
+            names = []
+            if self.bloom:
+                names.append("filter")
+            if self.stats:
+                names.extend(["live", "tombstones", "displacement"])
+            for name in names:
+                self.__dict__.pop(name, None)
+
+    def write_stats(self):
+        """ Writes the number of live elements and tombstones, and the
+        displacement, to disk, if the set keeps them and they've changed.
+
+        """
+        with self.lock:
+            if self.stats and self.dirty:
+                self.storage.write(self.stats_address,
+                    pack(self.stats_format, self.live, self.tombstones,
+                    self.displacement))
+            self.dirty = False
+
+    def compact(self, lookup=None):
+        """ Rewrites the set in place without its tombstones, so that probe
+        windows are as short as they can be again.
+
+        Elements are moved back into the first free cell of their probe
+        window, in the order they're in, which is where they'd be if the
+        removed elements had never been added. That only ever moves an
+        element back, and never by more than the probe size, so the set is
+        rewritten a chunk at a time in a single sequential pass, and every
+        chunk is read and written in one go. Until no later element can
+        move into a free cell, it's kept as a tombstone, so that lookups
+        that run while the set is compacted still find every element.
+
+        Since elements only move back, the displacement can only shrink. It
+        is worked out again from where the elements end up, along with any
+        elements that were added while we went.
+
+        Lookup turns the bytes of an element into the bytes that it was
+        hashed by. For a map, that's the bytes of its keys. By default it's
+        all of them.
+
+        >>> from cStringIO import StringIO
+        >>> from Persistent import Data, IntegerProperty
+        >>> class Integer(Data):
+        ...   value = IntegerProperty()
+        ...
+        >>> s = FixedSet(Integer, None, file_object=StringIO(), stats=True,
+        ...   allocation=1000, probe_size=20)
+        >>> s.chunk_size = 90
+        >>> left = s.set_many([Integer(value=i) for i in xrange(1000)])
+        >>> ints = [i for i in xrange(1000) if s.get(Integer(value=i))]
+        >>> len(ints) == s.live
+        True
+        >>> removed = [s.remove(Integer(value=i)) for i in ints[::2]]
+        >>> before = s.displacement
+        >>> s.compact()
+        >>> s.live == len(ints[1::2]), s.tombstones
+        (True, 0)
+        >>> [i for i in ints[1::2] if s.get(Integer(value=i)) == None]
+        []
+        >>> s.tombstone_cell in s.storage.read(0, 10000)
+        False
+        >>> s.displacement < before
+        True
+
+        """
+        if lookup == None:
+            lookup = lambda bytes: bytes
+        size  = self.record_size
+        probe = self.probe_size
+        chunk = max(1, self.chunk_size / size)
+        first = self.address + self.long_sz
+        live  = 0
+        reach = 0
+        # Elements added from here on are counted in placed. While we go,
+        # lookups read all of their probe window at once, since elements can
+        # move back into a part that they've already read.
+        with self.lock:
+            self.placed      = 0
+            self.compacting += 1
+        for start in xrange(0, self.allocation, chunk):
+            stop = min(start + chunk, self.allocation)
+            # The last few cells before the chunk are read again, since
+            # elements in the chunk can still move back into them, and the
+            # free ones still have to be left empty once they can't
+            base = max(0, start - probe)
+            with self.storage.operation(), self.lock:
+                raw  = bytearray(self.storage.read(first + base * size,
+                    (stop - base) * size))
+                cell = lambda index: raw[(index - base) * size :
+                    (index - base + 1) * size]
+                free = [index for index in xrange(base, start)
+                    if cell(index) in (self.empty_cell, self.tombstone_cell)]
+                for index in xrange(start, stop):
+                    # No element from here on can move back into cells this
+                    # far back, so the free ones are left empty
+                    while free and free[0] <= index - probe:
+                        self._set_cell(raw, free.pop(0) - base,
+                            self.empty_cell)
+                    bytes = str(cell(index))
+                    if bytes != self.empty_cell and \
+                            bytes != self.tombstone_cell:
+                        live += 1
+                        slot  = self._get_slot(self._get_hash(lookup(bytes)))
+                        moves = [i for i in free if i >= slot]
+                        if not moves:
+                            reach = max(reach, index - slot)
+                            continue
+                        reach = max(reach, moves[0] - slot)
+                        free.remove(moves[0])
+                        self._set_cell(raw, moves[0] - base, bytes)
+                    self._set_cell(raw, index - base, self.tombstone_cell)
+                    free.append(index)
+                if stop == self.allocation:
+                    for index in free:
+                        self._set_cell(raw, index - base, self.empty_cell)
+                self.storage.write(first + base * size, str(raw))
+        with self.lock:
+            self.live          = live
+            self.tombstones    = 0
+            self.displacement  = max(reach, self.placed)
+            self.compacting   -= 1
+            self.dirty         = True
+        self.write_stats()
+
+    def _set_cell(self, raw, index, bytes):
+        """ Sets the cell at index in raw to the bytes. """
+        raw[index * self.record_size : (index + 1) * self.record_size] = bytes
+
+    def set_many(self, datas):
+        """ Adds many elements to the set at once, and returns a list of the
+        elements that didn't fit, in the order they were given.
+
+        Rather than seeking to a random address for every element, we work
+        out the address of every element up front and sort them. Probe
+        windows that overlap, or are close enough to each other, are read in
+        a single read. Each element is then placed in memory, and the
+        changed elements are written back in address order, with neighbouring
+        elements written together. Loading a batch of elements then looks a
+        lot more like sequential I/O than random I/O.
+
+        >>> from cStringIO import StringIO
+        >>> from Persistent import Data, IntegerProperty
+        >>> class Pair(Data):
+        ...   key   = IntegerProperty(key=True)
+        ...   value = IntegerProperty()
+        ...
+        >>> s = FixedSet(Pair, None, file_object=StringIO(), allocation=100,
+        ...   probe_size=5)
+        >>> pairs = [Pair(key=i, value=i) for i in xrange(100)]
+        >>> for p in pairs:
+        ...   p._is_map = True
+        >>> left = s.set_many(pairs)
+        >>> 0 < len(left) < 100
+        True
+        >>> [p.key for p in pairs if (s.get(p) == None) != (p in left)]
+        []
+        >>> left == [p for p in pairs if p in left]
+        True
+
+        >>> # Later elements for the same key win, like they do with set()
+        >>> p = Pair(key=1000, value=2)
+        >>> p._is_map = True
+        >>> q = Pair(key=1000, value=3)
+        >>> q._is_map = True
+        >>> s = FixedSet(Pair, None, file_object=StringIO())
+        >>> s.set_many([p, q])
+        []
+        >>> s.get(p).value
+        3
+
+        """
+        size   = self.record_size
+        window = size * self.probe_size
+
+        # Work out the bytes and address of every element, sorted by
+        # address. The sort is stable, so elements with the same bytes stay
+        # in the order they were given.
+        elements = []
+        for position, data in enumerate(datas):
+            bytes = self._get_bytes(data)
+            hash  = self._get_hash(bytes)
+            elements.append((self._get_address(bytes, hash), bytes, data,
+                position, hash))
+        elements.sort(key=lambda element: element[0])
+
+        # Group the elements into regions of the file that we read at once
+        regions = []
+        for element in elements:
+            address = element[0]
+            if regions and address <= regions[-1][1] + self.coalesce_size:
+                regions[-1][1] = address + window
+                regions[-1][2].append(element)
+            else:
+                regions.append([address, address + window, [element]])
+
+        with self.storage.operation(), self.lock:
+            left_over = self._set_regions(regions)
+        left_over.sort()
+        return [data for position, data in left_over]
+
+    def _set_regions(self, regions):
+        """ Places the elements of each region for set_many(), and returns
+        the (position, element) pairs of the elements that didn't fit.
+
+        """
+        size      = self.record_size
+        window    = size * self.probe_size
+        left_over = []
+        for start, stop, region_elements in regions:
+            raw    = bytearray(self.storage.read(start, stop - start))
+            dirty  = set()
+            hashes = []
+            for address, bytes, data, position, hash in region_elements:
+                offset      = address - start
+                match, free = self._scan(bytes, raw, offset, offset + window)
+                index       = match if match != None else free
+                if index == None:
+                    left_over.append((position, data))
+                    continue
+                self._place(index)
+                index += offset
+                if match == None:
+                    self._count_added(raw, index)
+                raw[index : index + size] = self._unload(data)
+                dirty.add(index)
+                hashes.append(hash)
+            if self.filter != None:
+                self._add_to_filter(hashes)
+
+            # Write the changed elements back, in order, joining elements
+            # that sit next to each other into a single write.
+            run_start = run_stop = None
+            for index in sorted(dirty):
+                if index != run_stop:
+                    if run_start != None:
+                        self.storage.write(start + run_start,
+                            str(raw[run_start : run_stop]))
+                    run_start = index
+                run_stop = index + size
+            if run_start != None:
+                self.storage.write(start + run_start,
+                    str(raw[run_start : run_stop]))
+        return left_over
 
     def get(self, data):
         """ Gets an element from the set. """
-        # We get the data bytes, the address of this element and the raw bytes
-        # to probe
-        bytes, address, raw = self._get_bytes_address_raw(data)
+        # If we find the element, we return a new data object created from
+        # its bytes.
+        bytes = self._get_raw(self._get_bytes(data))
+        if bytes != None:
+            return self.data(self, bytes, _lazy=self.lazy,
+                _verify=self._should_verify())
+        return None
 
-        # If we find the bytes in our probe, we return a new data object
-        # created from those bytes.
-        index = self._find_by_bytes(bytes, raw)
+    def _get_raw(self, bytes):
+        """ Returns the bytes of the element that starts with the given
+        bytes, or None if there isn't one in the set.
+
+        """
+        # If the filter says the element isn't here, we don't read anything
+        hash = None
+        if self.filter != None:
+            hash = self._get_hash(bytes)
+            if not self._filter_contains(hash):
+                return None
+
+        address, raw, index = self._probe(bytes, hash)
         if index != None:
-            return self.data(self, raw[index : index + self.data._size])
+            return raw[index : index + self.record_size]
         return None
 
-    def _find_by_bytes(self, data_bytes, lookup_bytes):
-        """ Returns the first occurence of data_bytes in lookup_bytes.
+    def _probe(self, bytes, hash=None):
+        """ Looks for the element that starts with the given bytes. Returns
+        the address of its probe window, the bytes that were read from it,
+        and the index of the element in them, or None if it isn't there.
+
+        No element is further into its window than the displacement, so we
+        never read past it. Most elements are at the very start of their
+        window, so we first read probe_step elements, and only read the rest
+        if neither the element nor an empty element was in them. While the
+        set is compacted, we read it all at once instead.
+
+        >>> from cStringIO import StringIO
+        >>> from Persistent import Data, IntegerProperty
+        >>> class Integer(Data):
+        ...   value = IntegerProperty()
+        ...
+        >>> s = FixedSet(Integer, None, file_object=StringIO(), stats=True,
+        ...   allocation=1000, probe_size=20)
+        >>> s.set(Integer(value=1)), s.displacement
+        (True, 0)
+        >>> address, raw, index = s._probe(Integer(value=1).unload())
+        >>> len(raw) / s.record_size, index
+        (1, 0)
+
+        >>> # As the set fills up, elements are put further along
+        >>> left = s.set_many([Integer(value=i) for i in xrange(1000)])
+        >>> 0 < s.displacement < s.probe_size
+        True
+        >>> ints = [i for i in xrange(1000) if s.get(Integer(value=i))]
+        >>> len(ints) == s.live
+        True
+        >>> s.probe_step < s.displacement + 1
+        True
+        >>> reads = [s._probe(Integer(value=i).unload())[1] for i in ints]
+        >>> sizes = set(len(raw) / s.record_size for raw in reads)
+        >>> sorted(sizes) == [s.probe_step, s.displacement + 1]
+        True
+
+        """
+        reach = self.displacement + 1
+        count = reach
+        if not self.compacting:
+            count = min(reach, self.probe_step)
+        address, raw = self._get_address_and_probe_bytes(bytes, hash, count)
+        match, empty = self._scan(bytes, raw, free=False)
+        if match == None and empty == None and count < reach:
+            raw  += self.storage.read(address + len(raw),
+                (reach - count) * self.record_size)
+            match = self._scan(bytes, raw, free=False)[0]
+        return address, raw, match
+
+    def _scan(self, data_bytes, lookup_bytes, start=0, end=None, free=True):
+        """ Scans the elements in lookup_bytes[start:end] for data_bytes, and
+        returns a tuple of the index of the element that starts with them,
+        and the index of the first free element, which is where a new
+        element would go. Either is None if there isn't one. The indexes are
+        relative to start. If data_bytes is None, we only look for the first
+        free element.
+
+        Elements are always put in the first free element of their probe
+        window, and removed elements leave a tombstone behind rather than
+        an empty element, so an element can never come after an empty
+        element. That means we only have to look for data_bytes up to the
+        first empty element, which is where most of the elements that
+        aren't in the set would have been. The first free element is the
+        first tombstone before that, if there is one, or else the empty
+        element. Tombstones are only looked for if data_bytes wasn't found,
+        and free is True. Lookups that don't add anything don't need them.
+
+        The window is walked a whole element at a time, in a single pass,
+        comparing the bytes at the start of each element. Bytes that match
+        somewhere in the middle of an element are never looked at, so they
+        can't be mistaken for a match, and the walk stops at the first
+        match or the first empty element, whichever comes first. The index
+        of the free element isn't looked for once there's a match.
+
+        >>> from cStringIO import StringIO
+        >>> from Persistent import Data, IntegerProperty
+        >>> class Integer(Data):
+        ...   value = IntegerProperty()
+        ...
+        >>> s = FixedSet(Integer, None, file_object=StringIO())
+        >>> one, two = Integer(value=1).unload(), Integer(value=2).unload()
+        >>> empty = s.empty_cell
+        >>> s._scan(one, two + one + empty + one)
+        (9, None)
+        >>> s._scan(one, two + two + empty + one)
+        (None, 18)
+        >>> s._scan(one, two + two)
+        (None, None)
+        >>> s._scan(None, one + empty)
+        (None, 9)
+        >>> s._scan(one, one + empty), s._scan(one, empty + one)
+        ((0, None), (None, 0))
+
+        >>> # Matches that aren't on the boundary of an element don't count,
+        >>> # even when they come before the element that does match
+        >>> misaligned = "\\x00" + one[:-1]
+        >>> misaligned.find(one[:5]), len(misaligned) == s.record_size
+        (1, True)
+        >>> s._scan(one[:5], misaligned + one + empty)
+        (9, None)
+        >>> s._scan(one[:5], misaligned + empty + one)
+        (None, 9)
+        >>> s._scan(one[:5], "?" + misaligned + one, 1)
+        (9, None)
+
+        >>> # Tombstones are looked past, and reused
+        >>> s._scan(one, two + s.tombstone_cell + one + empty)
+        (18, None)
+        >>> s._scan(two, one + s.tombstone_cell + empty + two)
+        (None, 9)
+
+        """
+        if end == None:
+            end = len(lookup_bytes)
+        size      = self.record_size
+        empty     = self.empty_cell
+        tombstone = self.tombstone_cell
+        # Without tombstones, we can skip looking for them. Sets that don't
+        # keep their counts might have some, even though they've counted
+        # none since they were opened.
+        tombstones = free and (self.tombstones > 0 or not self.stats)
+        first_tombstone = None
+        startswith      = lookup_bytes.startswith
+        for index in xrange(start, end, size):
+            if data_bytes != None and startswith(data_bytes, index, end):
+                return index - start, None
+            if startswith(empty, index, end):
+                if first_tombstone != None:
+                    return None, first_tombstone
+                return None, index - start
+            if tombstones and first_tombstone == None and \
+                    startswith(tombstone, index, end):
+                first_tombstone = index - start
+        return None, first_tombstone
+
+    def _read_elements(self):
+        """ Yields the index and bytes of every element in the set, skipping
+        tombstones. See FixedArray._read_elements.
 
-        This ensures that the returned index is on the boundary of a data
-        object.
+        """
+        for index, bytes in FixedArray._read_elements(self):
+            if bytes != self.tombstone_cell:
+                yield index, bytes
 
-        Simply returning lokoup_bytes.find(data_bytes) might return an index
-        that falls in the middle of an element depending upon the bytes you're
-        searching for.
+    def _allocate_space(self, size):
+        """ Allocates space for the set elements, followed by the Bloom
+        filter, if there is one, and the counts, if they're kept. An empty
+        filter is all zero bytes, so it costs next to nothing to allocate.
 
         """
-        index = lookup_bytes.find(data_bytes)
-        while index != -1:
-            if index % self.data._size == 0:
-                return index
-            index = lookup_bytes.find(data_bytes, index + 1)
-        return None
+        FixedArray._allocate_space(self, size)
+        if self.bloom:
+            self.storage.allocate(self._get_filter_size(), chr(0))
+        if self.stats:
+            self.storage.allocate(calcsize(self.stats_format), chr(0))
+
+    def _get_filter_size(self):
+        """ Returns the number of bytes in the Bloom filter. """
+        return (self.allocation * self.filter_bits + 7) / 8
+
+    def _get_filter_bits(self, hash):
+        """ Returns the bits of the Bloom filter that belong to the hash.
+
+        Rather than hashing the bytes over and over, we take two numbers
+        from the two halves of the low 64 bits of the hash, which every hash
+        function has, and combine them. That works just as well (Kirsch and
+        Mitzenmacher's double hashing).
+
+        """
+        bits   = len(self.filter) * 8
+        first  = hash & 0xFFFFFFFF
+        second = ((hash >> 32) & 0xFFFFFFFF) | 1
+        return [(first + i * second) % bits
+            for i in xrange(self.filter_hashes)]
+
+    def _filter_contains(self, hash):
+        """ Returns False if the element with the hash is definitely not in
+        the set. True means that it might be.
+
+        """
+        filter = self.filter
+        for bit in self._get_filter_bits(hash):
+            if not filter[bit >> 3] & (1 << (bit & 7)):
+                return False
+        return True
+
+    def _add_to_filter(self, hashes):
+        """ Sets the Bloom filter bits of each of the hashes, and writes the
+        bytes that changed, joining neighbouring bytes into a single write.
+
+        """
+        filter  = self.filter
+        changed = set()
+        for hash in hashes:
+            for bit in self._get_filter_bits(hash):
+                byte, mask = bit >> 3, 1 << (bit & 7)
+                if not filter[byte] & mask:
+                    filter[byte] |= mask
+                    changed.add(byte)
+
+        run_start = run_stop = None
+        for byte in sorted(changed):
+            if byte != run_stop:
+                if run_start != None:
+                    self.storage.write(self.filter_address + run_start,
+                        str(filter[run_start : run_stop]))
+                run_start = byte
+            run_stop = byte + 1
+        if run_start != None:
+            self.storage.write(self.filter_address + run_start,
+                str(filter[run_start : run_stop]))
 
     def __contains__(self, data):
         """ Returns True is the data object is present in the set. """
@@ -0,0 +1,49 @@
+""" The hash functions that sets can place their elements with.
+
+Every hash function takes a string of bytes and returns a non-negative long
+of at least 64 bits. Each one has a number that is written in the header of
+the set, so the same function is used every time the set is opened. Sets
+written before there was a choice use md5, which is number 0.
+
+md5 is what sets have always used. It spreads elements very evenly. Being a
+cryptographic hash, it does a lot more work than we need, but CPython does
+that work in C. Most of the time it takes goes to turning the digest into a
+number, by way of a hex string of all 128 bits.
+
+md5_64 is md5 with the first 8 bytes of the digest unpacked straight into a
+number. That's all the bits that placing an element and the Bloom filters
+use, and it skips the hex string, which makes it about half again as fast
+as md5, see examples/hash_benchmark.py. New sets use it. It places elements
+differently than md5, so it has a number of its own, and sets written with
+md5 keep using md5.
+
+Hashes done with integer arithmetic in Python, such as FNV, are slower than
+either of these under CPython, which computes md5 in C.
+
+CRCs would be faster still, but they can't be used. The bytes of a set
+element end with a CRC of the rest of them, and the CRC of bytes followed by
+their own CRC is the same for all bytes.
+
+>>> [int(hashes[name]("Steve") % 1000) for name in names]
+[39, 321]
+>>> [hashes[name]("Steve") == hashes[name]("Steve\\x00") for name in names]
+[False, False]
+
+"""
+from hashlib import md5
+from struct import Struct
+
+def md5_hash(bytes):
+    """ Returns the md5 hash of the bytes. """
+    return int(md5(bytes).hexdigest(), 16)
+
+# The first 8 bytes of a digest, as a number
+_word = Struct("<Q")
+
+def md5_64_hash(bytes):
+    """ Returns the first 64 bits of the md5 hash of the bytes. """
+    return _word.unpack_from(md5(bytes).digest())[0]
+
+# The hash functions by name, and their names by the number in the header
+hashes = {"md5" : md5_hash, "md5_64" : md5_64_hash}
+names  = ["md5", "md5_64"]
@@ -1,5 +1,7 @@
+from math import ceil
 from Persistent                   import DynamicCollection
 from Persistent.Hashset.fixed_set import FixedSet
+from Persistent.Hashset.hashes    import names
 
 class Hashset(DynamicCollection):
     """ Hashset is a dynamically growing set implementation. The set elements
@@ -102,7 +104,8 @@ class Hashset(DynamicCollection):
 
     Note that this only holds true if the majority of your lookups are actually
     present in the set. If you frequently look for things that aren't in the
-    set, then the average lookup time will be closer to lg(N).
+    set, then the average lookup time will be closer to lg(N). Creating the
+    set with bloom=True fixes that, at the cost of a little space.
 
     I'm willing to make this tradeoff. There are many use cases where the
     majority of lookups are in fact in the set (or map, which uses this set
@@ -124,34 +127,483 @@ class Hashset(DynamicCollection):
     ...   a.add(i)
     >>> [False for i in ints if not i in a]
     []
-
+    >>> a.close()
     >>> import os
     >>> os.remove("set_doctest.db")
 
+    >>> # Sparse sets are grown without writing out their new space
+    >>> a = Hashset(Integer, "set_doctest.db", sparse=True)
+    >>> for i in ints:
+    ...   a.add(i)
+    >>> [False for i in ints if not i in a]
+    []
+    >>> Integer(value=-1) in a
+    False
+    >>> a.close()
+    >>> os.remove("set_doctest.db")
+
+    >>> # With Bloom filters, most misses don't read any of the fixed sets
+    >>> a = Hashset(Integer, "set_doctest.db", bloom=True)
+    >>> a.add_many(ints[:5000])
+    >>> for i in ints[5000:]:
+    ...   a.add(i)
+    >>> a.close()
+    >>> a = Hashset(Integer, "set_doctest.db")
+    >>> a.bloom, [False for i in ints if not i in a]
+    (True, [])
+    >>> misses = [Integer(value=-i) for i in xrange(1, 1001)]
+    >>> [m for m in misses if m in a]
+    []
+    >>> probes = [s for m in misses for s in a.collections
+    ...   if s._filter_contains(s._get_hash(m.unload()))]
+    >>> len(probes) < 100
+    True
+    >>> a.close()
+    >>> os.remove("set_doctest.db")
+
+    >>> # Every hash function places the same elements, and the one a set was
+    >>> # created with is used when it's reopened
+    >>> for hash in ("md5", "md5_64"):
+    ...   a = Hashset(Integer, "set_doctest.db", hash=hash)
+    ...   a.add_many(ints)
+    ...   a.close()
+    ...   a = Hashset(Integer, "set_doctest.db")
+    ...   print a.hash, [False for i in ints if not i in a]
+    ...   a.close()
+    ...   os.remove("set_doctest.db")
+    md5 []
+    md5_64 []
+
     """
 
     fixed_collection = FixedSet
 
+    # The bit of the flags in the header that says fixed sets have filters
+    bloom_flag       = 2
+    # The bit that says fixed sets keep their counts of live elements and
+    # tombstones, and their displacement. Every new set does, but older ones
+    # don't.
+    stats_flag       = 4
+    # The number of the hash function is kept in these bits of the flags
+    hash_shift       = 8
+    hash_mask        = 0xFF
+
+    # Fixed sets that are sized for a number of items, see reserve(), are
+    # only this full once they hold all of them. Much fuller than this, and
+    # items start to not fit in their probe windows.
+    fill             = 0.8
+
+    # Whether values() skips elements that a newer fixed set has too, unless
+    # it's told otherwise. An element that was added to a set twice is the
+    # same element both times, so it's cheaper to just yield it twice.
+    unique_values    = False
+
+    def __init__(self, data, file_name=None, file_object=None, address=None,
+            mmap=False, sparse=False, cache=None, durability=None,
+            lazy=False, bloom=False, hash="md5_64", checksum="read",
+            probe_size=75, initial_allocation=1024, growth=2,
+            expected_size=None, storage=None, readonly=False):
+        """ Initializes a new hashset. See DynamicCollection for most of the
+        arguments.
+
+        If bloom is True, every fixed set keeps a Bloom filter of the
+        elements in it. Looking for an element that isn't in the set then
+        rarely has to read any of the fixed sets, instead of reading every
+        one of them. The filters take up about a byte and a quarter per
+        element. This is recorded in the header, so it only matters when the
+        set is first created.
+
+        Hash is the name of the hash function that places the elements. See
+        Persistent.Hashset.hashes for the choices. md5_64 is the default,
+        and md5 is what sets written before there was a choice use. The hash
+        function is recorded in the header too.
+
+        Probe size is the number of elements each fixed set probes for an
+        element, see FixedSet.__init__. It's recorded in the header as
+        well. Collections written before it was are opened with the
+        default.
+
+        Sets sized by expected_size are only filled to fill, so the first
+        fixed set has room for a few more items than that.
+
+        """
+        if hash not in names:
+            raise Exception("Unknown hash: %s" % hash)
+        self.bloom      = bloom
+        self.hash       = hash
+        self.stats      = True
+        self.probe_size = probe_size
+        DynamicCollection.__init__(self, data, file_name, file_object,
+            address, mmap, sparse, cache, durability, lazy, checksum,
+            initial_allocation, growth, expected_size, storage, readonly)
+
+    def _get_reserved_allocation(self, count):
+        """ Fixed sets need room to spare, see fill. """
+        return max(1, int(ceil(count / self.fill)))
+
+    def reserve(self, count):
+        """ Makes room for count more items. If the newest fixed set doesn't
+        have room for them, a fixed set that does is added, and new items
+        go into it from then on. Loading a known number of items this way
+        puts all of them in one fixed set, so looking one up reads a single
+        fixed set, rather than every one that the set would have grown
+        through.
+
+        >>> from cStringIO import StringIO
+        >>> from Persistent import Data, IntegerProperty
+        >>> class Integer(Data):
+        ...   value = IntegerProperty()
+        ...
+        >>> a = Hashset(Integer, file_object=StringIO())
+        >>> a.reserve(50000)
+        >>> [c.allocation for c in a.collections]
+        [1024, 62500]
+        >>> a.add_many(Integer(value=i) for i in xrange(50000))
+        >>> a.reserve(1000)
+        >>> [c.allocation for c in a.collections]
+        [1024, 62500, 125000]
+
+        """
+        with self.storage.operation():
+            number = len(self.collections)
+            newest = self.collections[number - 1]
+            room   = 0
+            if newest.stats:
+                room = int(newest.allocation * self.fill) - newest.live
+            if room < count:
+                self._add_collection(number,
+                    self._get_reserved_allocation(count))
+
+    def _get_flags(self):
+        """ Adds the Bloom filter flag and the number of the hash function to
+        the flags in the header.
+
+        """
+        flags = DynamicCollection._get_flags(self)
+        if self.bloom:
+            flags |= self.bloom_flag
+        if self.stats:
+            flags |= self.stats_flag
+        return flags | (names.index(self.hash) << self.hash_shift)
+
+    def _load_flags(self, flags):
+        """ Reads the Bloom filter flag and the hash function from the flags
+        in the header.
+
+        """
+        DynamicCollection._load_flags(self, flags)
+        self.bloom = bool(flags & self.bloom_flag)
+        self.stats = bool(flags & self.stats_flag)
+        number     = (flags >> self.hash_shift) & self.hash_mask
+        if number >= len(names):
+            raise Exception("Unknown hash: %s" % number)
+        self.hash  = names[number]
+
+    def _get_collection_options(self):
+        """ Fixed sets are also told whether to keep a Bloom filter, what
+        hash function to use, and how many elements to probe.
+
+        """
+        options = DynamicCollection._get_collection_options(self)
+        options['bloom']      = self.bloom
+        options['hash']       = self.hash
+        options['stats']      = self.stats
+        options['probe_size'] = self.probe_size
+        return options
+
     def add(self, data):
         """ Adds an item to the set. """
         #TODO For data objects with only one property, allow setting like:
         # a.add("Steve")
-        if self.collections[-1].set(data) == True:
-            return
-        self._add_collection()
-        self.add(data)
+        with self.storage.operation():
+            self._refresh_if_changed()
+            count = len(self.collections)
+            if self.collections[count - 1].set(data) == True:
+                return
+            self._add_collection(count)
+            self.add(data)
+
+    def add_many(self, datas):
+        """ Adds many items to the set at once.
+
+        This is much faster than calling add() for each item, because the
+        items are written to disk in address order with as few reads and
+        writes as possible. See FixedSet.set_many for the details.
+
+        >>> from Persistent import Data, IntegerProperty
+        >>> class Integer(Data):
+        ...   value = IntegerProperty()
+        ...
+        >>> a = Hashset(Integer, "set_doctest.db")
+        >>> a.add_many(Integer(value=i) for i in xrange(10000))
+        >>> len(a.collections) > 1
+        True
+        >>> [False for i in xrange(10000) if not Integer(value=i) in a]
+        []
+        >>> Integer(value=10000) in a
+        False
+        >>> a.close()
+
+        >>> import os
+        >>> os.remove("set_doctest.db")
+
+        """
+        datas = list(datas)
+        with self.storage.operation():
+            self._refresh_if_changed()
+            while datas:
+                # We hand the newest collection no more items than it could
+                # ever hold, so we don't hash items that are bound to be
+                # handed back
+                count     = len(self.collections)
+                newest    = self.collections[count - 1]
+                left_over = newest.set_many(datas[:newest.allocation])
+                datas     = left_over + datas[newest.allocation:]
+                if left_over:
+                    # Whatever didn't fit goes into a new collection
+                    self._add_collection(count)
+
+    def remove(self, data):
+        """ Removes an item from the set, and returns True if it was there.
+
+        The item is replaced by a tombstone in every fixed set that has it,
+        since an item that was added again after its fixed set filled up
+        can be in more than one of them. Later items can be put where the
+        tombstones are. See FixedSet.remove, and compact() for getting rid
+        of the tombstones altogether.
+
+        >>> from Persistent import Data, IntegerProperty
+        >>> class Integer(Data):
+        ...   value = IntegerProperty()
+        ...
+        >>> a = Hashset(Integer, "set_doctest.db")
+        >>> a.add_many(Integer(value=i) for i in xrange(3000))
+        >>> [a.remove(Integer(value=i)) for i in (5, 5, 3000)]
+        [True, False, False]
+        >>> Integer(value=5) in a, Integer(value=6) in a
+        (False, True)
+        >>> len([i for i in xrange(3000) if a.remove(Integer(value=i))])
+        2999
+        >>> a.add_many(Integer(value=i) for i in xrange(2000))
+        >>> a.close()
+
+        >>> # The counts are kept in the fixed sets on disk. New items only go
+        >>> # in the newest fixed sets, so the oldest one is all tombstones.
+        >>> a = Hashset(Integer, "set_doctest.db")
+        >>> [(s.live, s.tombstones) for s in a.collections]
+        [(0, 1005), (2000, 4)]
+        >>> a.compact()
+        [0]
+        >>> [(s.live, s.tombstones) for s in a.collections]
+        [(0, 0), (2000, 4)]
+        >>> len(list(a)), [i for i in xrange(2000) if not Integer(value=i) in a]
+        (2000, [])
+        >>> a.close()
+
+        >>> import os
+        >>> os.remove("set_doctest.db")
+
+        """
+        with self.storage.operation():
+            self._refresh_if_changed()
+            removed = [fixed_set for fixed_set in self.collections
+                if fixed_set.remove(data)]
+            return len(removed) > 0
+
+    def compact(self, threshold=0.05, generations=None):
+        """ Compacts every fixed set in which tombstones take up more than
+        threshold of the cells, and returns the numbers of the fixed sets
+        that were compacted. If generations is given, only the fixed sets
+        with those numbers are looked at, see
+        DynamicCollection._get_generations.
+
+        Each fixed set is rewritten in place, in a single sequential pass,
+        while the set is still being used. See FixedSet.compact.
+
+        """
+        compacted = []
+        for number, fixed_set in self._get_generations(generations):
+            if fixed_set.tombstones > threshold * fixed_set.allocation:
+                fixed_set.compact(self._get_lookup_bytes)
+                compacted.append(number)
+        return compacted
 
     def get(self, data, default=None):
         """ Retrieves an item from the set.
         If the item doesn't exist, default is returned.
 
         """
+        self._refresh_if_changed()
         for fixed_set in reversed(self.collections):
             result = fixed_set.get(data)
             if result != None:
                 return result
         return default
 
+    def values(self, generations=None, result="data", unique=None):
+        """ Yields every element of the set.
+
+        Each fixed set is read in large sequential chunks, and only one
+        chunk is held at a time, so this is the way to walk through all of a
+        large set. The newest fixed set is walked first. If generations is
+        given, only the fixed sets with those numbers are walked, see
+        DynamicCollection._get_generations.
+
+        Items are only ever added to the newest fixed set, so an item can
+        also be in an older one. That's how a map replaces the value for a
+        key. If unique is True, an element is skipped if any newer fixed set
+        has it too, which means looking it up in each of them. That costs a
+        random read per element for every newer fixed set, unless they have
+        Bloom filters, which turns a walk through n elements in g fixed sets
+        into as many as n * g reads. Elements of the newest fixed set never
+        need looking up.
+
+        So unique is False for sets by default, and an element that was
+        added more than once can come up more than once. It's True for maps,
+        where the older elements hold values that have been replaced, see
+        unique_values.
+
+        The elements are data objects, unless result is "tuple" or
+        "namedtuple", see FixedArray.get_range.
+
+        >>> from Persistent import Data, IntegerProperty
+        >>> class Integer(Data):
+        ...   value = IntegerProperty()
+        ...
+        >>> a = Hashset(Integer, "set_doctest.db")
+        >>> a.add_many(Integer(value=i) for i in xrange(3000))
+        >>> a.add(Integer(value=0))
+        >>> sorted(i.value for i in a) == [0] + range(3000)
+        True
+        >>> sorted(i.value for i in a.values(unique=True)) == range(3000)
+        True
+        >>> len(list(a.values([0]))) < 1024
+        True
+        >>> a.close()
+
+        >>> import os
+        >>> os.remove("set_doctest.db")
+
+        """
+        if unique == None:
+            unique = self.unique_values
+        for fixed_set, bytes in self._read_elements(generations, unique):
+            yield fixed_set._load(bytes, None, result)
+
+    def _read_elements(self, generations=None, unique=True):
+        """ Yields the fixed set and bytes of every element in the given
+        generations, newest first. See values().
+
+        """
+        for number, fixed_set in reversed(self._get_generations(generations)):
+            newer = self.collections[number + 1:]
+            for index, bytes in fixed_set._read_elements():
+                if unique and newer:
+                    lookup = self._get_lookup_bytes(bytes)
+                    if [s for s in newer if s._get_raw(lookup) != None]:
+                        continue
+                yield fixed_set, bytes
+
+    def _get_lookup_bytes(self, bytes):
+        """ Returns the bytes that the element with the given bytes is
+        looked up by. For a set, that's all of them.
+
+        """
+        return bytes
+
+    def __iter__(self):
+        """ Iterates over the elements of the set. See values(). """
+        return self.values()
+
+    def aadd(self, data):
+        """ Asynchronously adds the item to the set, and returns a Future that
+        is done once it has been added.
+
+        Adds that are waiting at the same time are carried out together with
+        add_many().
+
+        >>> from Persistent import Data, IntegerProperty
+        >>> class Integer(Data):
+        ...   value = IntegerProperty()
+        ...
+        >>> a = Hashset(Integer, "set_doctest.db")
+        >>> adds  = [a.aadd(Integer(value=i)) for i in xrange(2000)]
+        >>> gets  = [a.aget(Integer(value=i)) for i in xrange(2001)]
+        >>> [i for i in xrange(2000) if gets[i].result().value != i]
+        []
+        >>> print gets[2000].result()
+        None
+        >>> a.close()
+
+        >>> import os
+        >>> os.remove("set_doctest.db")
+
+        """
+        return self._get_executor().submit(self.add, data,
+            key=self._get_request_key(data), write=True, batch=self._add_all)
+
+    def aget(self, data, default=None):
+        """ Asynchronously retrieves the item from the set, and returns a
+        Future for it. If the item doesn't exist, the result is default.
+
+        If the same item is already waiting to be read, the Future of that
+        read is returned, so both callers get the same object.
+
+        """
+        # Reads can only be shared if they'd return the same default
+        key = None
+        if default == None:
+            key = self._get_request_key(data)
+        return self._get_executor().submit(self._get_one, (data, default),
+            key=key, batch=self._get_all)
+
+    def _get_request_key(self, data):
+        """ Returns the bytes that identify the data for asynchronous
+        requests. These are the same bytes the data is hashed by.
+
+        """
+        if getattr(data, '_is_map', False):
+            return data.unload_key()
+        return data.unload()
+
+    def _get_one(self, request):
+        """ Carries out a single aget() request. """
+        return self.get(*request)
+
+    def _get_all(self, requests):
+        """ Carries out many aget() requests at once. """
+        return [self.get(*request) for request in requests]
+
+    def _add_all(self, datas):
+        """ Adds the items of many aadd() requests at once. """
+        self.add_many(datas)
+        return [None] * len(datas)
+
     def __contains__(self, data):
         """ Returns whether or not data is in the set. """
         return self.get(data) != None
+
+    def flush(self):
+        """ Writes the counts of the fixed sets, and makes sure that
+        everything written to the set has been handed to the operating
+        system.
+
+        """
+        self._write_stats()
+        DynamicCollection.flush(self)
+
+    def close(self):
+        """ Writes the counts of the fixed sets, and closes the set. See
+        DynamicCollection.close.
+
+        """
+        if self.executor != None:
+            self.executor.shutdown()
+            self.executor = None
+        self._write_stats()
+        DynamicCollection.close(self)
+
+    def _write_stats(self):
+        """ Writes the counts of the fixed sets. """
+        for fixed_set in self.collections:
+            fixed_set.write_stats()
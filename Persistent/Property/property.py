@@ -1,6 +1,6 @@
 from struct import calcsize, unpack, pack
 
-class Property:
+class Property(object):
     """ Property class is used to define fields of data in Data objects.
 
     Fields inherit from the Property class to control how data is saved
@@ -13,8 +13,12 @@ class Property:
     Also note that the value None is supported. Each property has an extra
     byte that tracks whether or not the value is actually set.
 
+    Properties are also descriptors. A Data object normally holds the values
+    of its properties itself, but a lazy one only holds its bytes, and the
+    properties decode their values from them the first time they're used.
+
     """
-    def __init__(self, format, key=False):
+    def __init__(self, format, key=False, index=False):
         """ Initializes a new Data property.
 
         The format follows the struct format described here:
@@ -23,6 +27,9 @@ class Property:
         The key paramter is used to determine whether or not this field should
         be part of the key in the Data object.
 
+        If index is True, maps keep an index on this field, so that data
+        objects can be found by it. See Hashmap.find_by.
+
         The default value to be written to disk is simply a series of
         nulled bytes.
 
@@ -33,11 +40,12 @@ class Property:
         """
 
         # We add 1 to the size for the is_set byte
-        self.format  = format
-        self.size    = 1 + calcsize(self.format)
-        self.default = chr(0) * self.size
-        self.is_key  = key
-        self.is_data = not self.is_key
+        self.format     = format
+        self.size       = 1 + calcsize(self.format)
+        self.default    = chr(0) * self.size
+        self.is_key     = key
+        self.is_data    = not self.is_key
+        self.is_indexed = index
 
     def unpack(self, bytes, file_object=None):
         """ Given bytes passed in, the first byte is read to determine if the
@@ -78,3 +86,100 @@ class Property:
         if value == None:
             return self.default
         return chr(1) + pack(self.format, value)
+
+    def pack_ordered(self, value):
+        """ Like pack(), but the bytes sort in the same order as the values
+        they were packed from, which is what ordered containers such as
+        Btree compare keys by. None sorts before everything else. They take
+        up as many bytes as pack() does, but they can't be unpacked.
+
+        Only formats of a single integer, bool, float or double can be
+        ordered this way. Integers are written big endian, with the sign bit
+        flipped so that negative numbers come first. Floats have every bit
+        flipped if they're negative, and just the sign bit if they aren't.
+
+        >>> p = Property('i')
+        >>> values = [None, -2**31, -5, -1, 0, 1, 300, 2**31 - 1]
+        >>> [p.pack_ordered(v) for v in values] == sorted(p.pack_ordered(v)
+        ...   for v in values)
+        True
+        >>> p.pack_ordered(1)
+        '\\x01\\x80\\x00\\x00\\x01'
+        >>> p = Property('d')
+        >>> values = [None, float("-inf"), -2.5, -1e-9, 0.0, 1e-9, 3.0]
+        >>> [p.pack_ordered(v) for v in values] == sorted(p.pack_ordered(v)
+        ...   for v in values)
+        True
+        >>> Property('ih').pack_ordered((1, 2))
+        Traceback (most recent call last):
+        ...
+        Exception: Properties with the format ih can't be ordered
+
+        """
+        code = self.format.lstrip("@=<>!")
+        size = self.size - 1
+        if len(code) != 1 or code not in "bBhHiIlLqQ?fd":
+            raise Exception("Properties with the format %s can't be ordered"
+                % self.format)
+        if value == None:
+            return self.default
+        unsigned = {1 : "B", 2 : "H", 4 : "I", 8 : "Q"}[size]
+        if code in "fd":
+            number = unpack(">" + unsigned, pack(">" + code, value))[0]
+            if number >> (size * 8 - 1):
+                number = ~number & ((1 << size * 8) - 1)
+            else:
+                number |= 1 << (size * 8 - 1)
+        elif code in "bhilq":
+            number = value + (1 << (size * 8 - 1))
+        else:
+            number = value
+        return chr(1) + pack(">" + unsigned, number)
+
+    def __get__(self, instance, owner):
+        """ Returns the property's value for a Data object that doesn't hold
+        it yet. See Data.decode. Looked up on the class, the property is
+        returned.
+
+        """
+        if instance == None:
+            return self
+        return instance.decode(self)
+
+    def encode(self, value):
+        """ Returns the values that the format packs for a value that isn't
+        None. Data objects use this, along with decode(), to pack all of
+        their properties with a single struct rather than calling pack() for
+        each of them. Properties that override pack() and unpack() should
+        override these too, or their Data objects go back to calling pack()
+        and unpack().
+
+        >>> p = Property('i', 0)
+        >>> p.decode(p.encode(5))
+        5
+
+        """
+        return (value,)
+
+    def decode(self, values):
+        """ Returns the value for the values that the format unpacked. This
+        is the opposite of encode().
+
+        """
+        return values[0]
+
+    def get_fields(self, name):
+        """ Returns the names of the fields for the values that the format
+        packs, when the property is described by a numpy dtype (see
+        Persistent.Data.dtype). Values that take more than one field are
+        numbered.
+
+        >>> Property('i').get_fields("age"), Property('ih').get_fields("age")
+        (['age'], ['age_0', 'age_1'])
+
+        """
+        count = len([char for char in self.format
+            if not char.isdigit() and char != "x"])
+        if count == 1:
+            return [name]
+        return ["%s_%d" % (name, i) for i in xrange(count)]
@@ -82,3 +82,50 @@ class StringProperty(Property):
             return self.default
         value = value[:self.length]
         return chr(1) + pack(self.format, len(value), value)
+
+    def pack_ordered(self, value):
+        """ Strings are ordered by their bytes, padded with null bytes, and
+        then by their length, so that a string comes before any longer
+        string that starts with it. See Property.pack_ordered.
+
+        >>> s = StringProperty(5)
+        >>> values = [None, "", "a", "a\\x00", "ab", "b", "b" * 9]
+        >>> [s.pack_ordered(v) for v in values] == sorted(s.pack_ordered(v)
+        ...   for v in values)
+        True
+
+        """
+        if value == None:
+            return self.default
+        value = value[:self.length]
+        return chr(1) + value.ljust(self.length, chr(0)) + \
+            pack(">I", len(value))
+
+    def encode(self, value):
+        """ Returns the length of the string and the string, which is what
+        the format packs. See Property.encode.
+
+        >>> s = StringProperty(5)
+        >>> s.encode('Persistent')
+        (5, 'Persi')
+        >>> s.decode((3, 'Per\\x00\\x00'))
+        'Per'
+
+        """
+        value = value[:self.length]
+        return (len(value), value)
+
+    def decode(self, values):
+        """ Returns the string for the length and bytes that the format
+        unpacked. See Property.decode.
+
+        """
+        length, string = values
+        return string[:length]
+
+    def get_fields(self, name):
+        """ The length of the string comes before it. See
+        Property.get_fields.
+
+        """
+        return [name + "_length", name]
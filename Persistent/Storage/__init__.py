@@ -0,0 +1,6 @@
+from Persistent.Storage.storage          import FileStorage
+from Persistent.Storage.mmap_storage     import MmapStorage
+from Persistent.Storage.page_cache       import PageCache, CachedStorage
+from Persistent.Storage.log_storage      import LoggedStorage
+from Persistent.Storage.readonly_storage import ReadOnlyStorage
+from Persistent.Storage.open_storage     import open_storage, open_file
@@ -0,0 +1,439 @@
+import os
+from time import time
+from zlib import crc32
+from struct import pack, unpack, calcsize
+from Persistent.Storage.storage import FileStorage
+
+class LoggedStorage(FileStorage):
+    """ LoggedStorage adds a write-ahead log in front of another storage, so
+    that a crash can never leave a container half written.
+
+    Writes aren't handed to the storage underneath, which we call the backing
+    storage, right away. Instead they're held in memory, and reads see them
+    on top of the backing storage. Every so often the writes that have
+    built up are appended to a log file next to the data file, followed by a
+    commit record. Only once the log has been synced to disk are the writes
+    handed to the backing storage. If we crash before the commit record made
+    it to disk, none of the writes happened. If we crash after, the writes
+    are replayed from the log the next time the file is opened.
+
+    Syncing the log is what makes writes durable, and it is also slow. So
+    rather than syncing after every write, we sync once for a whole group of
+    operations (a group commit). The durability argument decides how often
+    that happens:
+
+        "op"    - The log is synced after every operation.
+        "batch" - The log is synced once every group_size operations, or
+                  group_time seconds, whichever comes first. A crash loses
+                  at most the last group, but never leaves it half done.
+                  The time is only checked as operations finish, so once
+                  writes stop, the last group waits for flush() or
+                  close().
+        "none"  - The log is never synced. This protects against the process
+                  crashing, but not against the machine crashing.
+
+    An operation is everything done inside a storage.operation() block, such
+    as adding an element to a set, along with any collection that had to be
+    allocated for it. Writes made outside of a block are operations of
+    their own. If the block raises an exception, the writes made in it are
+    forgotten, so an operation that fails halfway never reaches the file.
+    For the same reason, flush() and close() only commit operations that
+    have finished, and leave the writes of one that's still going pending.
+
+    Growing the file is the exception. New space is appended to the data
+    file and synced right away. That's rare, and until a logged write points
+    at the new space, it's just unused space at the end of the file.
+
+    Once the log grows past checkpoint_size, the data file is synced and the
+    log is emptied.
+
+    Operations are serialized. A thread that starts an operation, or writes
+    outside of one, holds the storage's lock until it's done. Reads don't
+    take the lock, they work from whatever writes were pending when they
+    started.
+
+    >>> from Persistent import Data, IntegerProperty, Hashmap
+    >>> class Pair(Data):
+    ...   key   = IntegerProperty(key=True)
+    ...   value = IntegerProperty()
+    ...
+    >>> m = Hashmap(Pair, "log_doctest.db", durability="batch")
+    >>> for i in xrange(3000):
+    ...   m[i] = i
+    >>> m.close()
+    >>> os.path.getsize("log_doctest.db.log")
+    0
+
+    >>> # We crash after the log made it to disk, but before the data file
+    >>> # was written
+    >>> m = Hashmap(Pair, "log_doctest.db", durability="batch")
+    >>> m.storage.group_time = 60
+    >>> for i in xrange(10):
+    ...   m[i] = -i
+    >>> m.storage._write_log()
+    >>> m[10] = -10
+    >>> m.storage.log.close()
+    >>> m.storage.backing.close()
+
+    >>> # The logged writes are replayed, and the unlogged one is lost
+    >>> m = Hashmap(Pair, "log_doctest.db")
+    >>> [m[i] for i in xrange(11)]
+    [0, -1, -2, -3, -4, -5, -6, -7, -8, -9, 10]
+    >>> m.close()
+
+    >>> os.remove("log_doctest.db")
+    >>> os.remove("log_doctest.db.log")
+
+    >>> # An operation that fails is rolled back
+    >>> from Persistent.Storage import FileStorage
+    >>> backing = FileStorage(open("log_doctest.db", "w+b"))
+    >>> s = LoggedStorage(backing, "log_doctest.db.log", "op")
+    >>> s.append("AAAAAAAA")
+    0
+    >>> with s.operation():
+    ...   s.write(4, "CCCC")
+    ...   with s.operation():
+    ...     s.write(0, "BBBB")
+    ...     raise ValueError("Failed halfway")
+    Traceback (most recent call last):
+    ...
+    ValueError: Failed halfway
+    >>> s.read(0, 8)
+    'AAAAAAAA'
+    >>> s.write(0, "DD")
+    >>> s.close()
+    >>> open("log_doctest.db").read()
+    'DDAAAAAA'
+
+    >>> os.remove("log_doctest.db")
+    >>> os.remove("log_doctest.db.log")
+
+    >>> # Flushing in the middle of an operation only commits the operations
+    >>> # before it, so the operation can still be rolled back
+    >>> backing = FileStorage(open("log_doctest.db", "w+b"))
+    >>> s = LoggedStorage(backing, "log_doctest.db.log", "batch")
+    >>> s.append("AAAAAAAA")
+    0
+    >>> s.write(6, "ZZ")
+    >>> with s.operation():
+    ...   s.write(0, "BB")
+    ...   s.flush()
+    ...   s.write(2, "CC")
+    ...   raise ValueError("Failed halfway")
+    Traceback (most recent call last):
+    ...
+    ValueError: Failed halfway
+    >>> open("log_doctest.db").read(), s.read(0, 8)
+    ('AAAAAAZZ', 'AAAAAAZZ')
+    >>> s.close()
+
+    >>> os.remove("log_doctest.db")
+    >>> os.remove("log_doctest.db.log")
+
+    """
+
+    # Every entry in the log starts with a header. Writes are followed by the
+    # bytes that were written, and commit records end each group of writes.
+    entry_format = "<cqq"
+    entry_size   = calcsize(entry_format)
+
+    # Pending writes are indexed by the pages of this size that they touch
+    page_size    = 4096
+
+    def __init__(self, backing, log_name, durability="batch", group_size=64,
+            group_time=0.01, checkpoint_size=16 * 1024 * 1024):
+        """ Initializes a new logged storage on top of the backing storage.
+
+        Log_name is the name of the log file. If it contains any committed
+        writes, they are replayed before anything else happens, using
+        replay_log().
+
+        Durability is one of "op", "batch" or "none", as described above.
+        Group_size and group_time control how large a group commit can get.
+
+        """
+        if durability not in ("op", "batch", "none"):
+            raise Exception("Unknown durability: %s" % durability)
+        FileStorage.__init__(self, backing.file_object)
+        self.backing         = backing
+        self.durability      = durability
+        self.group_size      = group_size
+        self.group_time      = group_time
+        self.checkpoint_size = checkpoint_size
+        self.depth           = 0
+        self.operations      = 0
+        self.started         = None
+        # The number of writes committed so far. Operations remember where
+        # their writes start by counting every write ever made, so that the
+        # place stays right when the writes before them are committed.
+        self.committed       = 0
+        # Where the writes of the outermost operation that's still going
+        # start
+        self.open_mark       = 0
+        self.pending         = []
+        self.pages           = {}
+
+        replay_log(backing, log_name)
+        if not os.path.exists(log_name):
+            open(log_name, 'w').close()
+        self.log = open(log_name, 'r+b')
+
+    def _checkpoint(self):
+        """ Syncs the data file and empties the log. """
+        self.backing.flush()
+        _sync(self.backing.file_object)
+        self.log.seek(0)
+        self.log.truncate()
+        _sync(self.log)
+
+    def _write_log(self, writes=None):
+        """ Appends the writes, or all of the pending writes, to the log,
+        followed by a commit record, and syncs the log unless the durability
+        is "none".
+
+        """
+        if writes == None:
+            writes = self.pending
+        self.log.seek(0, 2)
+        checksum = 0
+        for address, bytes in writes:
+            entry    = pack(self.entry_format, "W", address, len(bytes))
+            entry   += bytes
+            checksum = crc32(entry, checksum)
+            self.log.write(entry)
+        self.log.write(pack(self.entry_format, "C", len(writes), checksum))
+        if self.durability == "none":
+            self.log.flush()
+        else:
+            _sync(self.log)
+
+    def _commit(self):
+        """ Commits the pending group of writes, up to the start of the
+        operation that's still going, if there is one.
+
+        """
+        count = len(self.pending)
+        if self.depth > 0:
+            count = self.open_mark - self.committed
+        group = self.pending[:count]
+        if group:
+            self._write_log(group)
+            for address, bytes in group:
+                self.backing.write(address, bytes)
+            if self.log.tell() > self.checkpoint_size:
+                self._checkpoint()
+        self.committed += count
+        self._set_pending(self.pending[count:])
+        self.operations = 0
+        self.started    = None
+
+    def _rollback(self, mark):
+        """ Forgets the pending writes from mark on, which counts every write
+        ever made, see _Operation.
+
+        """
+        self._set_pending(self.pending[:mark - self.committed])
+
+    def _set_pending(self, pending):
+        """ Replaces the pending writes, and the index of the pages they
+        touch. Reads that have already started keep the lists they started
+        with, so new ones are made rather than changing them.
+
+        """
+        pages = {}
+        for position, (address, bytes) in enumerate(pending):
+            first = address / self.page_size
+            last  = (address + len(bytes) - 1) / self.page_size
+            for page in xrange(first, last + 1):
+                pages.setdefault(page, []).append(position)
+        self.pending = pending
+        self.pages   = pages
+
+    def _finish_operation(self):
+        """ Called at the end of every operation, to commit the group once
+        it is large or old enough.
+
+        """
+        self.operations += 1
+        if self.started == None:
+            self.started = time()
+        if self.durability == "op" or self.operations >= self.group_size or \
+                time() - self.started >= self.group_time:
+            self._commit()
+
+    def operation(self):
+        """ Returns a context manager that groups the writes made within it
+        into a single operation, which will be committed all at once.
+
+        """
+        return _Operation(self)
+
+    def read(self, address, size):
+        """ Reads size bytes starting at address, including any pending
+        writes.
+
+        """
+        # A commit replaces the pending writes once they've reached the
+        # backing storage, so we have to look at them before reading it.
+        pending, pages = self.pending, self.pages
+        bytes  = self.backing.read(address, size)
+        first  = address / self.page_size
+        last   = (address + size - 1) / self.page_size
+        writes = set()
+        for page in xrange(first, last + 1):
+            writes.update(pages.get(page, ()))
+        if not writes:
+            return bytes
+
+        # Pending writes are applied in the order they were made
+        bytes = bytearray(bytes)
+        for position in sorted(writes):
+            write_address, write_bytes = pending[position]
+            start = max(address, write_address)
+            stop  = min(address + len(bytes), write_address + len(write_bytes))
+            if start < stop:
+                bytes[start - address : stop - address] = \
+                    write_bytes[start - write_address : stop - write_address]
+        return str(bytes)
+
+    def write(self, address, bytes):
+        """ Writes the bytes starting at address. The write is held in memory
+        until its group is committed.
+
+        """
+        with self.lock:
+            position = len(self.pending)
+            self.pending.append((address, bytes))
+            first = address / self.page_size
+            last  = (address + len(bytes) - 1) / self.page_size
+            for page in xrange(first, last + 1):
+                self.pages.setdefault(page, []).append(position)
+            if self.depth == 0:
+                self._finish_operation()
+
+    def end(self):
+        """ Returns the address of the end of the storage. """
+        return self.backing.end()
+
+    def append(self, bytes):
+        """ Writes the bytes at the end of the data file, syncs it, and returns
+        the address they were written to.
+
+        """
+        address = self.backing.append(bytes)
+        self.backing.flush()
+        _sync(self.backing.file_object)
+        return address
+
+    def allocate(self, size, fill=chr(255)):
+        """ Appends size bytes to the end of the data file, each of them set to
+        fill, syncs it, and returns the address of the new space.
+
+        """
+        address = self.backing.allocate(size, fill)
+        self.backing.flush()
+        _sync(self.backing.file_object)
+        return address
+
+    @property
+    def changes(self):
+        """ The number of writes that other storages have made to the file,
+        if the backing storage counts them, see CachedStorage.
+
+        """
+        return getattr(self.backing, "changes", 0)
+
+    def flush(self):
+        """ Commits the pending group of writes, making them durable. The
+        writes of an operation that's still going stay pending.
+
+        """
+        with self.lock:
+            self._commit()
+            self.backing.flush()
+
+    def reload(self):
+        """ Reloads the backing storage. Writes are only read back from
+        the log while they're pending, so flush() first.
+
+        """
+        self.backing.reload()
+
+    def close(self):
+        """ Commits the pending writes, empties the log and closes both files.
+        """
+        with self.lock:
+            self._commit()
+            self._checkpoint()
+            self.log.close()
+            self.backing.close()
+
+
+def replay_log(backing, log_name):
+    """ Applies every committed group of writes in the log to the backing
+    storage, then syncs the backing storage and empties the log.
+
+    Containers opened without a durability still replay a log that was left
+    behind, so that they never see a half written file.
+
+    """
+    if not os.path.exists(log_name) or os.path.getsize(log_name) == 0:
+        return
+    log      = open(log_name, 'r+b')
+    size     = LoggedStorage.entry_size
+    writes   = []
+    checksum = 0
+    while True:
+        header = log.read(size)
+        if len(header) < size:
+            break
+        kind, address, length = unpack(LoggedStorage.entry_format, header)
+        if kind == "W":
+            bytes = log.read(length)
+            if len(bytes) < length:
+                break
+            checksum = crc32(header + bytes, checksum)
+            writes.append((address, bytes))
+        elif kind == "C" and length == checksum and address == len(writes):
+            for address, bytes in writes:
+                backing.write(address, bytes)
+            writes   = []
+            checksum = 0
+        else:
+            # Anything else is the torn end of a group that never committed
+            break
+    backing.flush()
+    _sync(backing.file_object)
+    log.truncate(0)
+    _sync(log)
+    log.close()
+
+def _sync(file_object):
+    """ Flushes the file object and syncs it to disk. """
+    file_object.flush()
+    os.fsync(file_object.fileno())
+
+
+class _Operation:
+    """ The context manager returned by LoggedStorage.operation(). """
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    def __enter__(self):
+        self.storage.lock.acquire()
+        # Where this operation's writes start, in case it has to be undone
+        self.mark = self.storage.committed + len(self.storage.pending)
+        if self.storage.depth == 0:
+            self.storage.open_mark = self.mark
+        self.storage.depth += 1
+
+    def __exit__(self, type, value, traceback):
+        try:
+            self.storage.depth -= 1
+            if type != None:
+                self.storage._rollback(self.mark)
+            elif self.storage.depth == 0:
+                self.storage._finish_operation()
+        finally:
+            self.storage.lock.release()
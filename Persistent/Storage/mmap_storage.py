@@ -0,0 +1,131 @@
+import os
+import mmap
+from Persistent.Storage.storage import FileStorage
+
+class MmapStorage(FileStorage):
+    """ MmapStorage memory maps the container's file, so reads are simply
+    slices of the mapping and writes go straight into it. This saves the
+    seek and read system calls that FileStorage needs for every access, which
+    adds up quickly on read heavy workloads.
+
+    The file can only be mapped up to its current size, so whenever the file
+    grows (i.e. a container allocates a new collection at the end of it) we
+    write the new space through the file object and then remap the file.
+
+    This only works on real files, not on file-like objects such as StringIO.
+
+    Reads don't take any locks. Remapping the file only swaps in a new
+    mapping, and leaves the old one to be unmapped once nobody is reading
+    from it anymore, so a read is never cut short by another thread growing
+    the file.
+
+    >>> f = open("mmap_doctest.db", "w+b")
+    >>> s = MmapStorage(f)
+    >>> s.append("header")
+    0
+    >>> s.allocate(4)
+    6
+    >>> s.end()
+    10
+    >>> s.write(6, "ab")
+    >>> s.read(4, 6)
+    'erab\\xff\\xff'
+    >>> s.read(8, 100)
+    '\\xff\\xff'
+    >>> s.close()
+
+    >>> import os
+    >>> os.remove("mmap_doctest.db")
+
+    """
+
+    def __init__(self, file_object, access=mmap.ACCESS_WRITE):
+        """ Initializes a new storage by mapping the given file object.
+
+        The access argument is passed along to mmap, and determines whether
+        the mapping can be written to.
+
+        """
+        FileStorage.__init__(self, file_object)
+        self.access = access
+        self.map    = None
+        self._remap()
+
+    def _remap(self):
+        """ Maps the whole file, replacing the previous mapping if the file
+        has grown since it was made.
+
+        """
+        with self.lock:
+            # Anything still sitting in the file object's buffer needs to
+            # reach the file before we can map it.
+            self.file_object.flush()
+            length = os.fstat(self.file_object.fileno()).st_size
+
+            # Empty files can't be mapped, so we wait until there is
+            # something to map.
+            if length == 0 or (self.map != None and len(self.map) == length):
+                return
+            # The old mapping is unmapped once the last reader lets go of it
+            self.map = mmap.mmap(self.file_object.fileno(), length,
+                access=self.access)
+
+    def read(self, address, size):
+        """ Reads size bytes starting at address. Just like a file, reading
+        past the end returns fewer bytes.
+
+        """
+        map = self.map
+        if map == None:
+            return ""
+        return map[address : address + size]
+
+    def write(self, address, bytes):
+        """ Writes the bytes starting at address. """
+        end = address + len(bytes)
+        map = self.map
+        if map != None and end <= len(map):
+            map[address : end] = bytes
+        else:
+            # The write runs off the end of the mapping, so it has to go
+            # through the file, after which we map the extra space.
+            with self.lock:
+                FileStorage.write(self, address, bytes)
+                self._remap()
+
+    def append(self, bytes):
+        """ Writes the bytes at the end of the storage and returns the address
+        they were written to.
+
+        """
+        with self.lock:
+            address = FileStorage.append(self, bytes)
+            self._remap()
+            return address
+
+    def allocate(self, size, fill=chr(255)):
+        """ Appends size bytes to the end of the storage, each of them set to
+        fill, and returns the address of the newly allocated space.
+
+        """
+        with self.lock:
+            address = FileStorage.allocate(self, size, fill)
+            self._remap()
+            return address
+
+    def reload(self):
+        """ Maps the space that another process has added to the file. """
+        self._remap()
+
+    def flush(self):
+        """ Flushes the mapping and the file object. """
+        if self.map != None:
+            self.map.flush()
+        self.file_object.flush()
+
+    def close(self):
+        """ Unmaps the file and closes it. """
+        if self.map != None:
+            self.map.close()
+            self.map = None
+        self.file_object.close()
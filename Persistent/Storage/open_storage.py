@@ -0,0 +1,78 @@
+import os
+from Persistent.Storage.storage          import FileStorage
+from Persistent.Storage.mmap_storage     import MmapStorage
+from Persistent.Storage.readonly_storage import ReadOnlyStorage
+from Persistent.Storage.page_cache       import CachedStorage
+from Persistent.Storage.log_storage      import LoggedStorage, replay_log
+
+def open_file(file_name, address=None, readonly=False):
+    """ Opens the file with the given name for a container, and returns the
+    file object along with the address of the container.
+
+    If the file doesn't exist, it's created, and the address stays None so
+    that the container is created too. If the file exists already and no
+    address is supplied, the container is assumed to be at the start of it.
+
+    Read only files are never created, and are only opened for reading.
+
+    """
+    if os.path.exists(file_name) or readonly:
+        if address == None:
+            address = 0
+    else:
+        # Create the file if it doesn't exist
+        open(file_name, 'w').close()
+    return open(file_name, 'rb' if readonly else 'r+b'), address
+
+def open_storage(file_object, mmap=False, cache=None, durability=None,
+        readonly=False):
+    """ Wraps a file object in the storage that the container asked for.
+
+    By default this is a plain FileStorage. If mmap is True, the file is
+    memory mapped instead, which requires a real file on disk rather than
+    a StringIO or similar.
+
+    If a PageCache is given, reads and writes go through that cache.
+
+    If a durability is given, writes go through a write-ahead log that is
+    kept next to the file, and is named after it. See LoggedStorage for the
+    durability levels. Even without a durability, a log left behind by a
+    crash is replayed.
+
+    If readonly is True, the file is always memory mapped, shared and read
+    only, see ReadOnlyStorage. Read only storages share the operating
+    system's page cache rather than keeping a cache of their own, and never
+    write, so they can't have a cache or a durability. A log left behind by
+    the writer is left for the writer to replay.
+
+    >>> from cStringIO import StringIO
+    >>> open_storage(StringIO()).__class__.__name__
+    'FileStorage'
+    >>> open_storage(StringIO(), durability="op")
+    Traceback (most recent call last):
+    ...
+    ValueError: Log durability needs a named file to keep the log next to
+
+    """
+    if readonly:
+        if cache != None or durability != None:
+            raise Exception("Read only storages can't have a cache or a "
+                "durability")
+        return ReadOnlyStorage(file_object)
+    if mmap:
+        storage = MmapStorage(file_object)
+    else:
+        storage = FileStorage(file_object)
+    if cache != None:
+        storage = CachedStorage(storage, cache)
+    log_name = getattr(file_object, "name", None)
+    if log_name != None:
+        log_name += ".log"
+    elif durability != None:
+        raise ValueError("Log durability needs a named file to keep the log "
+            "next to")
+    if durability != None:
+        storage = LoggedStorage(storage, log_name, durability)
+    elif log_name != None:
+        replay_log(storage, log_name)
+    return storage
@@ -0,0 +1,347 @@
+import os
+import threading
+from collections import deque
+
+class PageCache:
+    """ PageCache keeps recently used parts of files in memory, so that
+    reading the same bytes again doesn't have to go to the operating system.
+
+    Files are split into fixed size pages. Reads load whole pages into the
+    cache, and writes only modify the cached pages, marking them as dirty.
+    Dirty pages are written back when they are evicted, or when flush() is
+    called. Once the cache holds more pages than its budget allows, pages
+    are evicted using the CLOCK algorithm. Every page has a referenced bit
+    that is set whenever the page is used. To evict a page, we go around
+    the pages in the order they were loaded. Pages with their bit set get
+    another chance and have the bit cleared, and the first page without it
+    is evicted. This is a cheap approximation of evicting the least recently
+    used page, that doesn't need any bookkeeping when a cached page is used.
+
+    A single cache can be shared by any number of containers, even ones
+    opened on the same file with their own file objects. Pages are keyed by
+    the file they belong to rather than by the container, so every container
+    reads the bytes that the others have written. All of the reads and
+    writes for a file go through the first storage that was opened on it.
+
+    Containers also keep some of what they've read in memory, such as the
+    fixed collections they've found in the directory, and the Bloom filters
+    and displacements of sets. The bytes alone don't keep that up to date,
+    so every storage counts the writes that the other storages on its file
+    have made, and a container refreshes itself before its next lookup or
+    write if the count has changed since it last looked, see
+    DynamicCollection.refresh. That costs a read of what it forgot, so
+    containers that take turns writing the same file keep reading it again.
+    The counts of live elements and tombstones in sets are only kept right
+    by one of them, so they're off when more than one of them writes to the
+    same set.
+
+    The cache is safe to use from many threads at once. It has a single lock
+    that is held while pages are looked up, loaded or evicted.
+
+    You don't use the cache directly. Instead, pass it to the containers
+    that should use it:
+
+    >>> from Persistent import Data, IntegerProperty, Hashmap
+    >>> class Pair(Data):
+    ...   key   = IntegerProperty(key=True)
+    ...   value = IntegerProperty()
+    ...
+    >>> cache = PageCache(budget=64 * 1024)
+    >>> m = Hashmap(Pair, "cache_doctest.db", cache=cache)
+    >>> for i in xrange(5000):
+    ...   m[i] = i
+    >>> len(cache.pages) * cache.page_size <= cache.budget
+    True
+    >>> n = Hashmap(Pair, "cache_doctest.db", cache=cache)
+    >>> [i for i in xrange(5000) if n[i] != i]
+    []
+    >>> m[0] = 10
+    >>> n[0]
+    10
+    >>> m.close()
+    >>> n.close()
+
+    >>> # Each container sees what the other one added, even to the fixed
+    >>> # sets and Bloom filters that it had already read
+    >>> m = Hashmap(Pair, "cache_doctest.db", cache=cache, bloom=True)
+    >>> n = Hashmap(Pair, "cache_doctest.db", cache=cache, bloom=True)
+    >>> n[6000], len(n.collections)
+    (None, 3)
+    >>> m.update(Pair(key=i, value=i) for i in xrange(6000, 12000))
+    >>> n[6000], n[11999], len(n.collections) == len(m.collections)
+    (6000, 11999, True)
+    >>> n.update(Pair(key=i, value=-i) for i in xrange(11000, 16000))
+    >>> m[11999], len(m.collections) == len(n.collections)
+    (-11999, True)
+    >>> m.close()
+    >>> n.close()
+
+    >>> # Everything made it to disk
+    >>> m = Hashmap(Pair, "cache_doctest.db")
+    >>> [i for i in xrange(1, 5000) if m[i] != i], m[0]
+    ([], 10)
+    >>> m.close()
+
+    >>> import os
+    >>> os.remove("cache_doctest.db")
+
+    """
+
+    def __init__(self, budget=64 * 1024 * 1024, page_size=4096):
+        """ Initializes a new page cache.
+
+        Budget is the number of bytes the cache may hold. Page_size is the
+        number of bytes in a page.
+
+        """
+        self.budget    = budget
+        self.page_size = page_size
+        # Maps (file, page number) to a [bytearray, dirty, referenced] list
+        self.pages     = {}
+        # The clock that we go around when evicting pages
+        self.clock     = deque()
+        self.lock      = threading.RLock()
+        # Maps each file to the storages that are open on it
+        self.storages  = {}
+
+    def register(self, storage):
+        """ Registers a storage with the cache, and returns the key that
+        identifies its file.
+
+        """
+        with self.lock:
+            try:
+                stat = os.fstat(storage.file_object.fileno())
+                key  = (stat.st_dev, stat.st_ino)
+            except (AttributeError, ValueError):
+                # Objects without a file descriptor, such as StringIO, can
+                # only be identified by themselves.
+                key = id(storage.file_object)
+            self.storages.setdefault(key, []).append(storage)
+            return key
+
+    def unregister(self, key, storage):
+        """ Writes back the dirty pages of the storage's file. Once no
+        storage is using the file anymore, its pages are dropped.
+
+        """
+        with self.lock:
+            self.flush(key)
+            self.storages[key].remove(storage)
+            if not self.storages[key]:
+                del self.storages[key]
+                self.drop(key)
+
+    def read(self, key, address, size):
+        """ Reads size bytes of the file, starting at address. """
+        with self.lock:
+            # Most reads fit in a single page
+            number, offset = divmod(address, self.page_size)
+            if offset + size <= self.page_size:
+                page = self._get_page(key, number)
+                return str(page[0][offset : offset + size])
+
+            chunks = []
+            while size > 0:
+                number, offset = divmod(address, self.page_size)
+                data   = self._get_page(key, number)[0]
+                chunk  = data[offset : offset + size]
+                chunks.append(chunk)
+                # A short page means we've hit the end of the file
+                if offset + size > len(data) and len(data) < self.page_size:
+                    break
+                address += len(chunk)
+                size    -= len(chunk)
+            return str(bytearray().join(chunks))
+
+    def write(self, key, address, bytes):
+        """ Writes the bytes to the file, starting at address. The bytes only
+        reach the file once their pages are written back.
+
+        """
+        with self.lock:
+            start = 0
+            while start < len(bytes):
+                number, offset = divmod(address + start, self.page_size)
+                stop = min(len(bytes), start + self.page_size - offset)
+                if offset == 0 and stop - start == self.page_size:
+                    # The whole page is overwritten, so there's no need to
+                    # read it
+                    page = self._put_page(key, number,
+                        bytearray(self.page_size))
+                else:
+                    page = self._get_page(key, number)
+                    # Just like a file, writing past the end fills the gap
+                    # with zeros
+                    if len(page[0]) < offset:
+                        page[0].extend(chr(0) * (offset - len(page[0])))
+                page[0][offset : offset + stop - start] = bytes[start : stop]
+                page[1] = True
+                start = stop
+
+    def _get_page(self, key, number):
+        """ Returns the page with the given number, reading it in if it isn't
+        cached yet.
+
+        """
+        page = self.pages.get((key, number))
+        if page == None:
+            data = self.storages[key][0].backing.read(
+                number * self.page_size, self.page_size)
+            return self._put_page(key, number, bytearray(data))
+        page[2] = True
+        return page
+
+    def _put_page(self, key, number, data):
+        """ Adds a clean page to the cache, evicting other pages if the cache
+        is over its budget.
+
+        """
+        while (len(self.pages) + 1) * self.page_size > self.budget and \
+                self.clock:
+            old = self.clock.popleft()
+            old_page = self.pages[old]
+            if old_page[2]:
+                old_page[2] = False
+                self.clock.append(old)
+                continue
+            del self.pages[old]
+            if old_page[1]:
+                self._write_back(old[0], old[1], old_page)
+        page = self.pages[(key, number)] = [data, False, True]
+        self.clock.append((key, number))
+        return page
+
+    def _write_back(self, key, number, page):
+        """ Writes a dirty page back to its file. """
+        self.storages[key][0].backing.write(number * self.page_size,
+            str(page[0]))
+        page[1] = False
+
+    def flush(self, key=None):
+        """ Writes back every dirty page, in the order the pages appear in
+        their files. If a key is given, only that file's pages are written.
+
+        """
+        with self.lock:
+            for (page_key, number), page in sorted(self.pages.items()):
+                if page[1] and key in (None, page_key):
+                    self._write_back(page_key, number, page)
+            for page_key, storages in self.storages.items():
+                if key in (None, page_key):
+                    for storage in storages:
+                        storage.backing.flush()
+
+    def drop(self, key, start=0):
+        """ Drops the file's pages from the cache, starting with the page that
+        holds the given address. Dirty pages have to be flushed first.
+
+        """
+        with self.lock:
+            first = start / self.page_size
+            for (page_key, number) in self.pages.keys():
+                if page_key == key and number >= first:
+                    del self.pages[(page_key, number)]
+            self.clock = deque(page for page in self.clock
+                if page in self.pages)
+
+
+class CachedStorage:
+    """ CachedStorage puts a PageCache in front of another storage. Reads and
+    writes go through the cache, while growing the file goes straight to the
+    storage underneath, which we call the backing storage.
+
+    """
+
+    def __init__(self, backing, cache):
+        """ Initializes a new storage that caches the backing storage. """
+        self.backing     = backing
+        self.cache       = cache
+        self.file_object = backing.file_object
+        # The number of writes that other storages on the same file have
+        # made since this one was opened
+        self.changes     = 0
+        self.key         = cache.register(self)
+
+    def _changed(self):
+        """ Counts a write for every other storage that's open on the same
+        file, so that their containers know to refresh themselves.
+
+        """
+        storages = self.cache.storages[self.key]
+        if len(storages) > 1:
+            with self.cache.lock:
+                for storage in storages:
+                    if storage is not self:
+                        storage.changes += 1
+
+    def read(self, address, size):
+        """ Reads size bytes starting at address. """
+        return self.cache.read(self.key, address, size)
+
+    def write(self, address, bytes):
+        """ Writes the bytes starting at address. """
+        self.cache.write(self.key, address, bytes)
+        self._changed()
+
+    def end(self):
+        """ Returns the address of the end of the storage. """
+        return self.backing.end()
+
+    def _grow(self):
+        """ The page holding the end of the file is only partly cached, so
+        before the file grows we write it back and drop it.
+
+        """
+        end = self.backing.end()
+        self.cache.flush(self.key)
+        self.cache.drop(self.key, end)
+
+    def append(self, bytes):
+        """ Writes the bytes at the end of the storage and returns the address
+        they were written to.
+
+        """
+        # Nobody may read the end of the file while it's growing
+        with self.cache.lock:
+            self._grow()
+            address = self.backing.append(bytes)
+            # The cache may read the new bytes through another file object
+            self.backing.flush()
+            self._changed()
+            return address
+
+    def allocate(self, size, fill=chr(255)):
+        """ Appends size bytes to the end of the storage, each of them set to
+        fill, and returns the address of the newly allocated space.
+
+        """
+        with self.cache.lock:
+            self._grow()
+            address = self.backing.allocate(size, fill)
+            self.backing.flush()
+            self._changed()
+            return address
+
+    def operation(self):
+        """ Returns the backing storage's operation context manager. """
+        return self.backing.operation()
+
+    def flush(self):
+        """ Writes back the dirty pages of this storage's file. """
+        self.cache.flush(self.key)
+
+    def reload(self):
+        """ Writes back the dirty pages of this storage's file and drops
+        them, so that what another process has written to it is read again.
+
+        """
+        with self.cache.lock:
+            self.cache.flush(self.key)
+            self.cache.drop(self.key)
+            self.backing.reload()
+
+    def close(self):
+        """ Writes back the dirty pages and closes the backing storage. """
+        self.cache.unregister(self.key, self)
+        self.backing.close()
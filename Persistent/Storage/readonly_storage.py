@@ -0,0 +1,77 @@
+import mmap
+from Persistent.Storage.mmap_storage import MmapStorage
+
+class ReadOnlyStorage(MmapStorage):
+    """ ReadOnlyStorage maps the file shared and read only. It's for
+    processes that only ever read a container that another process writes.
+    Every process that maps the same file shares the operating system's page
+    cache, so the data is only in memory once, however many readers there
+    are.
+
+    Nothing is ever written, appended or allocated. Trying to raises an
+    exception, instead of growing or changing the file.
+
+    The writer can go on writing to the file while it's mapped. Its writes
+    show up as soon as they reach the file, which for a writer that isn't
+    memory mapped itself is once it flushes. A read that runs past the end
+    of the mapping remaps the file first, so that space the writer has
+    appended since can be read. Containers find out about that space with
+    refresh(), see DynamicCollection.refresh.
+
+    >>> from Persistent.Storage import FileStorage
+    >>> writer = FileStorage(open("readonly_doctest.db", "w+b"))
+    >>> writer.append("header")
+    0
+    >>> writer.flush()
+    >>> s = ReadOnlyStorage(open("readonly_doctest.db", "rb"))
+    >>> s.read(0, 6)
+    'header'
+    >>> writer.append("more")
+    6
+    >>> writer.flush()
+    >>> s.read(4, 6)
+    'ermore'
+    >>> s.write(0, "x")
+    Traceback (most recent call last):
+    ...
+    Exception: The storage is read only
+    >>> s.close()
+    >>> writer.close()
+
+    >>> import os
+    >>> os.remove("readonly_doctest.db")
+
+    """
+
+    def __init__(self, file_object):
+        """ Initializes a new storage by mapping the given file object, which
+        only has to be open for reading.
+
+        """
+        MmapStorage.__init__(self, file_object, mmap.ACCESS_READ)
+
+    def read(self, address, size):
+        """ Reads size bytes starting at address. If that runs past the end
+        of the mapping, the file may have grown, so it's remapped first.
+
+        """
+        map = self.map
+        if map == None or address + size > len(map):
+            self._remap()
+        return MmapStorage.read(self, address, size)
+
+    def write(self, address, bytes):
+        """ Read only storages can't be written to. """
+        raise Exception("The storage is read only")
+
+    def append(self, bytes):
+        """ Read only storages can't be appended to. """
+        raise Exception("The storage is read only")
+
+    def allocate(self, size, fill=chr(255)):
+        """ Read only storages can't be allocated in. """
+        raise Exception("The storage is read only")
+
+    def flush(self):
+        """ There's never anything to flush. """
+        pass
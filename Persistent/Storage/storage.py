@@ -0,0 +1,147 @@
+import threading
+
+class FileStorage:
+    """ FileStorage is the layer that sits between the fixed collections and
+    the file that they live in. Containers never touch their file object
+    directly, instead they ask their storage to read or write a number of
+    bytes at a given address.
+
+    This is the simplest storage there is. Every read and write is a seek
+    followed by a read or write on the underlying file object. Any object
+    that behaves like a file will do, including a StringIO.
+
+    Other storages, such as MmapStorage, implement the same handful of
+    methods, so the containers don't need to care which one they're using.
+
+    Storages are safe to share between threads. Since reads and writes are
+    made by address, rather than relative to a shared file position, two
+    threads can't get in each other's way. Python 2 doesn't have os.pread
+    and os.pwrite, so here each seek and the read or write that follows it
+    happen under a lock. MmapStorage reads straight from the mapping, which
+    doesn't involve the file position at all.
+
+    >>> from cStringIO import StringIO
+    >>> s = FileStorage(StringIO())
+    >>> s.append("header")
+    0
+    >>> s.allocate(4)
+    6
+    >>> s.end()
+    10
+    >>> s.write(6, "ab")
+    >>> s.read(4, 6)
+    'erab\\xff\\xff'
+
+    >>> # Zero filled space is allocated without writing it out
+    >>> s.allocate(5, chr(0))
+    10
+    >>> s.read(8, 10)
+    '\\xff\\xff\\x00\\x00\\x00\\x00\\x00'
+
+    """
+
+    # Growing the storage is done half a megabyte at a time
+    block_size = 512 * 1024
+
+    def __init__(self, file_object):
+        """ Initializes a new storage on top of an open file object. """
+        self.file_object = file_object
+        self.lock        = threading.RLock()
+
+    def read(self, address, size):
+        """ Reads size bytes starting at address. """
+        with self.lock:
+            self.file_object.seek(address)
+            return self.file_object.read(size)
+
+    def write(self, address, bytes):
+        """ Writes the bytes starting at address. """
+        with self.lock:
+            self.file_object.seek(address)
+            self.file_object.write(bytes)
+
+    def end(self):
+        """ Returns the address of the end of the storage. """
+        with self.lock:
+            self.file_object.seek(0, 2)
+            return self.file_object.tell()
+
+    def append(self, bytes):
+        """ Writes the bytes at the end of the storage and returns the address
+        they were written to.
+
+        """
+        with self.lock:
+            address = self.end()
+            self.file_object.write(bytes)
+            return address
+
+    def allocate(self, size, fill=chr(255)):
+        """ Appends size bytes to the end of the storage, each of them set to
+        fill, and returns the address of the newly allocated space.
+
+        """
+        with self.lock:
+            address = self.end()
+
+            # Zero filled space doesn't need to be written at all. Writing a
+            # single byte at the very end of the space extends the file, and
+            # the file system leaves a hole in front of it that reads back as
+            # zeros. This makes allocating space constant time, no matter how
+            # large.
+            if fill == chr(0):
+                if size > 0:
+                    self.file_object.seek(address + size - 1)
+                    self.file_object.write(fill)
+                return address
+
+            # Otherwise we write the space a block at a time
+            block = fill * self.block_size
+            for i in xrange(size / self.block_size):
+                self.file_object.write(block)
+
+            # The last block won't likely be a full block, so we create a
+            # special block for the last one.
+            self.file_object.write(fill * (size % self.block_size))
+            return address
+
+    def operation(self):
+        """ Returns a context manager that groups the reads and writes made
+        within it into a single operation. Containers wrap anything that
+        needs more than one write to be consistent in an operation, such as
+        allocating a new collection and pointing to it.
+
+        Plain storages don't care about operations, but storages such as
+        LoggedStorage use them to commit writes atomically.
+
+        """
+        return _no_operation
+
+    def flush(self):
+        """ Pushes any buffered writes down to the operating system. """
+        with self.lock:
+            self.file_object.flush()
+
+    def reload(self):
+        """ Forgets anything the storage holds in memory about the file,
+        once another process has written to it. Plain storages read the file
+        every time, so there's nothing to forget.
+
+        """
+        pass
+
+    def close(self):
+        """ Closes the underlying file object. """
+        self.file_object.close()
+
+
+class _NoOperation:
+    """ The context manager returned by FileStorage.operation(). """
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, type, value, traceback):
+        pass
+
+_no_operation = _NoOperation()
@@ -3,4 +3,6 @@ from Persistent.Data              import Data
 from Persistent.Property          import Property, StringProperty, IntegerProperty
 from Persistent.Array             import Array, FixedArray
 from Persistent.Hashset           import Hashset
-from Persistent.Hashmap           import Hashmap
+from Persistent.Hashmap           import Hashmap, ShardedHashmap
+from Persistent.Btree             import Btree
+from Persistent.Storage           import PageCache
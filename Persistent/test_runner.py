@@ -1,16 +1,39 @@
 import unittest
 import doctest
 
-suite = unittest.TestSuite()
-for mod in ("Persistent.Property.property",
+modules = ["Persistent.Storage.storage",
+            "Persistent.Storage.mmap_storage",
+            "Persistent.Storage.page_cache",
+            "Persistent.Storage.log_storage",
+            "Persistent.Storage.readonly_storage",
+            "Persistent.Storage.open_storage",
+            "Persistent.DynamicCollection.dynamic_collection",
+            "Persistent.Executor.executor",
+            "Persistent.Property.property",
             "Persistent.Property.integer" ,
             "Persistent.Property.string"  ,
             "Persistent.Array.fixed_array",
             "Persistent.Array.array",
+            "Persistent.Hashset.hashes",
             "Persistent.Hashset.fixed_set",
             "Persistent.Hashset.hashset",
             "Persistent.Hashmap.hashmap",
-            "Persistent.Data.data"        ):
+            "Persistent.Hashmap.index",
+            "Persistent.Hashmap.sharded_hashmap",
+            "Persistent.Btree.btree",
+            "Persistent.Data.codec",
+            "Persistent.Data.dtype",
+            "Persistent.Data.data"        ]
+
+# numpy is optional, so the tests that need it only run if it's there
+try:
+    import numpy
+    modules.append("Persistent.Array.numpy_test")
+except ImportError:
+    pass
+
+suite = unittest.TestSuite()
+for mod in modules:
     suite.addTest(doctest.DocTestSuite(mod))
 runner = unittest.TextTestRunner()
 runner.run(suite)
@@ -8,16 +8,17 @@
 
 import os
 from time import time
-from Persistent import Array, Hashset, Hashmap, Data, IntegerProperty
+from Persistent import Array, Hashset, Hashmap, Data, IntegerProperty, \
+    PageCache
 
 class User(Data):
     id     = IntegerProperty(key=True)
     age    = IntegerProperty()
 
-def test(container, setter, getter):
+def test(container, setter, getter, **kwargs):
     db    = "test.db"
     size  = 174000
-    users = container(User, db)
+    users = container(User, db, **kwargs)
 
     t = time()
     for i in xrange(size):
@@ -35,6 +36,12 @@ def test(container, setter, getter):
     t = time() - t
     print "Reading: %d" % (size / t)
 
+    t = time()
+    for user in users.values():
+        pass
+    t = time() - t
+    print "Iterating: %d" % (size / t)
+
     users.close()
     os.remove(db)
 
@@ -52,3 +59,9 @@ print "\nHashmap"
 def setter(x, y):
     x[y] = y
 test(Hashmap, setter, lambda x, y: x.get(User(id=y)))
+
+print "\nHashmap (mmap)"
+test(Hashmap, setter, lambda x, y: x.get(User(id=y)), mmap=True)
+
+print "\nHashmap (page cache)"
+test(Hashmap, setter, lambda x, y: x.get(User(id=y)), cache=PageCache())
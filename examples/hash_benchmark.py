@@ -0,0 +1,54 @@
+###############################################################################
+# The author or authors of this code dedicate any and all copyright interest in
+# this code to the public domain. We make this dedication for the benefit of
+# the public at large and to the detriment of our heirs and successors. We
+# intend this dedication to be an overt act of relinquishment in perpetuity of
+# all present and future rights to this code under copyright law.
+###############################################################################
+
+import os
+from time import time
+from Persistent import Hashmap, Data, IntegerProperty
+from Persistent.Hashset.hashes import hashes, names
+
+class User(Data):
+    id     = IntegerProperty(key=True)
+    age    = IntegerProperty()
+
+size  = 174000
+rates = {}
+
+for name in names:
+    print "\n%s" % name
+
+    hash  = hashes[name]
+    keys  = [User(id=i).unload_key() for i in xrange(size)]
+    t = time()
+    for key in keys:
+        hash(key)
+    t = time() - t
+    rates[name] = size / t
+    print "Hashing: %d (%.2fx md5)" % (rates[name], rates[name] / rates["md5"])
+
+    db    = "test.db"
+    users = Hashmap(User, db, hash=name)
+
+    t = time()
+    for i in xrange(size):
+        users[i] = i
+    t = time() - t
+    print "Writing: %d" % (size / t)
+
+    t = time()
+    for i in xrange(size):
+        if users[i] != i:
+            users.close()
+            os.remove(db)
+            raise Exception("FAILED: %d" % i)
+    t = time() - t
+    print "Reading: %d" % (size / t)
+
+    print "Fixed sets: %d" % len(users.collections)
+
+    users.close()
+    os.remove(db)
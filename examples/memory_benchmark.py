@@ -0,0 +1,51 @@
+###############################################################################
+# The author or authors of this code dedicate any and all copyright interest in
+# this code to the public domain. We make this dedication for the benefit of
+# the public at large and to the detriment of our heirs and successors. We
+# intend this dedication to be an overt act of relinquishment in perpetuity of
+# all present and future rights to this code under copyright law.
+###############################################################################
+
+import os
+from sys import getsizeof
+from time import time
+from Persistent import Array, Data, IntegerProperty
+
+class User(Data):
+    id     = IntegerProperty(key=True)
+    age    = IntegerProperty()
+
+class SlottedUser(Data):
+    _slots = True
+    id     = IntegerProperty(key=True)
+    age    = IntegerProperty()
+
+db   = "test.db"
+size = 174000
+
+def test(users, result):
+    t = time()
+    records = users.get_many(xrange(size), result)
+    t = time() - t
+    print "Reading: %d" % (size / t)
+    # The values themselves take the same space whatever holds them, so we
+    # only count the records, and the __dict__ they keep their values in
+    record = records[-1]
+    size_  = getsizeof(record)
+    if not isinstance(record, tuple) and hasattr(record, "__dict__"):
+        size_ += getsizeof(record.__dict__)
+    print "Bytes per record: %d" % size_
+
+print "On disk: %d bytes per record" % User._size
+
+for cls in (User, SlottedUser):
+    users = Array(cls, db)
+    users.set_many((i, cls(id=i, age=i)) for i in xrange(size))
+    results = ["data"]
+    if cls == User:
+        results = ["tuple", "namedtuple", "data"]
+    for result in results:
+        print "\n%s %s" % (cls.__name__, result)
+        test(users, result)
+    users.close()
+    os.remove(db)